@@ -8,12 +8,22 @@ login = LoginManager(app)
 login.login_view = 'login'
 login.login_message = "Please login to access system"
 
-from app.commands import run_test_command
-from app.db import init_db_command, seed_db
+from app.commands import (run_test_command, profile_queries_command, dashboard_cache_command,
+                          benchmark_reports_command, generate_reports_command)
+from app.db import (init_db_command, seed_db, rebuild_fts_command, rebuild_rollup_command,
+                    rebuild_utilization_items_command, close_months_command)
 
 app.cli.add_command(init_db_command)
 app.cli.add_command(seed_db)
+app.cli.add_command(rebuild_fts_command)
+app.cli.add_command(rebuild_rollup_command)
+app.cli.add_command(rebuild_utilization_items_command)
+app.cli.add_command(close_months_command)
 app.cli.add_command(run_test_command)
+app.cli.add_command(profile_queries_command)
+app.cli.add_command(dashboard_cache_command)
+app.cli.add_command(benchmark_reports_command)
+app.cli.add_command(generate_reports_command)
 
 from app import routes, services, models
 from jinja2 import StrictUndefined
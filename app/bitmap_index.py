@@ -0,0 +1,267 @@
+''' Roaring-style bitmaps of encounter row positions per value of the low-cardinality columns '''
+
+import os
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # optional, like the column store the bitmaps are built from
+    np = None
+
+CHUNK_ROWS = 1 << 16
+CHUNK_WORDS = CHUNK_ROWS // 64
+# a chunk holding more rows than this is smaller as a bitset than as a uint16 array
+ARRAY_LIMIT = 4096
+
+
+def popcount(words: 'np.ndarray') -> int:
+    '''Set bits in uint64 words; bitwise_count only exists from NumPy 2.0'''
+    if hasattr(np, 'bitwise_count'):
+        return int(np.bitwise_count(words).sum())
+    return int(np.unpackbits(words.view(np.uint8)).sum())
+
+
+def pack(mask: 'np.ndarray') -> 'np.ndarray':
+    '''Boolean row mask as uint64 words, padded to whole chunks, bit i of word w being row 64w + i'''
+    padded = np.zeros(-(-mask.size // CHUNK_ROWS) * CHUNK_ROWS, dtype=bool)
+    padded[:mask.size] = mask
+    return np.packbits(padded, bitorder='little').view('<u8')
+
+
+class Bitmap:
+    '''
+    Immutable set of row positions split into chunks of 65536 rows. A chunk with at most
+    4096 rows is a sorted uint16 array of offsets, a fuller one a 1024-word bitset.
+    Intersections, unions and complements work chunk by chunk on these containers.
+    '''
+    __slots__ = ('chunks',)
+
+    def __init__(self, chunks: Optional[Dict[int, 'np.ndarray']] = None):
+        self.chunks = chunks or {}
+
+    @staticmethod
+    def _container(offsets: 'np.ndarray') -> 'np.ndarray':
+        if offsets.size <= ARRAY_LIMIT:
+            return offsets.astype(np.uint16)
+        bits = np.zeros(CHUNK_ROWS, dtype=bool)
+        bits[offsets] = True
+        return np.packbits(bits, bitorder='little').view('<u8')
+
+    @staticmethod
+    def _offsets(container: 'np.ndarray') -> 'np.ndarray':
+        if container.dtype == np.uint16:
+            return container
+        return np.flatnonzero(np.unpackbits(container.view(np.uint8), bitorder='little')).astype(np.uint16)
+
+    @staticmethod
+    def _words(container: 'np.ndarray') -> 'np.ndarray':
+        if container.dtype != np.uint16:
+            return container
+        bits = np.zeros(CHUNK_ROWS, dtype=bool)
+        bits[container] = True
+        return np.packbits(bits, bitorder='little').view('<u8')
+
+    @classmethod
+    def _compact(cls, words: 'np.ndarray') -> 'np.ndarray':
+        '''Smaller container for the rows of a bitset'''
+        return cls._offsets(words) if popcount(words) <= ARRAY_LIMIT else words
+
+    def __and__(self, other: 'Bitmap') -> 'Bitmap':
+        chunks = {}
+        for chunk in self.chunks.keys() & other.chunks.keys():
+            left, right = self.chunks[chunk], other.chunks[chunk]
+            if left.dtype == np.uint16 and right.dtype == np.uint16:
+                container = np.intersect1d(left, right, assume_unique=True)
+            elif left.dtype == np.uint16 or right.dtype == np.uint16:
+                offsets, words = (left, right) if left.dtype == np.uint16 else (right, left)
+                bits = words[offsets >> 6] >> (offsets & 63).astype(np.uint64)
+                container = offsets[(bits & np.uint64(1)).astype(bool)]
+            else:
+                container = self._compact(left & right)
+            if container.size:
+                chunks[chunk] = container
+        return Bitmap(chunks)
+
+    @classmethod
+    def union(cls, bitmaps: Iterable['Bitmap']) -> 'Bitmap':
+        by_chunk: Dict[int, List['np.ndarray']] = {}
+        for bitmap in bitmaps:
+            for chunk, container in bitmap.chunks.items():
+                by_chunk.setdefault(chunk, []).append(container)
+        chunks = {}
+        for chunk, containers in by_chunk.items():
+            if len(containers) == 1:
+                chunks[chunk] = containers[0]
+            elif all(container.dtype == np.uint16 for container in containers):
+                chunks[chunk] = cls._container(np.unique(np.concatenate(containers)))
+            else:
+                words = np.zeros(CHUNK_WORDS, dtype='<u8')
+                for container in containers:
+                    words |= cls._words(container)
+                chunks[chunk] = cls._compact(words)
+        return Bitmap(chunks)
+
+    def complement(self, size: int) -> 'Bitmap':
+        '''Rows below size that are not in the bitmap'''
+        chunks = {}
+        for chunk in range(-(-size // CHUNK_ROWS)):
+            words = ~self._words(self.chunks.get(chunk, np.zeros(0, dtype=np.uint16)))
+            rows = size - chunk * CHUNK_ROWS
+            if rows < CHUNK_ROWS:
+                words &= pack(np.arange(CHUNK_ROWS) < rows)
+            container = self._compact(words)
+            if container.size:
+                chunks[chunk] = container
+        return Bitmap(chunks)
+
+    def mask(self, size: int) -> 'np.ndarray':
+        '''The rows as a boolean mask over size rows'''
+        mask = np.zeros(-(-size // CHUNK_ROWS) * CHUNK_ROWS, dtype=bool)
+        for chunk, container in self.chunks.items():
+            if container.dtype == np.uint16:
+                mask[chunk * CHUNK_ROWS + container.astype(np.int64)] = True
+            else:
+                mask[chunk * CHUNK_ROWS:(chunk + 1) * CHUNK_ROWS] = np.unpackbits(
+                    container.view(np.uint8), bitorder='little').view(bool)
+        return mask[:size]
+
+    def extended(self, rows: 'np.ndarray') -> 'Bitmap':
+        '''Copy with rows added; rows are ascending and past every row already in the bitmap'''
+        chunks = dict(self.chunks)
+        high = rows >> 16
+        starts = np.flatnonzero(np.diff(high, prepend=-1)).tolist()
+        for start, end in zip(starts, starts[1:] + [rows.size]):
+            chunk = int(high[start])
+            offsets = (rows[start:end] & 0xFFFF).astype(np.uint16)
+            if chunk in chunks:
+                offsets = np.concatenate([self._offsets(chunks[chunk]), offsets])
+            chunks[chunk] = self._container(offsets)
+        return Bitmap(chunks)
+
+
+class BitmapIndex:
+    '''
+    A Bitmap per value of each indexed encounter column, over the first size rows of the
+    column store in id order. Text columns are keyed by their value (folded when NOCASE),
+    so a saved index does not depend on the codes of the process that wrote it.
+    Only the numpy and compare dashboard engines build it; the default sql engine never does.
+    '''
+    COLUMNS = ('scheme', 'outcome', 'facility_id', 'gender', 'age_group', 'enc_type')
+    INTEGER_COLUMNS = ('scheme', 'outcome', 'facility_id')
+
+    def __init__(self, size: int = 0, bitmaps: Optional[Dict[str, Dict[Any, Bitmap]]] = None):
+        self.size = size
+        self.bitmaps = bitmaps or {column: {} for column in self.COLUMNS}
+        self._flat: Dict[str, Tuple] = {}
+
+    def _flattened(self, column: str) -> Tuple[List, 'np.ndarray', 'np.ndarray', List[Tuple]]:
+        '''
+        Values of column, the rows of all their array chunks with the position of the value
+        each belongs to, and their bitset chunks, so counting every value is one pass
+        '''
+        if column not in self._flat:
+            values = list(self.bitmaps[column])
+            rows, owners, bitsets = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], []
+            for position, value in enumerate(values):
+                for chunk, container in self.bitmaps[column][value].chunks.items():
+                    if container.dtype == np.uint16:
+                        rows.append(chunk * CHUNK_ROWS + container.astype(np.int64))
+                        owners.append(np.full(container.size, position, dtype=np.int64))
+                    else:
+                        bitsets.append((position, chunk, container))
+            self._flat[column] = (values, np.concatenate(rows), np.concatenate(owners), bitsets)
+        return self._flat[column]
+
+    def union(self, column: str, values: Iterable) -> Bitmap:
+        '''Rows having any of values in column'''
+        bitmaps = self.bitmaps[column]
+        return Bitmap.union(bitmaps[value] for value in set(values) if value in bitmaps)
+
+    def mask(self, column: str, values: Iterable, size: int) -> 'np.ndarray':
+        '''Rows having any of values in column, as a boolean mask over size rows'''
+        return self.union(column, values).mask(size)
+
+    def counts(self, column: str, mask: 'np.ndarray') -> Dict[Any, int]:
+        '''Intersection cardinality of each value bitmap of column with the rows of mask'''
+        values, rows, owners, bitsets = self._flattened(column)
+        counts = np.bincount(owners[mask[rows]], minlength=len(values))
+        if bitsets:
+            words = pack(mask)
+            for position, chunk, container in bitsets:
+                counts[position] += popcount(container & words[chunk * CHUNK_WORDS:(chunk + 1) * CHUNK_WORDS])
+        return dict(zip(values, counts.tolist()))
+
+    def extended(self, values: Dict[str, 'np.ndarray'], keys: Dict[str, List]) -> 'BitmapIndex':
+        '''
+        Copy indexing the rows appended after size. values holds their column arrays and
+        keys the value of each code of the text columns.
+        '''
+        count = len(values[self.COLUMNS[0]])
+        bitmaps = {}
+        for column in self.COLUMNS:
+            by_value = dict(self.bitmaps[column])
+            column_values = values[column]
+            order = np.argsort(column_values, kind='stable')
+            ordered = column_values[order]
+            starts = np.flatnonzero(np.diff(ordered, prepend=ordered[:1] - 1)).tolist() if count else []
+            for start, end in zip(starts, starts[1:] + [count]):
+                value = int(ordered[start])
+                if column in keys:
+                    value = keys[column][value]
+                rows = self.size + order[start:end].astype(np.int64)
+                by_value[value] = by_value.get(value, Bitmap()).extended(rows)
+            bitmaps[column] = by_value
+        return BitmapIndex(self.size + count, bitmaps)
+
+    def save(self, path: str, rewrites: int, max_id: int):
+        '''Write the index next to the database, replacing the previous file in one rename'''
+        names, entries, arrays, bitsets = [], [], [], []
+        array_size = bitset_size = 0
+        for column in self.COLUMNS:
+            for value, bitmap in self.bitmaps[column].items():
+                names.append(f'{column}\t{value}')
+                for chunk, container in bitmap.chunks.items():
+                    if container.dtype == np.uint16:
+                        entries.append((len(names) - 1, chunk, 0, array_size, container.size))
+                        arrays.append(container)
+                        array_size += container.size
+                    else:
+                        entries.append((len(names) - 1, chunk, 1, bitset_size, container.size))
+                        bitsets.append(container)
+                        bitset_size += container.size
+
+        partial = f'{path}.{os.getpid()}.tmp'
+        with open(partial, 'wb') as file:
+            np.savez(file, meta=np.array([rewrites, self.size, max_id], dtype=np.int64),
+                     names=np.array(names, dtype=str),
+                     entries=np.array(entries, dtype=np.int64).reshape(-1, 5),
+                     arrays=np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.uint16),
+                     bitsets=np.concatenate(bitsets) if bitsets else np.zeros(0, dtype='<u8'))
+        os.replace(partial, path)
+
+    @classmethod
+    def load(cls, path: str, rewrites: int, ids: 'np.ndarray') -> Optional['BitmapIndex']:
+        '''
+        Saved index when it was written at the same rewrites counter over a prefix of the
+        rows with encounter ids ids; None when missing, unreadable or stale.
+        '''
+        try:
+            with np.load(path, allow_pickle=False) as saved:
+                saved_rewrites, size, max_id = saved['meta'].tolist()
+                if (saved_rewrites != rewrites or size > ids.size
+                        or (size and int(ids[size - 1]) != max_id)):
+                    return None
+                names, entries = saved['names'].tolist(), saved['entries']
+                arrays, bitsets = saved['arrays'], saved['bitsets']
+        except (OSError, ValueError, KeyError):
+            return None
+
+        bitmaps = {column: {} for column in cls.COLUMNS}
+        chunks: List[Dict[int, 'np.ndarray']] = [{} for _ in names]
+        for name, chunk, kind, start, length in entries.tolist():
+            source = bitsets if kind else arrays
+            chunks[name][chunk] = source[start:start + length]
+        for name, name_chunks in zip(names, chunks):
+            column, value = name.split('\t', 1)
+            bitmaps[column][int(value) if column in cls.INTEGER_COLUMNS else value] = Bitmap(name_chunks)
+        return cls(size, bitmaps)
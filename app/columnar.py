@@ -0,0 +1,558 @@
+''' In-process column store of the encounter fields the dashboard counts over '''
+
+import math
+import threading
+from dataclasses import dataclass
+from datetime import date, datetime
+from functools import cached_property, reduce, wraps
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # optional: without numpy the dashboard stays on SQL
+    np = None
+
+from app import app
+from app.bitmap_index import Bitmap, BitmapIndex
+from app.db import _is_memory_database, get_read_db
+from app.filter_parser import Filter, Params
+from app.models import Encounter, Facility, TreatmentOutcome
+from app.result_cache import current_data_version
+
+_EPOCH = date(1970, 1, 1).toordinal()
+_COMPARISONS = {'=': 'eq', '!=': 'ne', '<': 'lt', '<=': 'le', '>': 'gt', '>=': 'ge'}
+
+
+class Codes:
+    '''Small-int codes of a text column; NOCASE columns share a code across spellings'''
+
+    def __init__(self, nocase: bool = False):
+        self.nocase = nocase
+        self.labels: List[str] = []
+        self._index: Dict[str, int] = {}
+
+    def copy(self) -> 'Codes':
+        other = Codes(self.nocase)
+        other.labels, other._index = list(self.labels), dict(self._index)
+        return other
+
+    def _key(self, value: str) -> str:
+        return value.lower() if self.nocase else value
+
+    def code(self, value: Any) -> int:
+        '''Code of value, -1 when no row has it'''
+        if not isinstance(value, str):
+            return -1
+        return self._index.get(self._key(value), -1)
+
+    def encode(self, values) -> 'np.ndarray':
+        mapping = {}
+        for value in set(values):
+            key = self._key(value)
+            if key not in self._index:
+                self._index[key] = len(self.labels)
+                self.labels.append(value)
+            mapping[value] = self._index[key]
+        return np.fromiter(map(mapping.__getitem__, values), dtype=np.int16, count=len(values))
+
+
+def _day(value: Any) -> Optional[int]:
+    '''Days since 1970 of a date filter value, None when SQLite would compare it differently'''
+    if isinstance(value, datetime):
+        return None
+    if isinstance(value, str):
+        try:
+            value = date.fromisoformat(value)
+        except ValueError:
+            return None
+        if len(value.isoformat()) != 10:
+            return None
+    if isinstance(value, date):
+        return value.toordinal() - _EPOCH
+    return None
+
+
+def _integer(value: Any) -> Optional[int]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.strip().lstrip('-').isdigit():
+        return int(value)
+    return None
+
+
+def _compare(values: 'np.ndarray', op: str, operand) -> 'np.ndarray':
+    if op == 'BETWEEN':
+        return (values >= operand[0]) & (values <= operand[1])
+    return getattr(values, f'__{_COMPARISONS[op]}__')(operand)
+
+
+def _period_labels(granularity: str, buckets: 'np.ndarray') -> List[str]:
+    if granularity == 'week':
+        return [str(np.datetime64(int(day), 'D')) for day in buckets]
+    if granularity == 'month':
+        return [f'{1970 + month // 12}-{month % 12 + 1:02d}' for month in buckets.tolist()]
+    if granularity == 'quarter':
+        return [f'{1970 + quarter // 4}-Q{quarter % 4 + 1}' for quarter in buckets.tolist()]
+    return [str(1970 + year) for year in buckets.tolist()]
+
+
+@dataclass(frozen=True)
+class EncounterColumns:
+    '''
+    Immutable snapshot of the encounter columns as NumPy arrays: dates as days since 1970,
+    text columns as Codes, plus the facility, scheme and outcome lookups joined on them.
+    Filters become boolean masks and group-bys np.bincount over the masked codes. With a
+    BitmapIndex, equality filters are unions of value bitmaps, combined with each other as
+    bitmaps and expanded to a mask once, and single-column group-bys are the intersection
+    cardinalities of each value bitmap with the final mask. Date and range filters stay masks.
+    '''
+    database: str
+    version: int
+    rewrites: Optional[int]
+    max_id: int
+    date: 'np.ndarray'
+    facility_id: 'np.ndarray'
+    scheme: 'np.ndarray'
+    outcome: 'np.ndarray'
+    age: 'np.ndarray'
+    gender: 'np.ndarray'
+    age_group: 'np.ndarray'
+    enc_type: 'np.ndarray'
+    treatment_cost: 'np.ndarray'
+    medication_cost: 'np.ndarray'
+    investigation_cost: 'np.ndarray'
+    codes: Dict[str, Codes]
+    facility_names: Dict[int, str]
+    facility_lga: 'np.ndarray'  # lga code per facility id, -1 when there is no such facility
+    scheme_labels: Dict[int, Tuple[str, str]]  # id -> (scheme_name, color_scheme)
+    outcome_names: Dict[int, str]
+    outcome_types: Dict[int, str]
+    outcome_name: 'np.ndarray'  # name code per outcome id, -1 when there is no such outcome
+    outcome_type: 'np.ndarray'
+    bitmaps: Optional[BitmapIndex] = None
+
+    NUMERIC = {(Encounter, 'facility_id'): 'facility_id', (Facility, 'id'): 'facility_id',
+               (Encounter, 'scheme'): 'scheme', (Encounter, 'outcome'): 'outcome',
+               (Encounter, 'age'): 'age'}
+    CODED = {(Encounter, 'gender'): 'gender', (Encounter, 'age_group'): 'age_group',
+             (Encounter, 'enc_type'): 'enc_type'}
+    # filters on a joined table: per-row lookup and its codes
+    LOOKUPS = {(Facility, 'local_government'): ('row_lga', 'lga'),
+               (TreatmentOutcome, 'name'): ('row_outcome_name', 'outcome_name'),
+               (TreatmentOutcome, 'type'): ('row_outcome_type', 'outcome_type')}
+    # filters answered from the bitmap index: indexed column, or lookup table, its codes and the id column
+    BITMAPS = {(Encounter, 'facility_id'): 'facility_id', (Facility, 'id'): 'facility_id',
+               (Encounter, 'scheme'): 'scheme', (Encounter, 'outcome'): 'outcome',
+               (Encounter, 'gender'): 'gender', (Encounter, 'age_group'): 'age_group',
+               (Encounter, 'enc_type'): 'enc_type'}
+    BITMAP_LOOKUPS = {(Facility, 'local_government'): ('facility_lga', 'lga', 'facility_id'),
+                      (TreatmentOutcome, 'name'): ('outcome_name', 'outcome_name', 'outcome'),
+                      (TreatmentOutcome, 'type'): ('outcome_type', 'outcome_type', 'outcome')}
+
+    @property
+    def size(self) -> int:
+        return len(self.date)
+
+    @staticmethod
+    def _lookup(table: 'np.ndarray', ids: 'np.ndarray') -> 'np.ndarray':
+        # ids past the end of the lookup are rows referencing a missing facility or outcome
+        safe = np.minimum(ids, len(table) - 1) if len(table) else np.zeros_like(ids)
+        values = table[safe] if len(table) else np.full(len(ids), -1, dtype=np.int16)
+        return np.where(ids < len(table), values, -1)
+
+    def _bitmap_rows(self, fil: Filter) -> Optional[Bitmap]:
+        '''Equality filter as a union of value bitmaps, None when the index cannot answer it'''
+        op, key, value = fil.op.upper(), (fil.model, fil.col), fil.value
+        if self.bitmaps is None or op not in ('=', '!='):
+            return None
+        if key in self.BITMAPS:
+            column = self.BITMAPS[key]
+            if column in BitmapIndex.INTEGER_COLUMNS:
+                value = _integer(value)
+            elif isinstance(value, str):
+                value = self.codes[column]._key(value)
+            else:
+                return None
+            if value is None:
+                return None
+            rows = self.bitmaps.union(column, (value,))
+            return rows if op == '=' else rows.complement(self.size)
+
+        if key in self.BITMAP_LOOKUPS and isinstance(value, str):
+            table_name, codes_name, column = self.BITMAP_LOOKUPS[key]
+            table, code = getattr(self, table_name), self.codes[codes_name].code(value)
+            if op == '=':
+                ids = np.flatnonzero(table == code) if code >= 0 else []
+            else:
+                ids = np.flatnonzero((table >= 0) & (table != code))
+            return self.bitmaps.union(column, np.asarray(ids).tolist())
+        return None
+
+    def _filter_mask(self, fil: Filter) -> Optional['np.ndarray']:
+        op = fil.op.upper()
+        if op not in _COMPARISONS and op != 'BETWEEN':
+            return None
+        operands = fil.value if op == 'BETWEEN' else (fil.value,)
+        if op == 'BETWEEN' and (not isinstance(operands, (tuple, list)) or len(operands) != 2):
+            return None
+        key = (fil.model, fil.col)
+
+        if key == (Encounter, 'date'):
+            days = [_day(value) for value in operands]
+            if None in days:
+                return None
+            return _compare(self.date, op, days if op == 'BETWEEN' else days[0])
+        rows = self._bitmap_rows(fil)
+        if rows is not None:
+            return rows.mask(self.size)
+        if key in self.NUMERIC:
+            numbers = [_integer(value) for value in operands]
+            if None in numbers:
+                return None
+            return _compare(getattr(self, self.NUMERIC[key]), op, numbers if op == 'BETWEEN' else numbers[0])
+
+        if key in self.CODED:
+            codes, values = self.codes[self.CODED[key]], getattr(self, self.CODED[key])
+        elif key in self.LOOKUPS:
+            lookup, codes_name = self.LOOKUPS[key]
+            codes, values = self.codes[codes_name], getattr(self, lookup)
+        else:
+            return None
+        # only equality keeps its meaning on codes
+        if op not in ('=', '!=') or not isinstance(fil.value, str):
+            return None
+        code = codes.code(fil.value)
+        if op == '=':
+            return (values == code) if code >= 0 else np.zeros(self.size, dtype=bool)
+        return (values != code) & (values >= 0)
+
+    def mask(self, params: Params) -> Optional['np.ndarray']:
+        '''Rows matching the filters of params, None when params needs the SQL path'''
+        if params.group_by or params.order_by or params.limit or params.offset or params.seek_filter:
+            return None
+        # like FilterParser, a later AND filter on the same column and operator replaces the earlier one
+        and_filter = {(fil.model, fil.col, fil.op): fil for fil in params.and_filter}
+        mask = self.has_facility.copy()
+        # filters the bitmap index answers stay bitmaps until they are all combined
+        rows: List[Bitmap] = []
+        for fil in and_filter.values():
+            matched_rows = self._bitmap_rows(fil)
+            if matched_rows is not None:
+                rows.append(matched_rows)
+                continue
+            matched = self._filter_mask(fil)
+            if matched is None:
+                return None
+            mask &= matched
+        if params.or_filter:
+            any_rows = [self._bitmap_rows(fil) for fil in params.or_filter]
+            if all(matched_rows is not None for matched_rows in any_rows):
+                rows.append(Bitmap.union(any_rows))
+            else:
+                any_matched = np.zeros(self.size, dtype=bool)
+                for fil, matched_rows in zip(params.or_filter, any_rows):
+                    matched = matched_rows.mask(self.size) if matched_rows is not None else self._filter_mask(fil)
+                    if matched is None:
+                        return None
+                    any_matched |= matched
+                mask &= any_matched
+        if rows:
+            mask &= reduce(lambda left, right: left & right, rows).mask(self.size)
+        return mask
+
+    # per-row values of the joined lookups, computed once per snapshot
+    @cached_property
+    def row_lga(self) -> 'np.ndarray':
+        return self._lookup(self.facility_lga, self.facility_id)
+
+    @cached_property
+    def row_outcome_name(self) -> 'np.ndarray':
+        return self._lookup(self.outcome_name, self.outcome)
+
+    @cached_property
+    def row_outcome_type(self) -> 'np.ndarray':
+        return self._lookup(self.outcome_type, self.outcome)
+
+    @cached_property
+    def month(self) -> 'np.ndarray':
+        return self.date.astype('datetime64[D]').astype('datetime64[M]').astype(np.int32)
+
+    @cached_property
+    def has_facility(self) -> 'np.ndarray':
+        return self.row_lga >= 0
+
+    @cached_property
+    def has_outcome(self) -> 'np.ndarray':
+        return self.row_outcome_type >= 0
+
+    @cached_property
+    def has_scheme(self) -> 'np.ndarray':
+        known = np.fromiter(self.scheme_labels, dtype=np.int64, count=len(self.scheme_labels))
+        return np.isin(self.scheme, known)
+
+    def outcome_type_is(self, outcome_type: str) -> 'np.ndarray':
+        return self._filter_mask(Filter(TreatmentOutcome, 'type', '=', outcome_type))
+
+    def outcome_name_is(self, name: str) -> 'np.ndarray':
+        return self._filter_mask(Filter(TreatmentOutcome, 'name', '=', name))
+
+    def between(self, start_date: date, end_date: date) -> 'np.ndarray':
+        return (self.date >= _day(start_date)) & (self.date <= _day(end_date))
+
+    def count(self, mask: 'np.ndarray') -> int:
+        return int(np.count_nonzero(mask))
+
+    def total(self, mask: 'np.ndarray', column: str) -> int:
+        return int(getattr(self, column)[mask].sum())
+
+    def distinct_days(self, mask: 'np.ndarray') -> int:
+        return int(np.unique(self.date[mask]).size)
+
+    def _key_codes(self, key: str) -> Tuple['np.ndarray', Callable[['np.ndarray'], List]]:
+        if key in ('gender', 'age_group', 'enc_type'):
+            labels = self.codes[key].labels
+            return getattr(self, key), lambda codes: [labels[code] for code in codes.tolist()]
+        if key in ('facility_id', 'scheme', 'outcome'):
+            return getattr(self, key), lambda codes: codes.tolist()
+        if key == 'lga':
+            labels = self.codes['lga'].labels
+            return self.row_lga, lambda codes: [labels[code] for code in codes.tolist()]
+        if key == 'date':
+            return self.date, lambda days: _period_labels('week', days)
+        if key == 'week':
+            return self.date - (self.date + 3) % 7, lambda days: _period_labels('week', days)
+        if key in ('month', 'quarter', 'year'):
+            buckets = {'month': self.month, 'quarter': self.month // 3, 'year': self.month // 12}[key]
+            return buckets, lambda values: _period_labels(key, values)
+        raise KeyError(key)
+
+    def count_by(self, mask: 'np.ndarray', *keys: str) -> Dict[Any, int]:
+        '''
+        Matching rows per value of the keys (a text column, facility_id, scheme, outcome,
+        lga, date or a week/month/quarter/year bucket), in ascending code order.
+        Several keys give tuples.
+        '''
+        if len(keys) == 1 and self.bitmaps is not None and keys[0] in BitmapIndex.COLUMNS + ('lga',):
+            return self._bitmap_counts(mask, keys[0])
+        columns = [self._key_codes(key) for key in keys]
+        values = [codes[mask].astype(np.int64) for codes, _ in columns]
+        if len(keys) == 1:
+            low = int(values[0].min()) if values[0].size else 0
+            counts = np.bincount(values[0] - low)
+            present = np.flatnonzero(counts)
+            labels = columns[0][1](present + low)
+            return dict(zip(labels, counts[present].tolist()))
+
+        groups, counts = np.unique(np.stack(values), axis=1, return_counts=True)
+        labels = [decode(groups[i]) for i, (_, decode) in enumerate(columns)]
+        return dict(zip(zip(*labels), counts.tolist()))
+
+    def _bitmap_counts(self, mask: 'np.ndarray', key: str) -> Dict[Any, int]:
+        if key == 'lga':
+            # facilities partition the rows, so an LGA's count is the sum over its facilities
+            by_code: Dict[int, int] = {}
+            for facility_id, count in self.bitmaps.counts('facility_id', mask).items():
+                lga = int(self.facility_lga[facility_id]) if 0 <= facility_id < len(self.facility_lga) else -1
+                if lga >= 0:
+                    by_code[lga] = by_code.get(lga, 0) + count
+            labels = self.codes['lga'].labels
+            return {labels[code]: by_code[code] for code in sorted(by_code) if by_code[code]}
+
+        counts = self.bitmaps.counts(key, mask)
+        if key in BitmapIndex.INTEGER_COLUMNS:
+            return {value: counts[value] for value in sorted(counts) if counts[value]}
+        codes = self.codes[key]
+        by_code = sorted((codes.code(value), count) for value, count in counts.items() if count)
+        return {codes.labels[code]: count for code, count in by_code}
+
+
+def _load_lookups(db) -> Dict[str, Any]:
+    codes = {'lga': Codes(nocase=True), 'outcome_name': Codes(), 'outcome_type': Codes(nocase=True)}
+
+    def by_id(rows, codes_name):
+        size = max((row[0] for row in rows), default=-1) + 1
+        table = np.full(size, -1, dtype=np.int16)
+        if rows:
+            table[[row[0] for row in rows]] = codes[codes_name].encode([row[1] for row in rows])
+        return table
+
+    facilities = db.execute('SELECT id, local_government, name FROM facility').fetchall()
+    outcomes = db.execute('SELECT id, name, type FROM treatment_outcome').fetchall()
+    return {
+        'codes': codes,
+        'facility_lga': by_id([(row[0], row[1]) for row in facilities], 'lga'),
+        'facility_names': {row[0]: row[2] for row in facilities},
+        'scheme_labels': {row[0]: (row[1], row[2]) for row in
+                          db.execute('SELECT id, scheme_name, color_scheme FROM insurance_scheme')},
+        'outcome_names': {row[0]: row[1] for row in outcomes},
+        'outcome_types': {row[0]: row[2] for row in outcomes},
+        'outcome_name': by_id([(row[0], row[1]) for row in outcomes], 'outcome_name'),
+        'outcome_type': by_id([(row[0], row[2]) for row in outcomes], 'outcome_type'),
+    }
+
+
+def _load_rows(db, after_id: int, codes: Dict[str, Codes]) -> Dict[str, 'np.ndarray']:
+    # CAST keeps the date as text, which numpy parses far faster than the DATE converter
+    rows = db.execute('''
+    SELECT id, CAST(date AS TEXT), facility_id, scheme, outcome, age, gender, age_group, enc_type,
+           treatment_cost, medication_cost, investigation_cost
+    FROM encounters WHERE id > ? ORDER BY id
+    ''', (after_id,)).fetchall()
+    columns = list(zip(*rows)) if rows else [()] * 12
+    return {
+        'id': np.array(columns[0], dtype=np.int64),
+        'date': np.array(columns[1], dtype='datetime64[D]').astype(np.int32),
+        'facility_id': np.array(columns[2], dtype=np.int32),
+        'scheme': np.array(columns[3], dtype=np.int32),
+        'outcome': np.array(columns[4], dtype=np.int32),
+        'age': np.array(columns[5], dtype=np.int16),
+        'gender': codes['gender'].encode(columns[6]),
+        'age_group': codes['age_group'].encode(columns[7]),
+        'enc_type': codes['enc_type'].encode(columns[8]),
+        'treatment_cost': np.array(columns[9], dtype=np.int64),
+        'medication_cost': np.array(columns[10], dtype=np.int64),
+        'investigation_cost': np.array(columns[11], dtype=np.int64),
+    }
+
+
+_ROW_COLUMNS = ('date', 'facility_id', 'scheme', 'outcome', 'age', 'gender', 'age_group', 'enc_type',
+                'treatment_cost', 'medication_cost', 'investigation_cost')
+
+
+class ColumnStore:
+    '''
+    Current EncounterColumns of this process, used only by the numpy and compare dashboard
+    engines (DASHBOARD_ENGINE defaults to sql). Loaded on first use and brought up to date
+    by the first dashboard read that sees data_version move, not by the writes themselves:
+    rows inserted since are appended, and only an update or delete of a stored column (the
+    encounter_rewrites counter) reloads everything. The bitmap index follows the same rule
+    and is saved next to the database, so a new process only indexes the rows inserted
+    since the last save.
+    '''
+    # rows appended before the saved bitmap index is rewritten
+    SAVE_INDEX_EVERY = 1000
+
+    def __init__(self):
+        self._columns: Optional[EncounterColumns] = None
+        self._saved_size: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _rewrites(self, db) -> Optional[int]:
+        row = db.execute("SELECT version FROM data_version WHERE name = 'encounter_rewrites'").fetchone()
+        return row[0] if row else None
+
+    def _index_path(self, database: str) -> Optional[str]:
+        if _is_memory_database(database):
+            return None
+        return app.config.get('BITMAP_INDEX_FILE') or f'{database}.bitmaps.npz'
+
+    def _index(self, index: Optional[BitmapIndex], arrays: Dict[str, 'np.ndarray'],
+               codes: Dict[str, Codes], rewrites: Optional[int], max_id: int) -> BitmapIndex:
+        keys = {name: [codes[name]._key(label) for label in codes[name].labels]
+                for name in ('gender', 'age_group', 'enc_type')}
+        fresh = index is None
+        index = (index or BitmapIndex()).extended(
+            {column: arrays[column][(index.size if index else 0):] for column in BitmapIndex.COLUMNS}, keys)
+
+        path = self._index_path(app.config['DATABASE'])
+        if path and rewrites is not None and (fresh or self._saved_size is None
+                                              or index.size - self._saved_size >= self.SAVE_INDEX_EVERY):
+            try:
+                index.save(path, rewrites, max_id)
+                self._saved_size = index.size
+            except OSError as e:
+                app.logger.warning(f'Could not save the bitmap index to {path}: {e}')
+        return index
+
+    def _refresh(self, version: int) -> EncounterColumns:
+        db = get_read_db()
+        database = app.config['DATABASE']
+        rewrites = self._rewrites(db)
+        current = self._columns
+        lookups = _load_lookups(db)
+        use_index = app.config.get('DASHBOARD_BITMAP_INDEX')
+        if (current is None or current.database != database or rewrites is None
+                or current.rewrites != rewrites):
+            codes = {name: Codes(nocase=(name == 'enc_type')) for name in ('gender', 'age_group', 'enc_type')}
+            rows = _load_rows(db, 0, codes)
+            arrays = {name: rows[name] for name in _ROW_COLUMNS}
+            max_id = 0
+            path = self._index_path(database)
+            index = BitmapIndex.load(path, rewrites, rows['id']) if use_index and path and rewrites is not None else None
+            self._saved_size = index.size if index else None
+        else:
+            codes = {name: current.codes[name].copy() for name in ('gender', 'age_group', 'enc_type')}
+            rows = _load_rows(db, current.max_id, codes)
+            arrays = {name: np.concatenate([getattr(current, name), rows[name]]) for name in _ROW_COLUMNS}
+            max_id = current.max_id
+            index = current.bitmaps
+        if rows['id'].size:
+            max_id = int(rows['id'][-1])
+        if use_index:
+            index = self._index(index, arrays, codes, rewrites, max_id)
+        return EncounterColumns(database=database, version=version, rewrites=rewrites, max_id=max_id,
+                                **arrays, **{**lookups, 'codes': {**lookups['codes'], **codes}},
+                                bitmaps=index if use_index else None)
+
+    def answers(self, params: Params) -> bool:
+        '''Whether the configured engine is the column store and it can filter by params'''
+        if np is None or app.config.get('DASHBOARD_ENGINE', 'sql') not in ('numpy', 'compare'):
+            return False
+        columns = self.current()
+        return columns is not None and columns.mask(params) is not None
+
+    def current(self) -> Optional[EncounterColumns]:
+        '''Snapshot matching the data version, None when numpy or data_version is missing'''
+        if np is None:
+            return None
+        version = current_data_version()
+        if version is None:
+            return None
+        with self._lock:
+            columns = self._columns
+            if (columns is None or columns.version != version
+                    or columns.database != app.config['DATABASE']):
+                columns = self._columns = self._refresh(version)
+        return columns
+
+
+column_store = ColumnStore()
+
+
+def _same(left: Any, right: Any) -> bool:
+    if isinstance(left, float) or isinstance(right, float):
+        return isinstance(left, (int, float)) and isinstance(right, (int, float)) and math.isclose(left, right)
+    if isinstance(left, (list, tuple)) and isinstance(right, (list, tuple)):
+        return len(left) == len(right) and all(_same(a, b) for a, b in zip(left, right))
+    if isinstance(left, dict) and isinstance(right, dict):
+        return left.keys() == right.keys() and all(_same(left[key], right[key]) for key in left)
+    return left == right
+
+
+def columnar(method_name: str) -> Callable:
+    '''
+    Answer a DashboardServices classmethod taking params first from the column store with
+    cls.<method_name>(columns, params, *args) when DASHBOARD_ENGINE is 'numpy' and every filter
+    can be masked. With 'compare' both paths run, mismatches are logged and SQL is returned.
+    Apply under @cached_result.
+    '''
+    def decorate(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(cls, params: Params, *args, **kwargs):
+            engine = app.config.get('DASHBOARD_ENGINE', 'sql')
+            if engine not in ('numpy', 'compare') or not column_store.answers(params):
+                return func(cls, params, *args, **kwargs)
+
+            result = getattr(cls, method_name)(column_store.current(), params, *args, **kwargs)
+            if engine == 'compare':
+                expected = func(cls, params, *args, **kwargs)
+                if not _same(result, expected):
+                    app.logger.warning(f'Column engine differs from SQL in {func.__qualname__} '
+                                       f'for {params}: {result!r} != {expected!r}')
+                return expected
+            return result
+        wrapper.columnar_method = method_name
+        return wrapper
+    return decorate
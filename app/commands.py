@@ -1,6 +1,7 @@
 import click
 import unittest
 import sys
+import os
 from app import app
 @click.command('run-test')
 def run_test_command():
@@ -14,3 +15,216 @@ def run_test_command():
     if not result.wasSuccessful():
         sys.exit(1)
     click.echo('All tests passed!')
+
+@click.command('profile-queries')
+@click.option('--top', default=20, show_default=True, help='Number of query shapes to show')
+@click.option('--sort', 'sort_by', default='p95', show_default=True,
+              type=click.Choice(['p50', 'p95', 'max', 'total', 'count']))
+@click.option('--clear', is_flag=True, help='Delete the profile log after printing the summary')
+def profile_queries_command(top, sort_by, clear):
+    """
+    Summarizes the SQL profile log per query shape (p50/p95 in ms).
+    Enable collection with ODCHC_SQL_PROFILING=1.
+    """
+    from app.profiler import summarize_profile
+    path = app.config['QUERY_PROFILE_LOG']
+    if not os.path.exists(path):
+        click.echo(f'No query profile at {path}. Run the app with ODCHC_SQL_PROFILING=1 first.')
+        return
+
+    summary = sorted(summarize_profile(path), key=lambda row: row[sort_by], reverse=True)
+    click.echo(f"{'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'total ms':>10} {'rows':>8}  query")
+    for row in summary[:top]:
+        sql = row['sql'] if len(row['sql']) <= 120 else row['sql'][:117] + '...'
+        click.echo(f"{row['count']:>7} {row['p50']:>9.2f} {row['p95']:>9.2f} {row['max']:>9.2f} "
+                   f"{row['total']:>10.1f} {row['avg_rows']:>8.1f}  {sql}")
+    click.echo(f'Slow queries (>= {app.config["SLOW_QUERY_THRESHOLD_MS"]}ms) are logged to {app.config["SLOW_QUERY_LOG"]}')
+
+    if clear:
+        os.remove(path)
+        click.echo('Profile log cleared.')
+
+@click.command('dashboard-cache')
+@click.option('--clear', is_flag=True, help='Drop every cached result and reset the counters')
+def dashboard_cache_command(clear):
+    """
+    Shows dashboard cache hits and misses per widget.
+    Counters cover every worker only when ODCHC_DASHBOARD_CACHE_FILE is set.
+    """
+    from app.result_cache import result_cache
+    if clear:
+        result_cache.clear()
+        click.echo('Dashboard cache cleared.')
+        return
+
+    if not result_cache.path:
+        click.echo('The dashboard cache is in-process; set ODCHC_DASHBOARD_CACHE_FILE to share and inspect it.')
+        return
+    stats = sorted(result_cache.stats().items(), key=lambda item: item[1]['hits'] + item[1]['misses'], reverse=True)
+    click.echo(f"{'hits':>8} {'misses':>8} {'hit %':>6}  widget")
+    for name, counts in stats:
+        total = counts['hits'] + counts['misses']
+        click.echo(f"{counts['hits']:>8} {counts['misses']:>8} {100 * counts['hits'] / total:>6.1f}  {name}")
+
+@click.command('benchmark-reports')
+@click.option('--start', 'start_date', required=True, type=click.DateTime(['%Y-%m-%d']), help='First day, YYYY-MM-DD')
+@click.option('--end', 'end_date', required=True, type=click.DateTime(['%Y-%m-%d']), help='Last day, YYYY-MM-DD')
+@click.option('--facility', type=int, help='Facility of the utilization report. Defaults to the busiest one')
+@click.option('--repeat', default=5, show_default=True, help='Runs of each way; the fastest is shown')
+def benchmark_reports_command(start_date, end_date, facility, repeat):
+    """
+    Compares the pivot reports counted in SQLite with pivoting one row per item in pandas.
+    Shows the rows each way brings into Python and the fastest of its runs in ms, both
+    timing the query and the pivot only. Exits with an error when grouping does not bring
+    fewer rows than the items it counts.
+    """
+    import time
+    import pandas as pd
+    from app.db import get_read_db
+    from app.services import ReportServices
+
+    start_date, end_date = start_date.date(), end_date.date()
+    db = get_read_db()
+    if facility is None:
+        row = db.execute('''
+            SELECT facility_id FROM encounters WHERE date >= ? AND date <= ?
+            GROUP BY facility_id ORDER BY COUNT(*) DESC LIMIT 1
+        ''', (start_date, end_date)).fetchone()
+        if row is None:
+            click.echo('No encounters in this timeframe.')
+            return
+        facility = row[0]
+
+    def fastest(run):
+        times = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = run()
+            times.append((time.perf_counter() - started) * 1000)
+        return result, min(times)
+
+    def pivot(df, keys, values, aggfunc):
+        if not df.empty:
+            df.pivot_table(index=keys[0], values=values, columns=list(keys[1:]), aggfunc=aggfunc, fill_value=0)
+        return df
+
+    reports = [
+        ('utilization', ReportServices.SERVICE_UTILIZATION_ROWS.format(utilization=ReportServices._utilization_table()),
+         (start_date, end_date, facility), ('disease_name', 'age_group', 'gender')),
+        ('encounter', ReportServices.ENCOUNTER_ROWS, (start_date, end_date), ('facility_name', 'age_group', 'gender')),
+        ('categorization', ReportServices.CATEGORIZATION_ROWS, (start_date, end_date), ('facility_name', 'category_name')),
+    ]
+    not_reduced = []
+    click.echo(f"{'report':<15} {'item rows':>10} {'pandas ms':>10} {'grouped rows':>13} {'sql ms':>9} {'reduction':>10}")
+    for name, rows_query, args, keys in reports:
+        items, pandas_ms = fastest(lambda: pivot(pd.DataFrame([dict(row) for row in db.execute(rows_query, args)]),
+                                                 keys, 'policy_number', 'count'))
+        grouped, sql_ms = fastest(lambda: pivot(ReportServices._pivot_counts(rows_query, args, keys),
+                                                keys, 'count', 'sum'))
+        if len(items) > 1 and len(grouped) >= len(items):
+            not_reduced.append(name)
+        reduction = f'{len(items) / len(grouped):.1f}x' if len(grouped) else '-'
+        click.echo(f'{name:<15} {len(items):>10} {pandas_ms:>10.1f} {len(grouped):>13} {sql_ms:>9.1f} {reduction:>10}')
+    if not_reduced:
+        raise click.ClickException(f"Grouping brought no fewer rows than items for {', '.join(not_reduced)}; "
+                                   'it should group by the pivot dimensions only')
+
+def _utilization_workbook(facility_id, start_date, end_date):
+    '''
+    Utilization workbook of one facility, run in a generate-reports worker process with its
+    own read-only connection. Returns (facility_id, xlsx bytes or None, error, seconds).
+    '''
+    import time
+    from app.exceptions import MissingError
+    from app.routes import append_utilization_header
+    from app.services import ReportServices
+
+    started = time.perf_counter()
+    with app.app_context():
+        try:
+            facility, start_date, report_data = ReportServices.generate_service_utilization_report(
+                facility_id, start_date, end_date)
+            output = append_utilization_header(report_data, start_date, facility)
+        except MissingError as e:
+            return facility_id, None, str(e), time.perf_counter() - started
+    return facility_id, output.getvalue(), None, time.perf_counter() - started
+
+@click.command('generate-reports')
+@click.option('--month', type=click.IntRange(1, 12), help='Month of the reports. Defaults to the previous month')
+@click.option('--year', type=int, help='Year of the reports. Defaults to the year of that month')
+@click.option('--type', 'report_type', default='utilization', show_default=True, type=click.Choice(['utilization']))
+@click.option('--all-facilities', is_flag=True, help='Generate the report of every facility')
+@click.option('--facility', 'facility_ids', multiple=True, type=int, help='Facility id; can be given more than once')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True, type=click.IntRange(1))
+@click.option('--output', type=click.Path(dir_okay=False), help='Zip file to write. Defaults to <type>_reports_<YYYY>_<MM>.zip')
+def generate_reports_command(month, year, report_type, all_facilities, facility_ids, workers, output):
+    """
+    Generates a month's per-facility reports across a process pool and bundles them into one zip.
+    Facilities without encounters that month are skipped.
+    """
+    import time
+    import zipfile
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from datetime import date, timedelta
+    from werkzeug.utils import secure_filename
+    from app.db import get_read_db
+
+    if not all_facilities and not facility_ids:
+        raise click.UsageError('Give --all-facilities or at least one --facility.')
+    last_month = date.today().replace(day=1) - timedelta(days=1)
+    month = month or last_month.month
+    year = year or (last_month.year if month == last_month.month else date.today().year)
+    start_date = date(year, month, 1)
+    end_date = (start_date + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+
+    query = 'SELECT id, name FROM facility'
+    args = ()
+    if not all_facilities:
+        query += f" WHERE id IN ({', '.join('?' for _ in facility_ids)})"
+        args = facility_ids
+    facilities = {row['id']: row['name'] for row in get_read_db().execute(query + ' ORDER BY name', args)}
+    missing = set(facility_ids) - set(facilities)
+    if missing:
+        raise click.BadParameter(f"No facility with id {', '.join(map(str, sorted(missing)))}", param_hint='--facility')
+
+    output = output or f"{report_type}_reports_{start_date.strftime('%Y_%m')}.zip"
+    click.echo(f"Generating {len(facilities)} {report_type} reports for {start_date.strftime('%B %Y')} "
+               f"on {workers} workers into {output}")
+
+    started = time.perf_counter()
+    timings, skipped, failed, names = [], [], [], set()
+    with ProcessPoolExecutor(max_workers=workers) as executor, \
+            zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED) as bundle:
+        futures = {executor.submit(_utilization_workbook, facility_id, start_date, end_date): facility_id
+                   for facility_id in facilities}
+        for done, future in enumerate(as_completed(futures), 1):
+            facility_id = futures[future]
+            name = facilities[facility_id]
+            try:
+                facility_id, workbook, error, seconds = future.result()
+            except Exception as e:
+                failed.append(name)
+                click.echo(f'[{done}/{len(futures)}] {name}: failed ({e})', err=True)
+                continue
+            timings.append((seconds, name))
+            if workbook is None:
+                skipped.append(name)
+                click.echo(f'[{done}/{len(futures)}] {name}: skipped, {error} ({seconds * 1000:.0f}ms)')
+                continue
+            file_name = secure_filename(f"Service_Utilization_Report_for_{name}_{start_date.strftime('%B')}.xlsx")
+            if file_name in names:
+                file_name = f'{facility_id}_{file_name}'
+            names.add(file_name)
+            bundle.writestr(file_name, workbook)
+            click.echo(f'[{done}/{len(futures)}] {name} ({seconds * 1000:.0f}ms)')
+
+    elapsed = time.perf_counter() - started
+    click.echo(f'Wrote {len(names)} reports to {output} in {elapsed:.1f}s '
+               f'({len(skipped)} without encounters, {len(failed)} failed).')
+    if timings:
+        total = sum(seconds for seconds, _ in timings)
+        click.echo(f'Per facility: {total / len(timings) * 1000:.0f}ms on average, slowest:')
+        for seconds, name in sorted(timings, reverse=True)[:5]:
+            click.echo(f'  {seconds * 1000:>8.0f}ms  {name}')
+    if failed:
+        sys.exit(1)
@@ -4,6 +4,7 @@ import secrets
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 DBNAME = 'odchc_encounter.db'
 DBPATH = os.path.join(os.path.dirname(BASE_DIR), DBNAME)
+LOG_DIR = os.getenv('ODCHC_LOG_DIR') or os.path.dirname(BASE_DIR)
 # print(DBPATH)
 
 
@@ -12,6 +13,46 @@ class Config:
         'SECRET_KEY') or "This is supposed to be a secret key"
     ADMIN_PAGE_PAGINATION = 15
     DATABASE = os.getenv('ODCHC_DATABASE') or DBPATH
+    DB_POOL_ENABLED = os.getenv('ODCHC_DB_POOL', '1') != '0'
+    DB_POOL_SIZE = int(os.getenv('ODCHC_DB_POOL_SIZE') or 8)
+    DB_POOL_TIMEOUT = 10
+    # negative cache_size is in KiB: 64MB page cache and 256MB mmap for analytic reads
+    READ_DB_CACHE_SIZE = int(os.getenv('ODCHC_READ_DB_CACHE_SIZE') or -65536)
+    READ_DB_MMAP_SIZE = int(os.getenv('ODCHC_READ_DB_MMAP_SIZE') or 268435456)
+    QUERY_SHAPE_CACHE_SIZE = 512
+    ENCOUNTER_CHUNK_SIZE = 1000
+    ENCOUNTER_BATCH_MAX_ITEMS = 1000
+    ENCOUNTER_BATCH_MAX_BYTES = 16 * 1024 * 1024
+    DASHBOARD_USE_ROLLUP = os.getenv('ODCHC_DASHBOARD_ROLLUP', '1') != '0'
+    # monthly and coarser trends read the frozen totals of months closed by `flask close-months`
+    DASHBOARD_FROZEN_MONTHS = os.getenv('ODCHC_FROZEN_MONTHS', '1') != '0'
+    USE_UTILIZATION_ITEMS = os.getenv('ODCHC_UTILIZATION_ITEMS', '1') != '0'
+    # threads running independent dashboard widgets at once; 1 runs them in sequence
+    DASHBOARD_WORKERS = int(os.getenv('ODCHC_DASHBOARD_WORKERS') or min(4, os.cpu_count() or 1))
+    # 'numpy' answers the common dashboard counts from an in-process column store,
+    # 'compare' also runs the SQL and logs any difference
+    DASHBOARD_ENGINE = os.getenv('ODCHC_DASHBOARD_ENGINE', 'sql')
+    # bitmaps per scheme, outcome, facility, gender, age group and encounter type behind the
+    # numpy engine's filters, saved to <database>.bitmaps.npz unless a file is given
+    DASHBOARD_BITMAP_INDEX = os.getenv('ODCHC_BITMAP_INDEX', '1') != '0'
+    BITMAP_INDEX_FILE = os.getenv('ODCHC_BITMAP_INDEX_FILE')
+    DASHBOARD_CACHE_ENABLED = os.getenv('ODCHC_DASHBOARD_CACHE', '1') != '0'
+    DASHBOARD_CACHE_SIZE = 512
+    DASHBOARD_CACHE_MAX_BYTES = 64 * 1024 * 1024
+    DASHBOARD_CACHE_TTL = 600
+    # set to a file path to share cached dashboard results between worker processes
+    DASHBOARD_CACHE_FILE = os.getenv('ODCHC_DASHBOARD_CACHE_FILE')
+    # report downloads are generated on REPORT_WORKERS background threads and the XLSX kept
+    # in REPORT_DIR (default <database>.reports) until the data changes
+    REPORT_JOBS_ENABLED = os.getenv('ODCHC_REPORT_JOBS', '1') != '0'
+    REPORT_WORKERS = int(os.getenv('ODCHC_REPORT_WORKERS') or 2)
+    REPORT_DIR = os.getenv('ODCHC_REPORT_DIR')
+    # seconds before a queued or running job is taken to be lost and is run again
+    REPORT_JOB_TIMEOUT = 3600
+    SQL_PROFILING = os.getenv('ODCHC_SQL_PROFILING') == '1'
+    SLOW_QUERY_THRESHOLD_MS = float(os.getenv('ODCHC_SLOW_QUERY_MS') or 250)
+    SLOW_QUERY_LOG = os.path.join(LOG_DIR, 'slow_queries.log')
+    QUERY_PROFILE_LOG = os.path.join(LOG_DIR, 'query_profile.jsonl')
     LLM_SCHEMA_PATH = os.path.join(BASE_DIR, 'llm_minimal_schema.txt')
     GOOGLE_GENAI_API_KEY = os.getenv('GOOGLE_GENAI_API_KEY')
     GOOGLE_GENAI_MODEL = 'gemini-2.5-flash-lite'
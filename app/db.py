@@ -1,33 +1,358 @@
+import os
 import sqlite3
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Tuple
 from app.models import Role
+from app.exceptions import PoolTimeoutError
+from app.profiler import connection_factory, flush_query_profile
 from app import app
 from flask import g
 import click
+from urllib.parse import quote
+
+
+def _configure_connection(conn: sqlite3.Connection) -> sqlite3.Connection:
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute('PRAGMA foreign_keys = ON')
+    return conn
+
+
+def _connect(database: str, check_same_thread: bool = True) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        database,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        check_same_thread=check_same_thread,
+        factory=connection_factory()
+    )
+    return _configure_connection(conn)
+
+
+def _connect_read_only(database: str,
+                       cache_size: int,
+                       mmap_size: int,
+                       check_same_thread: bool = True) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        f"file:{quote(os.path.abspath(database))}?mode=ro",
+        uri=True,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        check_same_thread=check_same_thread,
+        factory=connection_factory()
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA query_only = ON')
+    conn.execute(f'PRAGMA cache_size = {int(cache_size)}')
+    conn.execute(f'PRAGMA mmap_size = {int(mmap_size)}')
+    return conn
+
+
+def _read_only_connector(database: str, check_same_thread: bool = True) -> sqlite3.Connection:
+    return _connect_read_only(database,
+                              cache_size=app.config.get('READ_DB_CACHE_SIZE', -2000),
+                              mmap_size=app.config.get('READ_DB_MMAP_SIZE', 0),
+                              check_same_thread=check_same_thread)
+
+
+def _is_memory_database(database: str) -> bool:
+    return database == ':memory:' or 'mode=memory' in database
+
+
+class ConnectionPool:
+    '''
+    Thread-safe pool of pre-configured sqlite connections for a single database.
+    Connections are health checked when handed out and rolled back when returned.
+    The pool is per process: after a fork the inherited idle connections are dropped.
+    '''
+
+    def __init__(self, database: str,
+                 connect: Callable[[str], sqlite3.Connection],
+                 max_size: int = 8,
+                 timeout: float = 10.0,
+                 read_only: bool = False):
+        self.database = database
+        self.read_only = read_only
+        self.max_size = max_size
+        self.timeout = timeout
+        self._connect = connect
+        self._idle: List[sqlite3.Connection] = []
+        self._checked_out = 0
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.discarded = 0
+
+    def _reset_after_fork(self):
+        # connections opened by the parent process must not be shared with the child
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = []
+            self._checked_out = 0
+
+    @staticmethod
+    def _is_healthy(conn: sqlite3.Connection) -> bool:
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    @staticmethod
+    def _close_quietly(conn: sqlite3.Connection):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def acquire(self) -> sqlite3.Connection:
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        with self._cond:
+            self._reset_after_fork()
+            while True:
+                while self._idle:
+                    conn = self._idle.pop()
+                    if self._is_healthy(conn):
+                        self._checked_out += 1
+                        self.hits += 1
+                        return conn
+                    self.discarded += 1
+                    self._close_quietly(conn)
+
+                if self._checked_out < self.max_size:
+                    self._checked_out += 1
+                    self.misses += 1
+                    break
+
+                if not waited:
+                    self.waits += 1
+                    waited = True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    if not self._idle and self._checked_out >= self.max_size:
+                        self.timeouts += 1
+                        raise PoolTimeoutError(
+                            f"No database connection available after {self.timeout}s")
+        try:
+            return self._connect(self.database)
+        except Exception:
+            with self._cond:
+                self._checked_out -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn: sqlite3.Connection):
+        healthy = True
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            healthy = False
+
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._checked_out = max(self._checked_out - 1, 0)
+            if healthy and len(self._idle) < self.max_size:
+                self._idle.append(conn)
+            else:
+                self.discarded += 1
+                self._close_quietly(conn)
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            for conn in self._idle:
+                self._close_quietly(conn)
+            self._idle = []
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                'database': self.database,
+                'read_only': self.read_only,
+                'max_size': self.max_size,
+                'idle': len(self._idle),
+                'checked_out': self._checked_out,
+                'hits': self.hits,
+                'misses': self.misses,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'discarded': self.discarded,
+            }
+
+
+_pools: Dict[Tuple[str, bool], ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(database: str, read_only: bool = False) -> ConnectionPool:
+    key = (database, read_only)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                connector = _read_only_connector if read_only else _connect
+                pool = ConnectionPool(
+                    database,
+                    connect=lambda path: connector(path, check_same_thread=False),
+                    max_size=app.config.get('DB_POOL_SIZE', 8),
+                    timeout=app.config.get('DB_POOL_TIMEOUT', 10),
+                    read_only=read_only
+                )
+                _pools[key] = pool
+    return pool
+
+
+def get_pool_stats() -> List[Dict]:
+    '''Hit/miss/wait counters of every connection pool in this worker process'''
+    return [pool.stats() for pool in list(_pools.values())]
+
 
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
-        g.db.execute("PRAGMA journal_mode=WAL;")
-        g.db.execute("PRAGMA synchronous=NORMAL;")
-        g.db.execute('PRAGMA foreign_keys = ON')
+        database = app.config['DATABASE']
+        if app.config.get('DB_POOL_ENABLED') and not _is_memory_database(database):
+            pool = _get_pool(database)
+            g.db = pool.acquire()
+            g.db_pool = pool
+        else:
+            g.db = _connect(database)
     return g.db
 
+def get_read_db():
+    '''
+    Read-only connection for analytic queries (dashboard, reports, downloads).
+    It is opened with mode=ro and query_only, and tuned with its own cache_size and
+    mmap_size, so long scans never hold a write-capable connection.
+    '''
+    if 'read_db' not in g:
+        database = app.config['DATABASE']
+        if _is_memory_database(database):
+            # an in-memory database only exists on the connection that created it
+            return get_db()
+        if app.config.get('DB_POOL_ENABLED'):
+            pool = _get_pool(database, read_only=True)
+            g.read_db = pool.acquire()
+            g.read_db_pool = pool
+        else:
+            g.read_db = _read_only_connector(database)
+    return g.read_db
+
+def _close_connection(conn_key: str, pool_key: str):
+    db = g.pop(conn_key, None)
+    pool = g.pop(pool_key, None)
+    if db is not None:
+        if pool is not None:
+            pool.release(db)
+        else:
+            db.close()
+
 @app.teardown_appcontext
 def close_db(exception=None):
-    db = g.pop('db', None)
-    if db is not None:
-        db.close()
+    if app.config.get('SQL_PROFILING'):
+        flush_query_profile()
+    _close_connection('db', 'db_pool')
+    _close_connection('read_db', 'read_db_pool')
+
+def rebuild_fts(db: sqlite3.Connection):
+    db.execute("INSERT INTO encounters_fts(encounters_fts) VALUES ('rebuild')")
+    db.execute("INSERT INTO encounters_fts(encounters_fts) VALUES ('optimize')")
+
+def rebuild_daily_rollup(db: sqlite3.Connection):
+    db.execute('DELETE FROM daily_encounter_rollup')
+    db.execute('''
+    INSERT INTO daily_encounter_rollup(date, facility_id, scheme, gender, age_group, outcome,
+        encounter_count, treatment_cost, medication_cost, investigation_cost)
+    SELECT date, facility_id, scheme, gender, age_group, outcome,
+        COUNT(*), SUM(treatment_cost), SUM(medication_cost), SUM(investigation_cost)
+    FROM encounters
+    GROUP BY date, facility_id, scheme, gender, age_group, outcome
+    ''')
+
+def rebuild_utilization_items(db: sqlite3.Connection):
+    db.execute('DELETE FROM utilization_items')
+    db.execute('''
+    INSERT INTO utilization_items(encounter_id, item_type, item_id, item_name, date, facility_id, scheme)
+    SELECT ecd.encounter_id, 'Disease', ecd.disease_id, dis.name, ec.date, ec.facility_id, ec.scheme
+    FROM encounters_diseases AS ecd
+    JOIN diseases AS dis ON dis.id = ecd.disease_id
+    JOIN encounters AS ec ON ec.id = ecd.encounter_id
+    UNION ALL
+    SELECT ecs.encounter_id, 'Service', ecs.service_id, srv.name, ec.date, ec.facility_id, ec.scheme
+    FROM encounters_services AS ecs
+    JOIN services AS srv ON srv.id = ecs.service_id
+    JOIN encounters AS ec ON ec.id = ecs.encounter_id
+    ''')
+
+def rebuild_facility_last_submission(db: sqlite3.Connection):
+    db.execute('DELETE FROM facility_last_submission')
+    db.execute('''
+    INSERT INTO facility_last_submission(facility_id, last_submission)
+    SELECT facility_id, MAX(created_at) FROM encounters GROUP BY facility_id
+    ''')
+
+def _next_month(month: str) -> str:
+    year, number = int(month[:4]), int(month[5:7])
+    return f'{year + number // 12}-{number % 12 + 1:02d}'
+
+def close_months(db: sqlite3.Connection, through: str) -> List[str]:
+    '''
+    Close every month from the first encounter through `through` (YYYY-MM) that is still
+    open, at the current encounters data version. Returns the months closed; the caller commits.
+    '''
+    first = db.execute('SELECT substr(MIN(date), 1, 7) FROM encounters').fetchone()[0]
+    if first is None:
+        return []
+    closed = {row[0] for row in db.execute('SELECT month FROM closed_months')}
+    months, month = [], first
+    while month <= through:
+        if month not in closed:
+            months.append(month)
+        month = _next_month(month)
+    db.executemany('''
+    INSERT INTO closed_months(month, generation)
+    SELECT ?, COALESCE((SELECT version FROM data_version WHERE name = 'encounters'), 0)
+    ''', [(month,) for month in months])
+    return months
+
+def reopen_months(db: sqlite3.Connection, months: List[str]) -> int:
+    '''Re-open months, dropping their frozen counts so they are counted live; the caller commits'''
+    return db.executemany('DELETE FROM closed_months WHERE month = ?', [(month,) for month in months]).rowcount
+
+# trigger that keeps a derived structure in sync -> how to rebuild it from encounters
+_DERIVED_REBUILDS = {
+    'encounters_fts_insert': rebuild_fts,
+    'daily_rollup_insert': rebuild_daily_rollup,
+    'utilization_disease_insert': rebuild_utilization_items,
+    'facility_last_submission_insert': rebuild_facility_last_submission,
+}
+
+def apply_derived_schema(db: sqlite3.Connection):
+    '''
+    Create the derived tables and triggers (FTS index, daily rollup, ...) that are missing.
+    Anything that was not maintained by its trigger until now is rebuilt from encounters.
+    '''
+    triggers = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    with app.open_resource('derived_schema.sql') as f:
+        db.executescript(f.read().decode('utf8'))
+    for trigger, rebuild in _DERIVED_REBUILDS.items():
+        if trigger not in triggers:
+            rebuild(db)
+    db.commit()
 
 def init_db():
     db = get_db()
 
     with app.open_resource('schema.sql') as f:
         db.executescript(f.read().decode('utf8'))
+    apply_derived_schema(db)
 
 @click.command('seed-db')
 def seed_db():
@@ -61,6 +386,73 @@ def seed_db():
     db.commit()
     print(" Database populated successfully.")
 
+@click.command('rebuild-fts')
+def rebuild_fts_command():
+    """Create the encounters_fts triggers if missing and rebuild the index from encounters."""
+    db = get_db()
+    apply_derived_schema(db)
+    rebuild_fts(db)
+    db.commit()
+    total = db.execute('SELECT COUNT(*) FROM encounters').fetchone()[0]
+    click.echo(f'Rebuilt the search index for {total} encounters.')
+
+@click.command('rebuild-rollup')
+def rebuild_rollup_command():
+    """Create the daily_encounter_rollup triggers if missing and recompute the rollup."""
+    db = get_db()
+    apply_derived_schema(db)
+    rebuild_daily_rollup(db)
+    db.commit()
+    rows = db.execute('SELECT COUNT(*), COALESCE(SUM(encounter_count), 0) FROM daily_encounter_rollup').fetchone()
+    click.echo(f'Rebuilt daily_encounter_rollup: {rows[0]} rows covering {rows[1]} encounters.')
+
+@click.command('rebuild-utilization-items')
+def rebuild_utilization_items_command():
+    """Create the utilization_items triggers if missing and backfill the table from encounters."""
+    db = get_db()
+    apply_derived_schema(db)
+    rebuild_utilization_items(db)
+    db.commit()
+    total = db.execute('SELECT COUNT(*) FROM utilization_items').fetchone()[0]
+    click.echo(f'Rebuilt utilization_items with {total} items.')
+
+def _month_option(ctx, param, value):
+    months = value if isinstance(value, tuple) else (value,)
+    for month in months:
+        if month is not None:
+            try:
+                datetime.strptime(month, '%Y-%m')
+            except ValueError:
+                raise click.BadParameter(f'{month} is not a YYYY-MM month')
+    return value
+
+@click.command('close-months')
+@click.option('--through', callback=_month_option,
+              help='Last month to close as YYYY-MM. Defaults to the month before the current one.')
+@click.option('--reopen', multiple=True, callback=_month_option,
+              help='Re-open a closed month (YYYY-MM) instead; can be given more than once.')
+def close_months_command(through, reopen):
+    """Close past months so dashboard trends keep their counts and only count open months live."""
+    db = get_db()
+    apply_derived_schema(db)
+    if reopen:
+        count = reopen_months(db, list(reopen))
+        db.commit()
+        click.echo(f'Re-opened {count} of {len(reopen)} months.')
+        return
+    if through is None:
+        through = (datetime.now().replace(day=1) - timedelta(days=1)).strftime('%Y-%m')
+    months = close_months(db, through)
+    db.commit()
+    if months:
+        click.echo(f'Closed {len(months)} months, {months[0]} to {months[-1]}.')
+    else:
+        click.echo(f'Every month through {through} is already closed.')
+    # the dashboard only reads frozen counts; months closed earlier and not frozen yet are counted too
+    from app.services.dashboard import DashboardServices
+    frozen = DashboardServices.freeze_closed_months(db)
+    click.echo(f'{frozen} monthly trend counts are frozen.')
+
 @click.command('init-db')
 def init_db_command():
     """Clear the existing data and create new tables."""
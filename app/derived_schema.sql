@@ -0,0 +1,401 @@
+-- Structures derived from the base tables. Every statement is idempotent so this
+-- file can be applied to an existing database as well as by init-db.
+
+-- Keys of the batch API submissions already stored, so a retried batch does not insert
+-- its encounters twice. Here rather than in schema.sql so existing databases get it too.
+CREATE TABLE IF NOT EXISTS encounter_idempotency_keys(
+    created_by INTEGER NOT NULL,
+    idempotency_key VARCHAR(255) NOT NULL,
+    encounter_id INTEGER NOT NULL,
+    created_at DATE NOT NULL,
+    PRIMARY KEY (created_by, idempotency_key),
+    FOREIGN KEY (encounter_id) REFERENCES encounters(id) ON DELETE CASCADE
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS encounters_fts USING fts5(
+    policy_number,
+    client_name,
+    nin,
+    phone_number,
+    address,
+    treatment,
+    medication,
+    investigation,
+    doctor_name,
+    mode_of_entry,
+    content='encounters',
+    content_rowid='id'
+);
+
+CREATE TRIGGER IF NOT EXISTS encounters_fts_insert AFTER INSERT ON encounters BEGIN
+    INSERT INTO encounters_fts(rowid, policy_number, client_name, nin, phone_number, address,
+        treatment, medication, investigation, doctor_name, mode_of_entry)
+    VALUES (new.id, new.policy_number, new.client_name, new.nin, new.phone_number, new.address,
+        new.treatment, new.medication, new.investigation, new.doctor_name, new.mode_of_entry);
+END;
+
+CREATE TRIGGER IF NOT EXISTS encounters_fts_delete AFTER DELETE ON encounters BEGIN
+    INSERT INTO encounters_fts(encounters_fts, rowid, policy_number, client_name, nin, phone_number,
+        address, treatment, medication, investigation, doctor_name, mode_of_entry)
+    VALUES ('delete', old.id, old.policy_number, old.client_name, old.nin, old.phone_number,
+        old.address, old.treatment, old.medication, old.investigation, old.doctor_name, old.mode_of_entry);
+END;
+
+CREATE TRIGGER IF NOT EXISTS encounters_fts_update AFTER UPDATE OF policy_number, client_name, nin,
+    phone_number, address, treatment, medication, investigation, doctor_name, mode_of_entry
+ON encounters BEGIN
+    INSERT INTO encounters_fts(encounters_fts, rowid, policy_number, client_name, nin, phone_number,
+        address, treatment, medication, investigation, doctor_name, mode_of_entry)
+    VALUES ('delete', old.id, old.policy_number, old.client_name, old.nin, old.phone_number,
+        old.address, old.treatment, old.medication, old.investigation, old.doctor_name, old.mode_of_entry);
+    INSERT INTO encounters_fts(rowid, policy_number, client_name, nin, phone_number, address,
+        treatment, medication, investigation, doctor_name, mode_of_entry)
+    VALUES (new.id, new.policy_number, new.client_name, new.nin, new.phone_number, new.address,
+        new.treatment, new.medication, new.investigation, new.doctor_name, new.mode_of_entry);
+END;
+
+-- Encounter counts and cost sums per day and dimension, read by the dashboard
+-- instead of scanning encounters. Kept current by the triggers below.
+CREATE TABLE IF NOT EXISTS daily_encounter_rollup(
+    date DATE NOT NULL,
+    facility_id INTEGER NOT NULL,
+    scheme INTEGER NOT NULL,
+    gender CHAR(1) NOT NULL,
+    age_group VARCHAR(20) NOT NULL,
+    outcome INTEGER NOT NULL,
+    encounter_count INTEGER NOT NULL DEFAULT 0,
+    treatment_cost INTEGER NOT NULL DEFAULT 0,
+    medication_cost INTEGER NOT NULL DEFAULT 0,
+    investigation_cost INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (date, facility_id, scheme, gender, age_group, outcome)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_daily_rollup_facility_date ON daily_encounter_rollup (facility_id, date);
+CREATE INDEX IF NOT EXISTS idx_daily_rollup_outcome_date ON daily_encounter_rollup (outcome, date);
+
+CREATE TRIGGER IF NOT EXISTS daily_rollup_insert AFTER INSERT ON encounters BEGIN
+    INSERT INTO daily_encounter_rollup(date, facility_id, scheme, gender, age_group, outcome,
+        encounter_count, treatment_cost, medication_cost, investigation_cost)
+    VALUES (new.date, new.facility_id, new.scheme, new.gender, new.age_group, new.outcome,
+        1, new.treatment_cost, new.medication_cost, new.investigation_cost)
+    ON CONFLICT(date, facility_id, scheme, gender, age_group, outcome) DO UPDATE SET
+        encounter_count = encounter_count + 1,
+        treatment_cost = treatment_cost + excluded.treatment_cost,
+        medication_cost = medication_cost + excluded.medication_cost,
+        investigation_cost = investigation_cost + excluded.investigation_cost;
+END;
+
+CREATE TRIGGER IF NOT EXISTS daily_rollup_delete AFTER DELETE ON encounters BEGIN
+    UPDATE daily_encounter_rollup SET
+        encounter_count = encounter_count - 1,
+        treatment_cost = treatment_cost - old.treatment_cost,
+        medication_cost = medication_cost - old.medication_cost,
+        investigation_cost = investigation_cost - old.investigation_cost
+    WHERE date = old.date AND facility_id = old.facility_id AND scheme = old.scheme
+        AND gender = old.gender AND age_group = old.age_group AND outcome = old.outcome;
+    DELETE FROM daily_encounter_rollup
+    WHERE date = old.date AND facility_id = old.facility_id AND scheme = old.scheme
+        AND gender = old.gender AND age_group = old.age_group AND outcome = old.outcome
+        AND encounter_count <= 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS daily_rollup_update AFTER UPDATE OF date, facility_id, scheme, gender,
+    age_group, outcome, treatment_cost, medication_cost, investigation_cost
+ON encounters BEGIN
+    UPDATE daily_encounter_rollup SET
+        encounter_count = encounter_count - 1,
+        treatment_cost = treatment_cost - old.treatment_cost,
+        medication_cost = medication_cost - old.medication_cost,
+        investigation_cost = investigation_cost - old.investigation_cost
+    WHERE date = old.date AND facility_id = old.facility_id AND scheme = old.scheme
+        AND gender = old.gender AND age_group = old.age_group AND outcome = old.outcome;
+    DELETE FROM daily_encounter_rollup
+    WHERE date = old.date AND facility_id = old.facility_id AND scheme = old.scheme
+        AND gender = old.gender AND age_group = old.age_group AND outcome = old.outcome
+        AND encounter_count <= 0;
+    INSERT INTO daily_encounter_rollup(date, facility_id, scheme, gender, age_group, outcome,
+        encounter_count, treatment_cost, medication_cost, investigation_cost)
+    VALUES (new.date, new.facility_id, new.scheme, new.gender, new.age_group, new.outcome,
+        1, new.treatment_cost, new.medication_cost, new.investigation_cost)
+    ON CONFLICT(date, facility_id, scheme, gender, age_group, outcome) DO UPDATE SET
+        encounter_count = encounter_count + 1,
+        treatment_cost = treatment_cost + excluded.treatment_cost,
+        medication_cost = medication_cost + excluded.medication_cost,
+        investigation_cost = investigation_cost + excluded.investigation_cost;
+END;
+
+-- view_utilization_items as a table: one row per disease or service recorded on an
+-- encounter, with the encounter's date, facility and scheme copied in for filtering.
+CREATE TABLE IF NOT EXISTS utilization_items(
+    encounter_id INTEGER NOT NULL,
+    item_type VARCHAR(10) NOT NULL,
+    item_id INTEGER NOT NULL,
+    item_name VARCHAR(255) NOT NULL,
+    date DATE NOT NULL,
+    facility_id INTEGER NOT NULL,
+    scheme INTEGER NOT NULL,
+    PRIMARY KEY (encounter_id, item_type, item_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_utilization_items_date ON utilization_items (date, facility_id);
+CREATE INDEX IF NOT EXISTS idx_utilization_items_item ON utilization_items (item_type, item_id, date);
+
+CREATE TRIGGER IF NOT EXISTS utilization_disease_insert AFTER INSERT ON encounters_diseases BEGIN
+    INSERT OR REPLACE INTO utilization_items(encounter_id, item_type, item_id, item_name, date, facility_id, scheme)
+    SELECT new.encounter_id, 'Disease', new.disease_id, dis.name, ec.date, ec.facility_id, ec.scheme
+    FROM encounters AS ec JOIN diseases AS dis ON dis.id = new.disease_id
+    WHERE ec.id = new.encounter_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS utilization_disease_delete AFTER DELETE ON encounters_diseases BEGIN
+    DELETE FROM utilization_items
+    WHERE encounter_id = old.encounter_id AND item_type = 'Disease' AND item_id = old.disease_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS utilization_disease_update AFTER UPDATE ON encounters_diseases BEGIN
+    DELETE FROM utilization_items
+    WHERE encounter_id = old.encounter_id AND item_type = 'Disease' AND item_id = old.disease_id;
+    INSERT OR REPLACE INTO utilization_items(encounter_id, item_type, item_id, item_name, date, facility_id, scheme)
+    SELECT new.encounter_id, 'Disease', new.disease_id, dis.name, ec.date, ec.facility_id, ec.scheme
+    FROM encounters AS ec JOIN diseases AS dis ON dis.id = new.disease_id
+    WHERE ec.id = new.encounter_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS utilization_service_insert AFTER INSERT ON encounters_services BEGIN
+    INSERT OR REPLACE INTO utilization_items(encounter_id, item_type, item_id, item_name, date, facility_id, scheme)
+    SELECT new.encounter_id, 'Service', new.service_id, srv.name, ec.date, ec.facility_id, ec.scheme
+    FROM encounters AS ec JOIN services AS srv ON srv.id = new.service_id
+    WHERE ec.id = new.encounter_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS utilization_service_delete AFTER DELETE ON encounters_services BEGIN
+    DELETE FROM utilization_items
+    WHERE encounter_id = old.encounter_id AND item_type = 'Service' AND item_id = old.service_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS utilization_service_update AFTER UPDATE ON encounters_services BEGIN
+    DELETE FROM utilization_items
+    WHERE encounter_id = old.encounter_id AND item_type = 'Service' AND item_id = old.service_id;
+    INSERT OR REPLACE INTO utilization_items(encounter_id, item_type, item_id, item_name, date, facility_id, scheme)
+    SELECT new.encounter_id, 'Service', new.service_id, srv.name, ec.date, ec.facility_id, ec.scheme
+    FROM encounters AS ec JOIN services AS srv ON srv.id = new.service_id
+    WHERE ec.id = new.encounter_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS utilization_encounter_update AFTER UPDATE OF date, facility_id, scheme
+ON encounters BEGIN
+    UPDATE utilization_items SET date = new.date, facility_id = new.facility_id, scheme = new.scheme
+    WHERE encounter_id = new.id;
+END;
+
+-- also covers deletes made with foreign keys off, when the cascade does not run
+CREATE TRIGGER IF NOT EXISTS utilization_encounter_delete AFTER DELETE ON encounters BEGIN
+    DELETE FROM utilization_items WHERE encounter_id = old.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS utilization_disease_rename AFTER UPDATE OF name ON diseases BEGIN
+    UPDATE utilization_items SET item_name = new.name WHERE item_type = 'Disease' AND item_id = new.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS utilization_service_rename AFTER UPDATE OF name ON services BEGIN
+    UPDATE utilization_items SET item_name = new.name WHERE item_type = 'Service' AND item_id = new.id;
+END;
+
+-- Counter bumped on every write the dashboard reads, so cached results can tell they are stale.
+CREATE TABLE IF NOT EXISTS data_version(
+    name VARCHAR(50) PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT OR IGNORE INTO data_version(name, version) VALUES ('encounters', 0);
+
+CREATE TRIGGER IF NOT EXISTS data_version_encounter_insert AFTER INSERT ON encounters BEGIN
+    UPDATE data_version SET version = version + 1 WHERE name = 'encounters';
+END;
+
+CREATE TRIGGER IF NOT EXISTS data_version_encounter_update AFTER UPDATE ON encounters BEGIN
+    UPDATE data_version SET version = version + 1 WHERE name = 'encounters';
+END;
+
+CREATE TRIGGER IF NOT EXISTS data_version_encounter_delete AFTER DELETE ON encounters BEGIN
+    UPDATE data_version SET version = version + 1 WHERE name = 'encounters';
+END;
+
+CREATE TRIGGER IF NOT EXISTS data_version_disease_insert AFTER INSERT ON encounters_diseases BEGIN
+    UPDATE data_version SET version = version + 1 WHERE name = 'encounters';
+END;
+
+CREATE TRIGGER IF NOT EXISTS data_version_disease_delete AFTER DELETE ON encounters_diseases BEGIN
+    UPDATE data_version SET version = version + 1 WHERE name = 'encounters';
+END;
+
+CREATE TRIGGER IF NOT EXISTS data_version_service_insert AFTER INSERT ON encounters_services BEGIN
+    UPDATE data_version SET version = version + 1 WHERE name = 'encounters';
+END;
+
+CREATE TRIGGER IF NOT EXISTS data_version_service_delete AFTER DELETE ON encounters_services BEGIN
+    UPDATE data_version SET version = version + 1 WHERE name = 'encounters';
+END;
+
+CREATE TRIGGER IF NOT EXISTS data_version_facility_update AFTER UPDATE ON facility BEGIN
+    UPDATE data_version SET version = version + 1 WHERE name = 'encounters';
+END;
+
+CREATE TRIGGER IF NOT EXISTS data_version_scheme_update AFTER UPDATE ON insurance_scheme BEGIN
+    UPDATE data_version SET version = version + 1 WHERE name = 'encounters';
+END;
+
+CREATE TRIGGER IF NOT EXISTS data_version_outcome_update AFTER UPDATE ON treatment_outcome BEGIN
+    UPDATE data_version SET version = version + 1 WHERE name = 'encounters';
+END;
+
+CREATE TRIGGER IF NOT EXISTS data_version_disease_rename AFTER UPDATE OF name ON diseases BEGIN
+    UPDATE data_version SET version = version + 1 WHERE name = 'encounters';
+END;
+
+CREATE TRIGGER IF NOT EXISTS data_version_service_rename AFTER UPDATE OF name ON services BEGIN
+    UPDATE data_version SET version = version + 1 WHERE name = 'encounters';
+END;
+
+-- Latest submission per facility, so the overview does not take MAX(created_at) over all encounters.
+CREATE TABLE IF NOT EXISTS facility_last_submission(
+    facility_id INTEGER PRIMARY KEY,
+    last_submission TEXT NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS facility_last_submission_insert AFTER INSERT ON encounters BEGIN
+    INSERT INTO facility_last_submission(facility_id, last_submission)
+    VALUES (new.facility_id, new.created_at)
+    ON CONFLICT(facility_id) DO UPDATE SET
+        last_submission = MAX(last_submission, excluded.last_submission);
+END;
+
+CREATE TRIGGER IF NOT EXISTS facility_last_submission_delete AFTER DELETE ON encounters BEGIN
+    DELETE FROM facility_last_submission WHERE facility_id = old.facility_id;
+    INSERT INTO facility_last_submission(facility_id, last_submission)
+    SELECT facility_id, MAX(created_at) FROM encounters
+    WHERE facility_id = old.facility_id GROUP BY facility_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS facility_last_submission_update AFTER UPDATE OF facility_id, created_at
+ON encounters BEGIN
+    DELETE FROM facility_last_submission WHERE facility_id IN (old.facility_id, new.facility_id);
+    INSERT INTO facility_last_submission(facility_id, last_submission)
+    SELECT facility_id, MAX(created_at) FROM encounters
+    WHERE facility_id IN (old.facility_id, new.facility_id) GROUP BY facility_id;
+END;
+
+-- Bumped only when stored encounter values change or rows go away, so in-process copies of
+-- the encounter columns know whether appending the new rows is enough.
+INSERT OR IGNORE INTO data_version(name, version) VALUES ('encounter_rewrites', 0);
+
+CREATE TRIGGER IF NOT EXISTS data_version_encounter_rewrite AFTER UPDATE OF date, facility_id, scheme,
+    outcome, age, gender, age_group, enc_type, treatment_cost, medication_cost, investigation_cost
+ON encounters BEGIN
+    UPDATE data_version SET version = version + 1 WHERE name = 'encounter_rewrites';
+END;
+
+CREATE TRIGGER IF NOT EXISTS data_version_encounter_remove AFTER DELETE ON encounters BEGIN
+    UPDATE data_version SET version = version + 1 WHERE name = 'encounter_rewrites';
+END;
+
+-- Months whose encounters are final. `flask close-months` closes past months and keeps the
+-- per-month counts of the unfiltered trends and series over them in frozen_month_counts,
+-- tagged with the generation the month was closed at; the dashboard only reads them. A write
+-- to an encounter dated in a closed month, or to its diseases or services, re-opens it and
+-- drops its frozen counts.
+CREATE TABLE IF NOT EXISTS closed_months(
+    month CHAR(7) PRIMARY KEY,
+    generation INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS frozen_month_queries(
+    query_key CHAR(40) NOT NULL,
+    month CHAR(7) NOT NULL,
+    generation INTEGER NOT NULL,
+    PRIMARY KEY (query_key, month)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS frozen_month_counts(
+    query_key CHAR(40) NOT NULL,
+    month CHAR(7) NOT NULL,
+    group_key TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (query_key, month, group_key)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS closed_month_reopen AFTER DELETE ON closed_months BEGIN
+    DELETE FROM frozen_month_queries WHERE month = old.month;
+    DELETE FROM frozen_month_counts WHERE month = old.month;
+END;
+
+CREATE TRIGGER IF NOT EXISTS closed_month_insert AFTER INSERT ON encounters
+WHEN substr(new.date, 1, 7) IN (SELECT month FROM closed_months) BEGIN
+    DELETE FROM closed_months WHERE month = substr(new.date, 1, 7);
+END;
+
+CREATE TRIGGER IF NOT EXISTS closed_month_delete AFTER DELETE ON encounters
+WHEN substr(old.date, 1, 7) IN (SELECT month FROM closed_months) BEGIN
+    DELETE FROM closed_months WHERE month = substr(old.date, 1, 7);
+END;
+
+-- only the columns trends and series filter or group on; dropped first so databases that
+-- have the earlier trigger, on every column, pick up the column list
+DROP TRIGGER IF EXISTS closed_month_update;
+CREATE TRIGGER closed_month_update
+AFTER UPDATE OF date, facility_id, scheme, outcome, gender, age_group, age, enc_type ON encounters BEGIN
+    DELETE FROM closed_months WHERE month IN (substr(old.date, 1, 7), substr(new.date, 1, 7));
+END;
+
+CREATE TRIGGER IF NOT EXISTS closed_month_disease_insert AFTER INSERT ON encounters_diseases BEGIN
+    DELETE FROM closed_months WHERE month = (SELECT substr(date, 1, 7) FROM encounters WHERE id = new.encounter_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS closed_month_disease_delete AFTER DELETE ON encounters_diseases BEGIN
+    DELETE FROM closed_months WHERE month = (SELECT substr(date, 1, 7) FROM encounters WHERE id = old.encounter_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS closed_month_service_insert AFTER INSERT ON encounters_services BEGIN
+    DELETE FROM closed_months WHERE month = (SELECT substr(date, 1, 7) FROM encounters WHERE id = new.encounter_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS closed_month_service_delete AFTER DELETE ON encounters_services BEGIN
+    DELETE FROM closed_months WHERE month = (SELECT substr(date, 1, 7) FROM encounters WHERE id = old.encounter_id);
+END;
+
+-- frozen counts may be grouped by facility, scheme or outcome names, so edits drop them all
+CREATE TRIGGER IF NOT EXISTS frozen_month_facility_update AFTER UPDATE ON facility BEGIN
+    DELETE FROM frozen_month_queries;
+    DELETE FROM frozen_month_counts;
+END;
+
+CREATE TRIGGER IF NOT EXISTS frozen_month_scheme_update AFTER UPDATE ON insurance_scheme BEGIN
+    DELETE FROM frozen_month_queries;
+    DELETE FROM frozen_month_counts;
+END;
+
+CREATE TRIGGER IF NOT EXISTS frozen_month_outcome_update AFTER UPDATE ON treatment_outcome BEGIN
+    DELETE FROM frozen_month_queries;
+    DELETE FROM frozen_month_counts;
+END;
+
+-- Report files generated in the background, one job per report, period, facility and data version.
+-- artifact is the XLSX file name under the report directory once the job is done.
+CREATE TABLE IF NOT EXISTS report_jobs(
+    id INTEGER PRIMARY KEY,
+    job_key CHAR(40) NOT NULL UNIQUE,
+    report_type VARCHAR(30) NOT NULL,
+    start_date DATE NOT NULL,
+    end_date DATE NOT NULL,
+    facility_id INTEGER,
+    data_version INTEGER NOT NULL,
+    status VARCHAR(10) NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'done', 'failed')),
+    report_name TEXT,
+    artifact TEXT,
+    error TEXT,
+    queued_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS report_jobs_report
+ON report_jobs(report_type, start_date, end_date, facility_id);
@@ -16,3 +16,6 @@ class QueryParameterError(ServiceError):
 
 class RangeError(ServiceError):
     '''Raised when date is out of range'''
+
+class PoolTimeoutError(ServiceError):
+    '''Raised when no pooled database connection becomes free in time'''
@@ -1,10 +1,12 @@
 ''' Parse SQL Params'''
 
+import threading
+from collections import OrderedDict
 from dataclasses import dataclass, field, replace
-from typing import Any, List, Optional, Dict, Union, Type, Tuple
+from typing import Any, List, Optional, Dict, Union, Type, Tuple, Hashable
 from app.config import Config
 from app.exceptions import QueryParameterError
-@dataclass
+@dataclass(frozen=True)
 class Filter:
     model: Optional[ Type ]
     col: str
@@ -12,17 +14,23 @@ class Filter:
     value: Any
 
 
-@dataclass
+@dataclass(frozen=True)
 class GroupBy:
     model: Optional[Type]
     col: str
 
-@dataclass
+@dataclass(frozen=True)
 class OrderBy:
     model: Optional[Type]
     col: str
     order: str = 'ASC'
 
+@dataclass(frozen=True)
+class Seek:
+    keys: tuple  # ((model, col), ...) most significant first
+    op: str
+    values: tuple
+
 @dataclass(frozen=True)
 class Params:
     _and_filter: tuple = field(default_factory=tuple)
@@ -31,6 +39,7 @@ class Params:
     _order_by: tuple  = field(default_factory=tuple)
     _limit: int = 0
     _offset: int = 0
+    _seek: Optional[Seek] = None
 
     def where(self, model: Type, col: str, op: str, value: Any) -> 'Params':
         return replace(self, _and_filter = self._and_filter + (Filter(model, col, op, value),))
@@ -50,6 +59,12 @@ class Params:
     def set_offset(self, offset: int = 0) -> 'Params':
         return replace(self,  _offset = offset)
 
+    def seek(self, keys: Tuple[Tuple[Type, str], ...], op: str, values: Tuple) -> 'Params':
+        '''Keyset condition (col1, col2, ...) op (value1, value2, ...)'''
+        if len(keys) != len(values):
+            raise QueryParameterError("Seek keys and values must have the same length")
+        return replace(self, _seek = Seek(tuple(keys), op, tuple(values)))
+
 
     @property
     def and_filter(self) -> Tuple[Filter]:
@@ -67,6 +82,10 @@ class Params:
     def order_by(self) -> Tuple[OrderBy]:
         return self._order_by
 
+    @property
+    def seek_filter(self) -> Optional[Seek]:
+        return self._seek
+
     @property
     def limit(self) -> int:
         return self._limit
@@ -75,6 +94,132 @@ class Params:
     def offset(self) -> int:
         return self._offset
 
+    def shape(self) -> Tuple:
+        '''Structure of the params (models, columns, operators, grouping, ordering) without the values'''
+        return (
+            tuple((f.model, f.col, f.op) for f in self._and_filter),
+            tuple((f.model, f.col, f.op) for f in self._or_filter),
+            tuple((gb.model, gb.col) for gb in self._group_by),
+            tuple((ob.model, ob.col, ob.order) for ob in self._order_by),
+            self._limit > 0,
+            self._offset > 0,
+            (self._seek.keys, self._seek.op) if self._seek else None,
+        )
+
+    def cache_key(self) -> Tuple:
+        '''Hashable identity of the params: the shape plus every bound value'''
+        def values(filters: tuple) -> tuple:
+            return tuple(_freeze(fil.value) for fil in filters)
+
+        return (self.shape(), values(self._and_filter), values(self._or_filter),
+                self._limit, self._offset, _freeze(self._seek.values) if self._seek else None)
+
+    def skeleton(self) -> 'Params':
+        '''Same shape with every value replaced by a _Slot pointing back at where it came from'''
+        def slots(filters: tuple, source: str) -> tuple:
+            result = []
+            for index, fil in enumerate(filters):
+                if fil.op.upper() == 'BETWEEN':
+                    value = (_Slot(source, index, 0), _Slot(source, index, 1))
+                else:
+                    value = _Slot(source, index)
+                result.append(replace(fil, value=value))
+            return tuple(result)
+
+        seek = self._seek
+        if seek:
+            seek = replace(seek, values=tuple(_Slot('seek', i) for i in range(len(seek.values))))
+
+        return replace(self,
+                       _seek=seek,
+                       _and_filter=slots(self._and_filter, 'and'),
+                       _or_filter=slots(self._or_filter, 'or'),
+                       _limit=_Slot('limit') if self._limit > 0 else 0,
+                       _offset=_Slot('offset') if self._offset > 0 else 0)
+
+
+def _freeze(value: Any) -> Hashable:
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    return value
+
+
+class _Slot(int):
+    '''
+    Placeholder bound in place of a value while compiling a query shape.
+    It is an int so limit/offset comparisons keep working.
+    '''
+    def __new__(cls, source: str, index: int = 0, part: Optional[int] = None):
+        slot = super().__new__(cls, 1)
+        slot.ref = (source, index, part)
+        return slot
+
+
+@dataclass(frozen=True)
+class CompiledQuery:
+    sql: str
+    binding: Tuple[Tuple[str, int, Optional[int]], ...]
+
+    def bind(self, params: Params, base_arg: Optional[List] = None) -> List:
+        args = list(base_arg) if base_arg else []
+        for source, index, part in self.binding:
+            if source == 'and':
+                value = params.and_filter[index].value
+            elif source == 'or':
+                value = params.or_filter[index].value
+            elif source == 'seek':
+                value = params.seek_filter.values[index]
+            elif source == 'limit':
+                value = params.limit
+            else:
+                value = params.offset
+            args.append(value if part is None else value[part])
+        return args
+
+
+class QueryShapeCache:
+    '''Bounded LRU of CompiledQuery keyed by (base query, model map, Params.shape())'''
+
+    def __init__(self, max_size: int = 512):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[CompiledQuery]:
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return compiled
+
+    def put(self, key: Hashable, compiled: CompiledQuery):
+        with self._lock:
+            self._entries[key] = compiled
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'size': len(self._entries), 'max_size': self.max_size,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+query_shape_cache = QueryShapeCache(Config.QUERY_SHAPE_CACHE_SIZE)
+
 class FilterParser:
     ALLOWED_OPERATORS = {'=', '>', '<', '>=', '<=', '!=', 'LIKE', 'IN', 'BETWEEN'}
 
@@ -89,6 +234,8 @@ class FilterParser:
             result[ 'group_by' ] = cls.parse_groupby(group_by, model_map)
         if order_by := params.order_by:
            result [ 'order_by' ] = cls.parse_orderby(order_by, model_map)
+        if seek := params.seek_filter:
+            result['seek'] = cls.parse_seek(seek, model_map)
         if params.limit > 0:
             result['limit'] = params.limit
         if params.offset > 0:
@@ -176,3 +323,19 @@ class FilterParser:
             else:
                 result[save[col]] = (col, order)
         return result
+
+    @classmethod
+    def parse_seek(cls, seek: Seek, model_map: Dict) -> Tuple[List[str], str, Tuple]:
+        columns = []
+        for model, col in seek.keys:
+            if model:
+                if not model.validate_col(col):
+                    raise QueryParameterError(f"Column {col} not in table {model.get_name()}")
+                if not model in model_map:
+                    raise QueryParameterError(f"Model {model} not in Model map")
+                col = f'{model_map[model]}.{col}'
+            columns.append(col)
+
+        if seek.op not in {'>', '<', '>=', '<='}:
+            raise QueryParameterError(f"Operator {seek.op} not allowed for seek")
+        return columns, seek.op, seek.values
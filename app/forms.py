@@ -363,6 +363,7 @@ class EncounterFilterForm(FlaskForm, FacilityMixin, SchemeMixin):
     facility_id = SelectField('Facility', coerce=int, validators=[Optional()])
     scheme_id = SelectField('Scheme', coerce=int, validators = [Optional()])
     outcome =SelectField("Treatment Outcome", coerce=int, validators = [Optional()])
+    q = StringField('Search', validators=[Optional(), Length(max=200)])
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
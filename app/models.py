@@ -11,14 +11,16 @@ class Role(Enum):
     admin = auto()
     user = auto()
 
+_COLUMN_NAMES = {}
+
 @dataclass
 class Model:
     @classmethod
     def validate_col(cls, col: str):
-        for field in fields(cls):
-            if (field.name == col):
-                return True
-        return False
+        names = _COLUMN_NAMES.get(cls)
+        if names is None:
+            names = _COLUMN_NAMES[cls] = frozenset(field.name for field in fields(cls))
+        return col in names
 
 @dataclass
 class User(Model):
@@ -0,0 +1,227 @@
+''' Per-request SQL profiling and slow-query logging '''
+
+import json
+import logging
+import math
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from flask import g, has_app_context, has_request_context, request
+from app import app
+
+_IN_LIST = re.compile(r'\?(\s*,\s*\?)+')
+_WHITESPACE = re.compile(r'\s+')
+_write_lock = threading.Lock()
+
+
+def normalize_sql(sql: str) -> str:
+    '''Query shape: whitespace collapsed and IN (?, ?, ...) lists folded into one marker'''
+    sql = _WHITESPACE.sub(' ', sql).strip()
+    return _IN_LIST.sub('?+', sql)
+
+
+def param_shape(parameters: Any) -> str:
+    '''Run-length encoded parameter types, e.g. "date,date,int*1000"'''
+    if not parameters:
+        return ''
+    if isinstance(parameters, dict):
+        return ','.join(f':{key}' for key in sorted(parameters))
+
+    shape = []
+    for value in parameters:
+        name = type(value).__name__
+        if shape and shape[-1][0] == name:
+            shape[-1][1] += 1
+        else:
+            shape.append([name, 1])
+    return ','.join(name if count == 1 else f'{name}*{count}' for name, count in shape)
+
+
+@dataclass
+class QueryRecord:
+    sql: str
+    parameters: Any
+    connection: sqlite3.Connection
+    endpoint: Optional[str] = None
+    elapsed: float = 0.0
+    rows: int = 0
+    started_at: datetime = field(default_factory=datetime.now)
+
+    @property
+    def elapsed_ms(self) -> float:
+        return self.elapsed * 1000
+
+
+def _start_record(cursor: sqlite3.Cursor, sql: str, parameters: Any) -> Optional[QueryRecord]:
+    if not has_app_context():
+        return None
+    record = QueryRecord(sql=sql, parameters=parameters, connection=cursor.connection,
+                         endpoint=request.path if has_request_context() else None)
+    g.setdefault('query_profile', []).append(record)
+    return record
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    '''Cursor that times execution and every fetch, and counts the rows returned'''
+
+    _record: Optional[QueryRecord] = None
+
+    def _track(self, start: float, rows: int = 0):
+        if self._record is not None:
+            self._record.elapsed += time.perf_counter() - start
+            self._record.rows += rows
+
+    def execute(self, sql, parameters=()):
+        self._record = _start_record(self, sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._track(start)
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        self._record = _start_record(self, sql, seq_of_parameters[0] if seq_of_parameters else ())
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._track(start, max(self.rowcount, 0))
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._track(start, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._track(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._track(start, len(rows))
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._track(start)
+            raise
+        self._track(start, 1)
+        return row
+
+
+class ProfilingConnection(sqlite3.Connection):
+    '''Connection whose shortcut execute methods go through ProfilingCursor'''
+
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connection_factory():
+    return ProfilingConnection if app.config.get('SQL_PROFILING') else sqlite3.Connection
+
+
+def _slow_query_logger() -> logging.Logger:
+    logger = logging.getLogger('odchc.slow_query')
+    if not logger.handlers:
+        handler = logging.FileHandler(app.config['SLOW_QUERY_LOG'])
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+def _explain(record: QueryRecord) -> List[str]:
+    # call the base class so the EXPLAIN itself is not profiled
+    try:
+        rows = sqlite3.Connection.execute(record.connection,
+                                          f'EXPLAIN QUERY PLAN {record.sql}',
+                                          record.parameters).fetchall()
+    except sqlite3.Error as e:
+        return [f'(plan unavailable: {e})']
+    return [row[-1] for row in rows]
+
+
+def flush_query_profile():
+    '''
+    Write the queries recorded during this app context to the profile log and
+    the ones slower than SLOW_QUERY_THRESHOLD_MS, with their plan, to the slow-query log.
+    Must run before the connections are released.
+    '''
+    records: List[QueryRecord] = g.pop('query_profile', [])
+    if not records:
+        return
+
+    threshold = app.config.get('SLOW_QUERY_THRESHOLD_MS', 250)
+    lines = []
+    for record in records:
+        shape = normalize_sql(record.sql)
+        lines.append(json.dumps({
+            'at': record.started_at.isoformat(timespec='seconds'),
+            'endpoint': record.endpoint,
+            'sql': shape,
+            'params': param_shape(record.parameters),
+            'ms': round(record.elapsed_ms, 3),
+            'rows': record.rows,
+        }))
+        if record.elapsed_ms >= threshold:
+            plan = '\n'.join(f'    {step}' for step in _explain(record))
+            _slow_query_logger().info(
+                f'{record.elapsed_ms:.1f}ms rows={record.rows} endpoint={record.endpoint} '
+                f'params=[{param_shape(record.parameters)}]\n  {shape}\n{plan}')
+
+    with _write_lock:
+        with open(app.config['QUERY_PROFILE_LOG'], 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    # nearest-rank percentile
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def summarize_profile(path: str) -> List[Dict]:
+    '''Aggregate the profile log per query shape: count, p50, p95, max, total time and rows'''
+    timings: Dict[str, List[float]] = {}
+    rows: Dict[str, int] = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            timings.setdefault(entry['sql'], []).append(entry['ms'])
+            rows[entry['sql']] = rows.get(entry['sql'], 0) + entry['rows']
+
+    summary = []
+    for shape, values in timings.items():
+        summary.append({
+            'sql': shape,
+            'count': len(values),
+            'p50': _percentile(values, 50),
+            'p95': _percentile(values, 95),
+            'max': max(values),
+            'total': sum(values),
+            'avg_rows': rows[shape] / len(values),
+        })
+    return summary
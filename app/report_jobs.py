@@ -0,0 +1,149 @@
+''' Report files generated on background threads, tracked in the report_jobs table '''
+
+import hashlib
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from typing import IO, Callable, Optional, Tuple
+
+from app import app
+from app.db import _is_memory_database, get_db
+from app.exceptions import ServiceError
+from app.result_cache import current_data_version
+
+# (report_type, start_date, end_date, facility_id) -> (file name, XLSX file object)
+ReportBuilder = Callable[[str, date, date, Optional[int]], Tuple[str, IO[bytes]]]
+
+_executor: ThreadPoolExecutor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _job_executor() -> ThreadPoolExecutor:
+    global _executor, _executor_pid
+    with _executor_lock:
+        # threads do not survive a fork, so every worker process starts its own pool
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=app.config.get('REPORT_WORKERS', 2),
+                                           thread_name_prefix='report-job')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def jobs_enabled() -> bool:
+    '''Whether reports go through the queue: enabled, on a file database with the report_jobs table'''
+    if not app.config.get('REPORT_JOBS_ENABLED') or _is_memory_database(app.config['DATABASE']):
+        return False
+    row = get_db().execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'report_jobs'").fetchone()
+    return row is not None
+
+
+def report_dir() -> str:
+    return app.config.get('REPORT_DIR') or f"{app.config['DATABASE']}.reports"
+
+
+def artifact_path(job: sqlite3.Row) -> Optional[str]:
+    '''Stored XLSX of a finished job, None when the job is not done or the file is gone'''
+    if job['status'] != 'done' or not job['artifact']:
+        return None
+    path = os.path.join(report_dir(), job['artifact'])
+    return path if os.path.exists(path) else None
+
+
+def get_job(job_id: int) -> Optional[sqlite3.Row]:
+    return get_db().execute('SELECT * FROM report_jobs WHERE id = ?', (job_id,)).fetchone()
+
+
+def submit_report(report_type: str, start_date: date, end_date: date, facility_id: Optional[int],
+                  build: ReportBuilder) -> Optional[sqlite3.Row]:
+    '''
+    Job of the report at the current data version. It is queued on this process's workers
+    unless it is already done, or queued or running within REPORT_JOB_TIMEOUT seconds; a
+    failed job is queued again. None when there is no data version to key the job by.
+    '''
+    version = current_data_version()
+    if version is None:
+        return None
+    job_key = hashlib.sha1(repr((report_type, start_date.isoformat(), end_date.isoformat(),
+                                 facility_id, version)).encode()).hexdigest()
+    db = get_db()
+    with db:
+        queued = db.execute('''
+        INSERT OR IGNORE INTO report_jobs(job_key, report_type, start_date, end_date, facility_id, data_version)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', (job_key, report_type, start_date, end_date, facility_id, version)).rowcount
+        job = db.execute('''
+        SELECT *, queued_at < datetime('now', ?) AS timed_out FROM report_jobs WHERE job_key = ?
+        ''', (f"-{app.config.get('REPORT_JOB_TIMEOUT', 3600)} seconds", job_key)).fetchone()
+        # a job whose worker process went away is taken over once it has timed out
+        retry = (job['status'] == 'failed' or (job['status'] in ('queued', 'running') and job['timed_out'])
+                 or (job['status'] == 'done' and artifact_path(job) is None))
+        if not queued and retry:
+            queued = db.execute('''
+            UPDATE report_jobs SET status = 'queued', error = NULL, queued_at = CURRENT_TIMESTAMP,
+                finished_at = NULL
+            WHERE id = ? AND status = ?
+            ''', (job['id'], job['status'])).rowcount
+            job = get_job(job['id'])
+    if queued:
+        _job_executor().submit(_run_job, job['id'], build)
+    return job
+
+
+def _run_job(job_id: int, build: ReportBuilder):
+    with app.app_context():
+        db = get_db()
+        with db:
+            job = get_job(job_id)
+            claimed = db.execute("UPDATE report_jobs SET status = 'running' WHERE id = ? AND status = 'queued'",
+                                 (job_id,)).rowcount
+        if not claimed:
+            return
+        try:
+            report_name, output = build(job['report_type'], job['start_date'], job['end_date'], job['facility_id'])
+            artifact = f"{job['job_key']}.xlsx"
+            os.makedirs(report_dir(), exist_ok=True)
+            path = os.path.join(report_dir(), artifact)
+            partial = f'{path}.{os.getpid()}.tmp'
+            with output, open(partial, 'wb') as file:
+                output.seek(0)
+                file.write(output.read())
+            os.replace(partial, path)
+        except ServiceError as e:
+            _finish(db, job_id, 'failed', error=str(e))
+            return
+        except Exception as e:
+            app.logger.exception(f'Report job {job_id} failed')
+            _finish(db, job_id, 'failed', error=f'The report could not be generated: {e}')
+            return
+        _finish(db, job_id, 'done', report_name=report_name, artifact=artifact)
+        _prune(db, job)
+
+
+def _finish(db: sqlite3.Connection, job_id: int, status: str, report_name: str = None,
+            artifact: str = None, error: str = None):
+    with db:
+        db.execute('''
+        UPDATE report_jobs SET status = ?, report_name = ?, artifact = ?, error = ?, finished_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+        ''', (status, report_name, artifact, error, job_id))
+
+
+def _prune(db: sqlite3.Connection, job: sqlite3.Row):
+    '''Drop the finished jobs, and their files, of the same report at older data versions'''
+    with db:
+        old = db.execute('''
+        SELECT id, artifact FROM report_jobs
+        WHERE report_type = ? AND start_date = ? AND end_date = ? AND facility_id IS ?
+        AND data_version < ? AND status IN ('done', 'failed')
+        ''', (job['report_type'], job['start_date'], job['end_date'], job['facility_id'],
+              job['data_version'])).fetchall()
+        db.executemany('DELETE FROM report_jobs WHERE id = ?', [(row['id'],) for row in old])
+    for row in old:
+        if row['artifact']:
+            try:
+                os.remove(os.path.join(report_dir(), row['artifact']))
+            except OSError:
+                pass
@@ -0,0 +1,210 @@
+''' Cache of dashboard results keyed by method, arguments and data version '''
+
+import hashlib
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+from functools import wraps
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app import app
+from app.config import Config
+from app.db import get_read_db
+from app.filter_parser import Params, _freeze
+
+
+def current_data_version() -> Optional[int]:
+    '''
+    Value of the encounters counter in data_version, read on every call so a write
+    earlier in the same request is seen. None when the derived schema has not been
+    applied, which disables caching.
+    '''
+    try:
+        row = get_read_db().execute(
+            "SELECT version FROM data_version WHERE name = 'encounters'").fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else None
+
+
+def _result_key(name: str, args: Tuple, kwargs: Dict) -> str:
+    def key(value):
+        return value.cache_key() if isinstance(value, Params) else _freeze(value)
+
+    identity = (app.config['DATABASE'], name,
+                tuple(key(arg) for arg in args),
+                tuple(sorted((k, key(v)) for k, v in kwargs.items())))
+    return hashlib.sha1(pickle.dumps(identity)).hexdigest()
+
+
+class ResultCache:
+    '''
+    Bounded LRU of pickled results, each stored with the data version it was computed at.
+    With a path the entries live in a sqlite file shared by every worker on the host,
+    otherwise in this process. Hits and misses are counted per cached method.
+    '''
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 64 * 1024 * 1024,
+                 ttl: float = 600, path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.path = path
+        self._entries: OrderedDict = OrderedDict()  # key -> (version, created_at, blob)
+        self._size = 0
+        self._counts: Dict[str, List[int]] = {}  # name -> [hits, misses]
+        self._lock = threading.Lock()
+        self._file_ready = False
+
+    def _count(self, name: str, hit: bool):
+        with self._lock:
+            counts = self._counts.setdefault(name, [0, 0])
+            counts[0 if hit else 1] += 1
+
+    def _fresh(self, version: int, entry_version: int, created_at: float) -> bool:
+        return entry_version == version and time.time() - created_at < self.ttl
+
+    def get(self, name: str, key: str, version: int) -> Tuple[bool, Any]:
+        blob = self._file_get(name, key, version) if self.path else self._memory_get(key, version)
+        self._count(name, blob is not None)
+        if blob is None:
+            return False, None
+        return True, pickle.loads(blob)
+
+    def put(self, name: str, key: str, version: int, value: Any):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_bytes:
+            return
+        if self.path:
+            self._file_put(name, key, version, blob)
+        else:
+            self._memory_put(key, version, blob)
+
+    def _memory_get(self, key: str, version: int) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if not self._fresh(version, entry[0], entry[1]):
+                self._size -= len(self._entries.pop(key)[2])
+                return None
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def _memory_put(self, key: str, version: int, blob: bytes):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old[2])
+            self._entries[key] = (version, time.time(), blob)
+            self._size += len(blob)
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._size -= len(self._entries.popitem(last=False)[1][2])
+
+    def _connect_file(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        if not self._file_ready:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript('''
+            CREATE TABLE IF NOT EXISTS result_cache(
+                key TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                used_at REAL NOT NULL,
+                size INTEGER NOT NULL,
+                value BLOB NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS result_cache_stats(
+                name TEXT PRIMARY KEY,
+                hits INTEGER NOT NULL DEFAULT 0,
+                misses INTEGER NOT NULL DEFAULT 0
+            );
+            ''')
+            self._file_ready = True
+        return conn
+
+    def _file_get(self, name: str, key: str, version: int) -> Optional[bytes]:
+        # a cache that cannot be read is a miss, never an error on the dashboard
+        try:
+            with closing(self._connect_file()) as conn, conn:
+                row = conn.execute('SELECT version, created_at, value FROM result_cache WHERE key = ?',
+                                   (key,)).fetchone()
+                blob = row[2] if row and self._fresh(version, row[0], row[1]) else None
+                if blob is not None:
+                    conn.execute('UPDATE result_cache SET used_at = ? WHERE key = ?', (time.time(), key))
+                conn.execute('''
+                INSERT INTO result_cache_stats(name, hits, misses) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET hits = hits + excluded.hits, misses = misses + excluded.misses
+                ''', (name, int(blob is not None), int(blob is None)))
+                return blob
+        except sqlite3.Error:
+            return None
+
+    def _file_put(self, name: str, key: str, version: int, blob: bytes):
+        now = time.time()
+        try:
+            with closing(self._connect_file()) as conn, conn:
+                conn.execute('DELETE FROM result_cache WHERE version != ?', (version,))
+                conn.execute('INSERT OR REPLACE INTO result_cache VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (key, name, version, now, now, len(blob), blob))
+                kept, size, evict = 0, 0, []
+                for row in conn.execute('SELECT key, size FROM result_cache ORDER BY used_at DESC'):
+                    kept, size = kept + 1, size + row[1]
+                    if kept > self.max_entries or size > self.max_bytes:
+                        evict.append((row[0],))
+                conn.executemany('DELETE FROM result_cache WHERE key = ?', evict)
+        except sqlite3.Error:
+            pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self._counts.clear()
+        if self.path:
+            with closing(self._connect_file()) as conn, conn:
+                conn.execute('DELETE FROM result_cache')
+                conn.execute('DELETE FROM result_cache_stats')
+
+    def stats(self) -> Dict[str, Dict]:
+        '''Hits and misses per cached method, for every worker when file backed'''
+        if self.path:
+            with closing(self._connect_file()) as conn:
+                rows = conn.execute('SELECT name, hits, misses FROM result_cache_stats').fetchall()
+        else:
+            with self._lock:
+                rows = [(name, hits, misses) for name, (hits, misses) in self._counts.items()]
+        return {name: {'hits': hits, 'misses': misses} for name, hits, misses in rows}
+
+
+result_cache = ResultCache(max_entries=Config.DASHBOARD_CACHE_SIZE,
+                           max_bytes=Config.DASHBOARD_CACHE_MAX_BYTES,
+                           ttl=Config.DASHBOARD_CACHE_TTL,
+                           path=Config.DASHBOARD_CACHE_FILE)
+
+
+def cached_result(func: Callable) -> Callable:
+    '''Cache a classmethod's result until the data version changes; apply under @classmethod'''
+    name = func.__qualname__
+
+    @wraps(func)
+    def wrapper(cls, *args, **kwargs):
+        if not app.config.get('DASHBOARD_CACHE_ENABLED'):
+            return func(cls, *args, **kwargs)
+        version = current_data_version()
+        if version is None:
+            return func(cls, *args, **kwargs)
+
+        key = _result_key(name, args, kwargs)
+        found, value = result_cache.get(name, key, version)
+        if found:
+            return value
+        value = func(cls, *args, **kwargs)
+        result_cache.put(name, key, version, value)
+        return value
+    return wrapper
@@ -13,20 +13,29 @@ from app.forms import LoginForm, AddEncounterForm, AddFacilityForm, EditFacility
 from app.forms import AddUserForm, AddCategoryForm, DeleteUserForm, EditUserForm, EditDiseaseForm, EncounterFilterForm, AdminDashboardFilterForm, ANCEncounterForm, ChildHealthEncounterForm, FacilityFilterForm
 from app.constants import ONDO_LGAS_LIST, SchemeEnum, BabyOutcome, ModeOfEntry, AgeGroup, DeliveryMode
 from .schemas import ANCEncounterSchema, DeliveryEncounterSchema, ChildHealthEncounterSchema
+from .schemas import EncounterSchema, format_validation_errors
+from pydantic import ValidationError as SchemaValidationError
 from werkzeug.utils import secure_filename
 
 from app.filter_parser import Params
 from flask_wtf import FlaskForm
 from copy import copy
+from functools import partial
 from app.services import DashboardServices, ReportServices, GroqChatServices
-from typing import Optional, List, Dict
+from app import report_jobs
+from typing import Iterator, Optional, List, Dict
 from datetime import datetime, date, timedelta
 from typing import Any
 import json
 import io
+import tempfile
+import zlib
+from itertools import chain
 import arrow
 import pandas as pd
-from openpyxl import load_workbook
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
 from openpyxl.styles import Font, Alignment
 from flask import g
 from flask import send_file
@@ -40,29 +49,32 @@ def get_facility_user_dashboard():
     end_date=datetime.now().date()
     with_date_param = param_filter.where(Encounter, 'date', '>=', start_date)\
                             .where(Encounter, 'date', '<=', end_date)
-    total_encounter = DashboardServices.get_total_encounters(param_filter, start_date=start_date, end_date = end_date)
-    encounter_gender = DashboardServices.encounter_gender_distribution(with_date_param)
-    total_utilization = DashboardServices.get_total_utilization(param_filter, start_date = start_date, end_date = end_date)
-    total_mortality = DashboardServices.get_total_death_outcome(param_filter, start_date = start_date, end_date = end_date)
-    encounter_age_group = DashboardServices.encounter_age_group_distribution(with_date_param)
-    top_cause_of_mortality = DashboardServices.get_top_cause_of_mortality(with_date_param)
-    case_fatality = DashboardServices.case_fatality(with_date_param)
+    widgets = DashboardServices.run_widgets({
+        'total_encounter': partial(DashboardServices.get_total_encounters, param_filter, start_date, end_date),
+        'encounter_gender': partial(DashboardServices.encounter_gender_distribution, with_date_param),
+        'total_utilization': partial(DashboardServices.get_total_utilization, param_filter, start_date, end_date),
+        'total_mortality': partial(DashboardServices.get_total_death_outcome, param_filter, start_date, end_date),
+        'encounter_age_group': partial(DashboardServices.encounter_age_group_distribution, with_date_param),
+        'top_cause_of_mortality': partial(DashboardServices.get_top_cause_of_mortality, with_date_param),
+        'case_fatality': partial(DashboardServices.case_fatality, with_date_param),
+    })
     facility_name = get_current_user().facility.name
 
     return render_template("facility_dashboard.html",
                            title  = f"{facility_name} - Dashboard",
                            start_date = start_date,
                            end_date = end_date,
-                           total_encounter = total_encounter,
-                           total_utilization = total_utilization,
-                           total_mortality = total_mortality,
-                           encounter_gender = encounter_gender,
-                           encounter_age_group = encounter_age_group,
-                           top_cause_of_mortality = top_cause_of_mortality,
                            facility_name = facility_name,
-                           case_fatality = case_fatality
+                           **widgets
                            )
 
+@app.after_request
+def add_widget_timing(response):
+    timings = g.get('widget_timings')
+    if timings:
+        response.headers['Server-Timing'] = ', '.join(f'{name};dur={ms:.1f}' for name, ms in timings.items())
+    return response
+
 @app.route('/')
 @app.route('/index')
 @login_required
@@ -341,6 +353,126 @@ def add_delivery_encounter_api():
 
 
 
+BATCH_ENCOUNTER_SCHEMAS = {
+    'general': EncounterSchema,
+    'anc': ANCEncounterSchema,
+    'delivery': DeliveryEncounterSchema,
+    'child_health': ChildHealthEncounterSchema,
+}
+
+
+def read_batch_body() -> Any:
+    max_bytes = app.config.get('ENCOUNTER_BATCH_MAX_BYTES', 16 * 1024 * 1024)
+    # refuse an oversized body before reading it; a body without Content-Length is read
+    # no further than one byte past the limit
+    if request.content_length is not None and request.content_length > max_bytes:
+        raise RangeError(f"Batch is larger than {max_bytes} bytes")
+    raw = b''
+    while len(raw) <= max_bytes:
+        chunk = request.stream.read(max_bytes + 1 - len(raw))
+        if not chunk:
+            break
+        raw += chunk
+    if len(raw) > max_bytes:
+        raise RangeError(f"Batch is larger than {max_bytes} bytes")
+    if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        raw = decompressor.decompress(raw, max_bytes)
+        if decompressor.unconsumed_tail:
+            raise RangeError(f"Decompressed batch is larger than {max_bytes} bytes")
+    return json.loads(raw)
+
+
+@app.post('/api/encounters/batch')
+@login_required
+def encounters_batch_api():
+    '''
+    Submit many encounters in one request and one transaction.
+    The body is a JSON array (or {"encounters": [...]}), optionally sent with
+    Content-Encoding: gzip. Each item has a "type" (general, anc, delivery, child_health),
+    an optional "idempotency_key" and, for general encounters, a "scheme_id".
+    A retried item whose key was already accepted is reported as a duplicate, not inserted again.
+    '''
+    try:
+        items = read_batch_body()
+    except RangeError as e:
+        return jsonify({'msg': str(e)}), 413
+    except (ValueError, zlib.error):
+        return jsonify({'msg': 'Body must be JSON, optionally gzip encoded'}), 400
+
+    if isinstance(items, dict):
+        items = items.get('encounters')
+    if not isinstance(items, list) or not items:
+        return jsonify({'msg': 'Expected a non-empty array of encounters'}), 400
+    max_items = app.config.get('ENCOUNTER_BATCH_MAX_ITEMS', 1000)
+    if len(items) > max_items:
+        return jsonify({'msg': f'A batch can hold at most {max_items} encounters'}), 413
+
+    user = get_current_user()
+    is_admin = user.role.name == 'admin'
+    user_schemes = None if is_admin else {sc.id for sc in user.facility.scheme}
+    amchis = InsuranceSchemeServices.get_scheme_by_enum(SchemeEnum.AMCHIS)
+
+    results = [{'index': index, 'idempotency_key': None, 'status': 'error', 'id': None, 'error': None}
+               for index in range(len(items))]
+    batch, positions, schemes, keys = [], [], [], []
+    for index, item in enumerate(items):
+        result = results[index]
+        if not isinstance(item, dict):
+            result['error'] = 'Encounter must be a JSON object'
+            continue
+        item = dict(item)
+        enc_type = item.pop('type', None)
+        key = item.pop('idempotency_key', None)
+        scheme_id = item.pop('scheme_id', None) if enc_type == 'general' else (amchis.id if amchis else None)
+        result['idempotency_key'] = key
+
+        schema = BATCH_ENCOUNTER_SCHEMAS.get(enc_type)
+        if schema is None:
+            result['error'] = f'Unknown encounter type {enc_type!r}'
+        elif key is not None and (not isinstance(key, str) or not 0 < len(key) <= 255):
+            result['error'] = 'idempotency_key must be a string of at most 255 characters'
+        elif scheme_id is None:
+            result['error'] = 'Missing scheme_id' if enc_type == 'general' else 'No AMCHIS scheme found in the database'
+        elif not isinstance(scheme_id, int) or isinstance(scheme_id, bool):
+            result['error'] = 'scheme_id must be an integer'
+        elif user_schemes is not None and scheme_id not in user_schemes:
+            result['error'] = 'Your facility is not under this insurance scheme'
+        if result['error']:
+            continue
+
+        if not is_admin:
+            item['facility_id'] = user.facility.id
+        if enc_type in ('anc', 'delivery'):
+            item['gender'] = 'F'
+        try:
+            batch.append(schema(**item))
+        except SchemaValidationError as e:
+            result['error'] = format_validation_errors(e)
+            continue
+        positions.append(index)
+        schemes.append(scheme_id)
+        keys.append(key)
+
+    if batch:
+        try:
+            created = EncounterServices.create_encounters_bulk(batch,
+                                                               scheme=schemes,
+                                                               created_by=user.id,
+                                                               idempotency_keys=keys)
+        except ServiceError as e:
+            return jsonify({'msg': f'Error while creating encounters: {e}'}), 400
+        for index, row in zip(positions, created):
+            results[index].update(id=row.id, error=row.error,
+                                  status='error' if row.error else ('duplicate' if row.duplicate else 'created'))
+
+    return jsonify({
+        'created': sum(r['status'] == 'created' for r in results),
+        'duplicates': sum(r['status'] == 'duplicate' for r in results),
+        'errors': sum(r['status'] == 'error' for r in results),
+        'results': results,
+    })
+
 @app.route("/add_encounter/amchis/child_health", methods=['GET', 'POST'])
 @login_required
 @scheme_access_required(SchemeEnum.AMCHIS)
@@ -1184,15 +1316,46 @@ def encounters():
 
     filters = build_filter(filter_form, ['period', 'scheme_id', 'outcome', 'facility_id', 'age_group'], Params(), encounter_filter_config)
 
-    encounter_list = list(EncounterServices.list_row_by_page(page,
-                                                             params=filters))
+    search_text = (filter_form.q.data or '').strip()
+    if search_text:
+        # ranked results can't seek on (date, id); page through them by rank, fetching one extra row
+        limit = app.config.get('ADMIN_PAGE_PAGINATION', 20)
+        page = max(page, 1)
+        try:
+            encounter_list = list(EncounterServices.search(
+                search_text, params=filters.set_limit(limit + 1).set_offset((page - 1) * limit)))
+        except ValidationError as e:
+            flash(str(e), 'error')
+            encounter_list = []
+        pagination_args = {k: v for k, v in request.args.items() if k != 'cursor'}
+        next_url = (url_for('encounters', **{**pagination_args, 'page': page + 1})
+                    if len(encounter_list) > limit else None)
+        prev_url = url_for('encounters', **{**pagination_args, 'page': page - 1}) if page > 1 else None
+        return render_template('encounters.html',
+                               title="Encounter Search",
+                               encounter_list=encounter_list[:limit],
+                               filter_form=filter_form,
+                               next_url=next_url,
+                               prev_url=prev_url
+                               )
+
+    cursor = request.args.get('cursor')
+    try:
+        encounter_page = EncounterServices.list_row_by_cursor(cursor, params=filters)
+    except ValidationError as e:
+        flash(str(e), 'error')
+        args = {k: v for k, v in request.args.items() if k not in ('cursor', 'page')}
+        return redirect(url_for('encounters', **args))
+    encounter_list = encounter_page.items
+    page = page if cursor else 1
 
-    pagination_args = {**request.args, "page": page + 1}
+    pagination_args = {**request.args, "page": page + 1, "cursor": encounter_page.next_cursor}
     next_url = (url_for('encounters', **pagination_args)
-                if EncounterServices.has_next_page(page, params=filters) else None)
+                if encounter_page.next_cursor else None)
 
-    pagination_args['page'] = page - 1
-    prev_url = None if page == 1 else url_for('encounters', **pagination_args)
+    pagination_args.update(page=page - 1, cursor=encounter_page.prev_cursor)
+    prev_url = (url_for('encounters', **pagination_args)
+                if encounter_page.prev_cursor else None)
     return render_template('encounters.html',
                            title="Encounter List",
                            encounter_list=encounter_list,
@@ -1232,32 +1395,28 @@ def admin_overview():
     all_filter = build_filter(form, ['period', 'scheme_id', 'gender'] )
     without_date_filter = build_filter(form, [ 'scheme_id', 'gender'] )
 
-    total_facilities = DashboardServices.get_active_encounter_facility(all_filter)
-    total_encounter = DashboardServices.get_total_encounters(params = without_date_filter,
-                                                    start_date = g.start_date, end_date = g.end_date)
-    total_death = DashboardServices.get_total_death_outcome(without_date_filter, g.start_date, g.end_date)
-    facilities_summary = DashboardServices.get_top_facilities_summaries(all_filter, g.start_date, g.end_date)
-    total_utilization = DashboardServices.get_total_utilization(without_date_filter, g.start_date, g.end_date)
-    encounter_scheme_grouped = DashboardServices.total_encounter_by_scheme_grouped(all_filter, g.start_date,
-                                                                                   g.end_date)
-
-    utilization_scheme_grouped = DashboardServices.total_utilization_by_scheme_grouped(all_filter, g.start_date,
-                                                                                       g.end_date)
-    mortality_scheme_grouped = DashboardServices.total_mortality_by_scheme_grouped(all_filter, g.start_date,
-                                                                                       g.end_date)
-    # print(f'total_facilities: {total_facilities}, total_death: {total_death} total_encounter: {total_encounter}')
+    widgets = DashboardServices.run_widgets({
+        'total_facilities': partial(DashboardServices.get_active_encounter_facility, all_filter),
+        'total_encounter': partial(DashboardServices.get_total_encounters, without_date_filter,
+                                   g.start_date, g.end_date),
+        'total_death': partial(DashboardServices.get_total_death_outcome, without_date_filter,
+                               g.start_date, g.end_date),
+        'facilities_summary': partial(DashboardServices.get_top_facilities_summaries, all_filter,
+                                      g.start_date, g.end_date),
+        'total_utilization': partial(DashboardServices.get_total_utilization, without_date_filter,
+                                     g.start_date, g.end_date),
+        'encounter_scheme_grouped': partial(DashboardServices.total_encounter_by_scheme_grouped, all_filter,
+                                            g.start_date, g.end_date),
+        'utilization_scheme_grouped': partial(DashboardServices.total_utilization_by_scheme_grouped, all_filter,
+                                              g.start_date, g.end_date),
+        'mortality_scheme_grouped': partial(DashboardServices.total_mortality_by_scheme_grouped, all_filter,
+                                            g.start_date, g.end_date),
+    })
 
     return render_template(
         'dashboard_overview.html',
         title = 'Dashboard',
-        total_facilities = total_facilities,
-        total_encounter = total_encounter,
-        total_death = total_death,
-        facilities_summary = facilities_summary,
-        total_utilization = total_utilization,
-        encounter_scheme_grouped = encounter_scheme_grouped,
-        utilization_scheme_grouped = utilization_scheme_grouped,
-        mortality_scheme_grouped = mortality_scheme_grouped,
+        **widgets,
         form = form,
         start_date = g.start_date,
         end_date = g.end_date
@@ -1283,28 +1442,26 @@ def admin_utilization():
     without_scheme_filters = build_filter(form, base_list + ['lga' , 'gender' , 'facility_id'])
     without_date_filters = build_filter(form, ['lga', 'gender', 'scheme_id', 'facility_id'])
 
-    utilization_per_scheme = DashboardServices.get_utilization_per_scheme(all_filters)
-    utilization_per_lga = DashboardServices.utilization_distribution_across_lga(without_lgas_filters)
-    top_utilized_items = DashboardServices.top_utilized_items(all_filters)
-    average_daily_utilization = DashboardServices.get_average_utilization_per_day(without_date_filters, g.start_date, g.end_date)
-    total_utilization = DashboardServices.get_total_utilization(without_date_filters, g.start_date, g.end_date)
-    utilization_age_distribution = DashboardServices.utilization_age_group_distribution(all_filters)
-    top_utilized_facilities = DashboardServices.get_top_utilization_facilities(all_filters)
-    service_utilization_rate =  DashboardServices.get_service_utilization_rate(without_date_filters, g.start_date, g.end_date)
-    utilization_trend = DashboardServices.get_utilization_trend(without_date_filters, g.start_date, g.end_date)
+    widgets = DashboardServices.run_widgets({
+        'utilization_per_scheme': partial(DashboardServices.get_utilization_per_scheme, all_filters),
+        'utilization_per_lga': partial(DashboardServices.utilization_distribution_across_lga, without_lgas_filters),
+        'top_utilized_items': partial(DashboardServices.top_utilized_items, all_filters),
+        'average_daily_utilization': partial(DashboardServices.get_average_utilization_per_day,
+                                             without_date_filters, g.start_date, g.end_date),
+        'total_utilization': partial(DashboardServices.get_total_utilization, without_date_filters,
+                                     g.start_date, g.end_date),
+        'utilization_age_distribution': partial(DashboardServices.utilization_age_group_distribution, all_filters),
+        'top_utilized_facilites': partial(DashboardServices.get_top_utilization_facilities, all_filters),
+        'service_utilization_rate': partial(DashboardServices.get_service_utilization_rate, without_date_filters,
+                                            g.start_date, g.end_date),
+        'utilization_trend': partial(DashboardServices.get_utilization_trend, without_date_filters,
+                                     g.start_date, g.end_date),
+    })
 
     return render_template(
         'dashboard_utilization.html',
         title = 'Dashboard',
-        total_utilization = total_utilization,
-        utilization_per_scheme = utilization_per_scheme,
-        utilization_age_distribution = utilization_age_distribution,
-        top_utilized_items = top_utilized_items,
-        average_daily_utilization = average_daily_utilization,
-        utilization_trend = utilization_trend,
-        top_utilized_facilites = top_utilized_facilities,
-        service_utilization_rate = service_utilization_rate,
-        utilization_per_lga = utilization_per_lga,
+        **widgets,
         start_date = g.start_date,
         end_date = g.end_date,
         form = form
@@ -1323,36 +1480,14 @@ def admin_encounters():
         flash("Invalid Filter Parameters", "error")
         return redirect(url_for('admin_encounters'))
 
-    base_list = ['period']
-    all_filters = build_filter(form, base_list + ['scheme_id' , 'lga' , 'gender' ,'facility_id'])
-    without_facility_filters = build_filter(form, base_list + ['scheme_id' , 'lga' , 'gender'])
-    without_gender_filters = build_filter(form, base_list + ['scheme_id' , 'lga' , 'facility_id'])
-    without_lgas_filters = build_filter(form, base_list + ['scheme_id' , 'gender' , 'facility_id'])
-    without_scheme_filters = build_filter(form, base_list + ['lga' , 'gender' , 'facility_id'])
-    without_date_filters = build_filter(form, ['lga', 'gender', 'scheme_id', 'facility_id'])
-
-    total_encounter = DashboardServices.get_total_encounters(without_date_filters, g.start_date, g.end_date)
-    encounter_gender_distribution = DashboardServices.encounter_gender_distribution(without_gender_filters)
-    encounter_age_distribution = DashboardServices.encounter_age_group_distribution(all_filters)
-    encounter_per_scheme = DashboardServices.get_encounter_per_scheme(without_scheme_filters)
-    treatment_outcome_distribution = DashboardServices.get_treatment_outcome_distribution(all_filters)
-    top_encounter_facilities = DashboardServices.get_top_encounter_facilities(all_filters)
-    average_daily_encounter = DashboardServices.get_average_encounter_per_day(all_filters, g.start_date, g.end_date)
-    encounter_trend = DashboardServices.get_encounter_trend(without_date_filters, g.start_date, g.end_date)
-    encounter_per_lga = DashboardServices.encounter_distribution_across_lga(without_lgas_filters)
+    all_filters = build_filter(form, ['period', 'scheme_id' , 'lga' , 'gender' ,'facility_id'])
+    # each widget drops the filter on its own dimension, as the separate queries used to
+    widgets = DashboardServices.encounter_page_summary(all_filters, g.start_date, g.end_date)
 
     return render_template(
         'dashboard_encounters.html',
         title = 'Dashboard',
-        total_encounter = total_encounter,
-        encounter_gender_distribution = encounter_gender_distribution,
-        encounter_age_distribution = encounter_age_distribution,
-        treatment_outcome_distribution = treatment_outcome_distribution,
-        encounter_per_scheme = encounter_per_scheme,
-        top_encounter_facilities = top_encounter_facilities,
-        average_daily_encounter = average_daily_encounter,
-        encounter_trend = encounter_trend,
-        encounter_per_lga = encounter_per_lga,
+        **widgets,
         start_date = g.start_date,
         end_date = g.end_date,
         form = form
@@ -1379,32 +1514,30 @@ def admin_mortality():
     without_scheme_filters = build_filter(form, base_list + ['lga' , 'gender' , 'facility_id'])
     without_date_filters = build_filter(form, ['lga', 'gender', 'scheme_id', 'facility_id'])
 
-    mortality_type_distribution  = DashboardServices.mortality_distribution_by_type(all_filters)
-    mortality_age_group_distribution = DashboardServices.mortality_distribution_by_age_group(all_filters)
-    mortality_facility_distribution = DashboardServices.get_mortality_count_per_facility(without_facility_filters)
-    mortality_gender_distribution = DashboardServices.get_mortality_distribution_by_gender(without_gender_filters)
-    mortality_scheme_distribution = DashboardServices.get_mortality_per_scheme(without_scheme_filters)
-    mortality_trend = DashboardServices.get_mortality_trend(all_filters, g.start_date, g.end_date)
-    mortality_per_lga = DashboardServices.get_mortality_by_lga(without_lgas_filters)
-    average_daily_mortality = DashboardServices.get_average_mortality_per_day(without_date_filters, g.start_date, g.end_date)
-    top_cause = DashboardServices.get_top_cause_of_mortality(all_filters)
-    total_death = DashboardServices.get_total_death_outcome(without_date_filters, start_date = g.start_date, end_date = g.end_date)
-    case_fatality = DashboardServices.case_fatality(all_filters)
+    widgets = DashboardServices.run_widgets({
+        'mortality_type_distribution': partial(DashboardServices.mortality_distribution_by_type, all_filters),
+        'mortality_age_group_distribution': partial(DashboardServices.mortality_distribution_by_age_group,
+                                                    all_filters),
+        'mortality_facility_distribution': partial(DashboardServices.get_mortality_count_per_facility,
+                                                   without_facility_filters),
+        'mortality_gender_distribution': partial(DashboardServices.get_mortality_distribution_by_gender,
+                                                 without_gender_filters),
+        'mortality_scheme_distribution': partial(DashboardServices.get_mortality_per_scheme, without_scheme_filters),
+        'mortality_trend_distribution': partial(DashboardServices.get_mortality_trend, all_filters,
+                                                g.start_date, g.end_date),
+        'mortality_per_lga': partial(DashboardServices.get_mortality_by_lga, without_lgas_filters),
+        'average_daily_mortality': partial(DashboardServices.get_average_mortality_per_day, without_date_filters,
+                                           g.start_date, g.end_date),
+        'mortality_top_cause': partial(DashboardServices.get_top_cause_of_mortality, all_filters),
+        'total_death': partial(DashboardServices.get_total_death_outcome, without_date_filters,
+                               g.start_date, g.end_date),
+        'case_fatality': partial(DashboardServices.case_fatality, all_filters),
+    })
 
     return render_template(
         'dashboard_mortality.html',
         title = 'Dashboard',
-        mortality_type_distribution = mortality_type_distribution,
-        mortality_age_group_distribution = mortality_age_group_distribution,
-        mortality_facility_distribution = mortality_facility_distribution,
-        mortality_gender_distribution = mortality_gender_distribution,
-        mortality_scheme_distribution = mortality_scheme_distribution,
-        mortality_trend_distribution = mortality_trend,
-        mortality_per_lga = mortality_per_lga,
-        mortality_top_cause = top_cause,
-        total_death =  total_death,
-        average_daily_mortality = average_daily_mortality,
-        case_fatality = case_fatality,
+        **widgets,
         form = form,
         start_date = g.start_date,
         end_date = g.end_date
@@ -1423,7 +1556,9 @@ def reports():
                            start_date = start_date,
                            end_date = end_date)
 
-def get_report_data():
+REPORT_TYPES = ('utilization', 'encounter', 'categorization', 'nhia_encounter')
+
+def get_report_request():
     report_type = request.args.get('report_type')
     facility_id_str = request.args.get('facility_id')
     start_date, end_date = parse_date()
@@ -1435,29 +1570,32 @@ def get_report_data():
         raise RangeError("Cannot Generate report with date range more than a year")
 
     facility_id = int(facility_id_str) if facility_id_str else None
-    report_data = None
-    report_title = ""
+    if report_type not in REPORT_TYPES:
+        raise ValidationError("Invalid report type selected.")
+    if report_type == 'utilization' and not facility_id:
+        raise ValidationError(
+            "Please select a facility for the Utilization Report.")
+    return report_type, start_date, end_date, facility_id
+
+def generate_report(report_type, start_date, end_date, facility_id):
     facility = None
 
     if report_type == 'utilization':
-        if not facility_id:
-            raise ValidationError(
-                "Please select a facility for the Utilization Report.")
         facility, start_date, report_data = ReportServices.generate_service_utilization_report(
             facility=facility_id, start_date = start_date, end_date = end_date)
         report_title = f"Service Utilization Report for {facility.name} "
 
     elif report_type == 'encounter':
-        report_data = ReportServices.generate_encounter_report(
+        start_date, report_data = ReportServices.generate_encounter_report(
                 start_date = start_date, end_date = end_date)
         report_title = "Encounter Report "
 
     elif report_type == 'categorization':
-        report_data = ReportServices.generate_categorization_report(
+        start_date, report_data = ReportServices.generate_categorization_report(
             start_date=start_date, end_date = end_date)
         report_title = "Disease Categorization Report "
     elif report_type == 'nhia_encounter':
-        report_data = ReportServices.generate_nhia_encounter_report(
+        start_date, report_data = ReportServices.generate_nhia_encounter_report(
                 start_date = start_date, end_date = end_date)
         report_title = "NHIA Encounter Report"
     else:
@@ -1470,7 +1608,7 @@ def get_report_data():
 @admin_required
 def view_report():
     try:
-        report_title, start_date, facility, report_data = get_report_data()
+        report_title, start_date, facility, report_data = generate_report(*get_report_request())
     except (MissingError, ValidationError) as e:
         flash(str(e), 'error')
         return redirect(url_for('reports'))
@@ -1618,31 +1756,81 @@ def append_categorization_header(report_data, start_date: date):
     wb.save(final_output)
     return final_output
 
-def append_nhia_encounter_header(report_data, start_date: date):
-    output_buffer = io.BytesIO()
-    with pd.ExcelWriter(output_buffer) as writer:
-        report_data.to_excel(writer)
-    output_buffer.seek(0)
+# free-text columns get autofit_columns' cap, as the widths are set before any row is written
+NHIA_WIDE_COLUMNS = {'FACILITY NAME', 'ENROLLEE NAME', 'RESIDENTIAL ADDRESS', 'INVESTIGATION', 'DIAGNOSIS',
+                     'TREATMENT', 'MEDICATION', 'REASON FOR REFERRAL'}
+
+def write_nhia_encounter_report(rows: Iterator[List], columns: List[str], max_width=55):
+    """
+    Writes the NHIA encounter rows to a write-only workbook as they come, so memory stays
+    flat however long the period is. The file spools to disk once it outgrows 8MB.
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    header = ['S/N'] + columns
+    for idx, name in enumerate(header, 1):
+        width = max_width if name in NHIA_WIDE_COLUMNS else min((len(name) + 2) * 1.2, max_width)
+        ws.column_dimensions[get_column_letter(idx)].width = width
+
+    bold = Font(bold=True)
+    alignment = Alignment(horizontal='left', vertical='center')
+
+    def styled(value, font=None):
+        cell = WriteOnlyCell(ws, value)
+        cell.alignment = alignment
+        if font:
+            cell.font = font
+        return cell
+
+    ws.append([styled(name, bold) for name in header])
+    for sn, row in enumerate(rows, 1):
+        ws.append([styled(sn, bold)] + [styled(value) for value in row])
+
+    output = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    wb.save(output)
+    return output
+
+def build_report_file(report_type, start_date, end_date, facility_id):
+    if report_type == 'nhia_encounter':
+        rows = ReportServices.iter_nhia_encounter_rows(start_date, end_date)
+        first = next(rows, None)
+        if first is None:
+            raise MissingError("No report available for this timeframe!")
+        # written row by row from the cursor
+        output_buffer = write_nhia_encounter_report(chain([first], rows), ReportServices.NHIA_COLUMNS)
+        return f"NHIA_Encounter_Report_{start_date.strftime('%B')}.xlsx", output_buffer
+
+    report_title, start_date, facility, report_data = generate_report(report_type, start_date, end_date, facility_id)
+    report_name = f"{report_title.replace(' ', '_')}_{start_date.strftime('%B')}.xlsx"
+    if report_type == 'utilization':
+        output_buffer = append_utilization_header(
+            report_data, start_date, facility)
+    elif report_type == 'encounter':
+        output_buffer = append_encounter_header(report_data, start_date)
+    elif report_type == 'categorization':
+        output_buffer = append_categorization_header(report_data, start_date)
+    else:
+        raise ValidationError("Invalid report type selected.")
+    return report_name, output_buffer
 
-    wb = load_workbook(output_buffer)
-    ws = wb.active
-    ws['A1'].value = 'S/N'
-    for idx,row in enumerate(ws.columns):
-        for cell in row:
-            if idx == 0:
-                cell.font = Font(bold=True)
-                cell.alignment = Alignment(horizontal='left', vertical='center')
-            cell.alignment = Alignment(horizontal='left', vertical='center')
-    autofit_columns(ws, 55)
-    final_output = io.BytesIO()
-    wb.save(final_output)
-    return final_output
+def send_report_file(output, report_name):
+    return send_file(
+        output,
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        as_attachment=True,
+        download_name=secure_filename(report_name)
+    )
 
 @app.route('/admin/download_report')
 @admin_required
 def download_report():
+    job = None
     try:
-        report_title, start_date, facility, report_data = get_report_data()
+        report = get_report_request()
+        if report_jobs.jobs_enabled():
+            job = report_jobs.submit_report(*report, build_report_file)
+        if job is None:
+            report_name, output_buffer = build_report_file(*report)
     except (MissingError, ValidationError) as e:
         flash(str(e), 'error')
         return redirect(url_for('reports'))
@@ -1653,29 +1841,43 @@ def download_report():
         flash(str(e), 'error')
         return redirect(url_for('reports'))
 
-    report_name = f"{report_title.replace(' ', '_')}_{start_date.strftime('%B')}.xlsx"
+    if job is not None:
+        return redirect(url_for('report_job', job_id=job['id']))
+    output_buffer.seek(0)
+    return send_report_file(output_buffer, report_name)
 
-    report_type = request.args.get('report_type')
-    if report_type == 'utilization':
-        output_buffer = append_utilization_header(
-            report_data, start_date, facility)
-    elif report_type == 'encounter':
-        output_buffer = append_encounter_header(report_data, start_date)
-    elif report_type == 'categorization':
-        output_buffer = append_categorization_header(report_data, start_date)
-    elif report_type == "nhia_encounter":
-        output_buffer =  append_nhia_encounter_header(report_data, start_date)
-    else:
-        flash("Invalid report type", "error")
-        return redirect(url_for("view_report"))
+@app.route('/admin/report_jobs/<int:job_id>')
+@admin_required
+def report_job(job_id):
+    job = report_jobs.get_job(job_id)
+    if job is None:
+        abort(404)
+    if job['status'] == 'done':
+        return redirect(url_for('report_job_download', job_id=job_id))
+    return render_template('report_job.html', title="Preparing Report", job=job)
 
-    output_buffer.seek(0)
-    return send_file(
-        output_buffer,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name=secure_filename(report_name)
-    )
+@app.route('/admin/report_jobs/<int:job_id>/status')
+@admin_required
+def report_job_status(job_id):
+    job = report_jobs.get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Report job not found'}), 404
+    return jsonify({
+        'id': job['id'],
+        'status': job['status'],
+        'error': job['error'],
+        'download_url': url_for('report_job_download', job_id=job_id) if job['status'] == 'done' else None
+    })
+
+@app.route('/admin/report_jobs/<int:job_id>/download')
+@admin_required
+def report_job_download(job_id):
+    job = report_jobs.get_job(job_id)
+    path = report_jobs.artifact_path(job) if job is not None else None
+    if path is None:
+        flash("This report is no longer available, please generate it again.", 'error')
+        return redirect(url_for('reports'))
+    return send_report_file(path, job['report_name'])
 
 @app.route('/admin/analytic_query')
 @admin_required
@@ -1697,10 +1899,13 @@ def query():
         print("Initialized Chat services")
         chatsession = GroqChatServices()
         print("=================Starting to generate response=================")
-        for text_chunk in chatsession.generate_response(user_input, conversation):
-            if text_chunk:
-                print("New chunkss: ", text_chunk)
-                yield text_chunk
+        try:
+            for text_chunk in chatsession.generate_response(user_input, conversation):
+                if text_chunk:
+                    print("New chunkss: ", text_chunk)
+                    yield text_chunk
+        finally:
+            chatsession.close()
         print("=================Finished generating response=================\n\n")
 
     return Response(
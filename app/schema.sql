@@ -187,21 +187,6 @@ CREATE TABLE bot_sessions(
     context_data TEXT
 );
 
-CREATE VIRTUAL TABLE encounters_fts USING fts5(
-    policy_number,
-    client_name,
-    nin,
-    phone_number,
-    address,
-    treatment,
-    medication,
-    investigation,
-    doctor_name,
-    mode_of_entry,
-    content='encounters',
-    content_rowid='id'
-);
-
 CREATE VIEW view_utilization_items AS
 SELECT
     ecd.encounter_id,
@@ -272,7 +257,7 @@ SELECT
     sa.service_list as "Services",
     e.treatment as "Treatment",
     tc.name as "Outcome",
-    tc.type as "Outcome Type"
+    tc.type as "Outcome Type",
 
     ar.lmp as "LMP",
     ar.expected_delivery_date as "EDD",
@@ -313,6 +298,7 @@ CREATE INDEX idx_encounters_created_at ON encounters (created_at);
 CREATE INDEX idx_facility_scheme_id ON facility_scheme (scheme_id);
 CREATE INDEX idx_facility_scheme_facility_id ON facility_scheme (facility_id);
 CREATE INDEX idx_encounters_facility_date ON encounters (facility_id, date);
+CREATE INDEX idx_encounters_date ON encounters (date);
 CREATE INDEX idx_user_facility_id ON users (facility_id);
 CREATE INDEX idx_diseases_category_id ON diseases (category_id);
 CREATE INDEX idx_encounters_date_gender ON encounters (date, gender);
@@ -1,5 +1,5 @@
 from typing import Optional, List, Literal
-from pydantic import BaseModel, Field, field_validator, model_validator, ConfigDict
+from pydantic import BaseModel, Field, field_validator, model_validator, ConfigDict, ValidationError
 from datetime import datetime, date
 from .constants import AgeGroup, ModeOfEntry, BabyOutcome, DeliveryMode
 import re
@@ -100,3 +100,8 @@ class ChildHealthEncounterSchema(EncounterSchema):
         if not pattern.match(field):
             raise ValueError("ORIN must be exactly 10 digits")
         return field
+
+
+def format_validation_errors(error: ValidationError) -> str:
+    return '; '.join(f"{'.'.join(str(loc) for loc in err['loc'])}: {err['msg']}"
+                     for err in error.errors())
@@ -1,3 +1,4 @@
+from .base import BaseServices
 from .encounter import EncounterServices
 from .facility import FacilityServices
 from .insurance_scheme import InsuranceSchemeServices
@@ -1,7 +1,11 @@
-from typing import Optional, Type, TypeVar, Iterator, List, Tuple, Dict
+import base64
+import binascii
+import json
+from dataclasses import dataclass
+from typing import Any, Optional, Type, TypeVar, Iterator, List, Tuple, Dict
 from app import app
-from app.db import get_db
-from app.filter_parser import FilterParser, Params
+from app.db import get_db, get_read_db
+from app.filter_parser import FilterParser, Params, CompiledQuery, query_shape_cache
 from app.exceptions import ValidationError, MissingError, QueryParameterError
 
 def _legacy_to_params(**kwargs) -> Dict:
@@ -22,11 +26,62 @@ def _legacy_to_params(**kwargs) -> Dict:
 
 T = TypeVar('T')
 
+
+@dataclass
+class CursorPage:
+    items: List
+    next_cursor: Optional[str] = None
+    prev_cursor: Optional[str] = None
+
+
+def _encode_cursor(values: Tuple, backwards: bool = False) -> str:
+    payload = json.dumps({'k': list(values), 'b': backwards}, default=str, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def _decode_cursor(cursor: str) -> Tuple[Tuple, bool]:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return tuple(payload['k']), bool(payload['b'])
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise ValidationError("Invalid page cursor")
+
+# (database, table) pairs known to exist; optional derived tables are only looked up once
+_existing_tables = set()
+
 class BaseServices:
     model: Type[T] = None
     table_name = ''
     columns_to_update: set = set()
     MODEL_ALIAS_MAP = {}
+    # analytic services only read, so they are routed to the read-only connection
+    read_only: bool = False
+    # (model, column) pairs keyset pagination seeks on; defaults to the model id
+    cursor_key: Tuple[Tuple[Type, str], ...] = ()
+    cursor_order: str = 'ASC'
+
+    @classmethod
+    def _connection(cls):
+        return get_read_db() if cls.read_only else get_db()
+
+    @classmethod
+    def _table_exists(cls, name: str) -> bool:
+        key = (app.config['DATABASE'], name)
+        if key not in _existing_tables:
+            row = cls._connection().execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone()
+            if row is None:
+                return False
+            _existing_tables.add(key)
+        return True
+
+    @classmethod
+    def _utilization_table(cls) -> str:
+        '''utilization_items when it is enabled and created, otherwise the view it materialises'''
+        if app.config.get('USE_UTILIZATION_ITEMS') and cls._table_exists('utilization_items'):
+            return 'utilization_items'
+        return 'view_utilization_items'
 
     @staticmethod
     def _row_to_model(row, model_cls: Type[T]) -> T:
@@ -36,7 +91,7 @@ class BaseServices:
 
     @classmethod
     def get_by_id(cls, id: int) -> object:
-        db = get_db()
+        db = cls._connection()
         row = db.execute(
             f'SELECT * FROM {cls.table_name} WHERE id = ?', (id,)).fetchone()
         if row is None:
@@ -66,6 +121,58 @@ class BaseServices:
         params = params.set_limit(limit).set_offset(offset)
         return cls.get_all(params=params)
 
+    @classmethod
+    def list_row_by_cursor(cls,
+                           cursor: Optional[str] = None,
+                           params: Optional[Params] = None,
+                           ) -> CursorPage:
+        '''
+        Keyset pagination: seek past the key of the last row seen instead of using OFFSET,
+        and fetch one extra row to know whether another page exists without a COUNT(*).
+        The cursors returned are opaque strings to pass back for the next/previous page.
+        '''
+        params = Params() if params is None else params
+        if params.order_by or params.offset:
+            raise QueryParameterError("Cursor pagination defines its own order and offset")
+
+        limit = params.limit if params.limit > 0 else app.config.get('ADMIN_PAGE_PAGINATION', 20)
+        if limit < 0:
+            raise ValidationError("Invalid Page limit")
+
+        keys = cls.cursor_key or ((cls.model, 'id'),)
+        descending = cls.cursor_order.upper() == 'DESC'
+        backwards = False
+        if cursor:
+            values, backwards = _decode_cursor(cursor)
+            if len(values) != len(keys):
+                raise ValidationError("Invalid page cursor")
+            # walking backwards reverses both the seek and the order
+            op = '<' if descending != backwards else '>'
+            params = params.seek(keys, op, values)
+
+        order = 'DESC' if descending != backwards else 'ASC'
+        for model, col in keys:
+            params = params.sort(model, col, order)
+
+        items = list(cls.get_all(params=params.set_limit(limit + 1)))
+        has_more = len(items) > limit
+        items = items[:limit]
+        if backwards:
+            items.reverse()
+        if not items:
+            return CursorPage(items)
+
+        def key_of(item: Any) -> Tuple:
+            return tuple(getattr(item, col) for _, col in keys)
+
+        if backwards:
+            next_cursor = _encode_cursor(key_of(items[-1]))
+            prev_cursor = _encode_cursor(key_of(items[0]), True) if has_more else None
+        else:
+            next_cursor = _encode_cursor(key_of(items[-1])) if has_more else None
+            prev_cursor = _encode_cursor(key_of(items[0]), True) if cursor else None
+        return CursorPage(items, next_cursor, prev_cursor)
+
     @classmethod
     def update_data(cls, model: Type[T]) -> T:
         db = get_db()
@@ -85,22 +192,13 @@ class BaseServices:
                   **kwargs) -> int:
 
         query = f'SELECT COUNT(*) from {cls.table_name}'
-        res ={}
-        if params is not None:
-            if params.group_by or params.order_by:
-                raise QueryParameterError("You can't groupby or order by to get_total")
-
-            mapper = {cls.model: cls.table_name}
-            res = FilterParser.parse_params(params, model_map=mapper)
-        else:
-            res = _legacy_to_params(**kwargs)
+        if params is not None and (params.group_by or params.order_by):
+            raise QueryParameterError("You can't groupby or order by to get_total")
 
-        query, args = cls._apply_filter(
-            base_query=query,
-            base_arg=[],
-            **res
-        )
-        db = get_db()
+        query, args = cls._build_query(query, params,
+                                       model_map={cls.model: cls.table_name},
+                                       **kwargs)
+        db = cls._connection()
         res =db.execute(query, args).fetchone()
         if res:
             return res[0]
@@ -109,11 +207,36 @@ class BaseServices:
 
     @classmethod
     def _run_query(cls, query: str, params: list, row_mapper):
-        db = get_db()
+        db = cls._connection()
         rows = db.execute(query, params)
         return [row_mapper(row) for row in rows]
 
 
+    @classmethod
+    def _build_query(cls,
+                     base_query: str,
+                     params: Optional[Params] = None,
+                     model_map: Optional[Dict] = None,
+                     base_arg: Optional[List] = None,
+                     **kwargs) -> Tuple[str, List]:
+        '''
+        Append the WHERE/GROUP BY/ORDER BY/LIMIT clauses described by params to base_query.
+        The SQL text for a given params shape is compiled once and cached, so repeated calls
+        only bind the filter values. Without params the legacy keyword filters are applied.
+        '''
+        if params is None:
+            return cls._apply_filter(base_query, base_arg, **_legacy_to_params(**kwargs))
+
+        model_map = cls.MODEL_ALIAS_MAP if model_map is None else model_map
+        key = (base_query, tuple(model_map.items()), params.shape())
+        compiled = query_shape_cache.get(key)
+        if compiled is None:
+            res = FilterParser.parse_params(params.skeleton(), model_map)
+            query, slots = cls._apply_filter(base_query, [], **res)
+            compiled = CompiledQuery(query, tuple(slot.ref for slot in slots))
+            query_shape_cache.put(key, compiled)
+        return compiled.sql, compiled.bind(params, base_arg)
+
     @classmethod
     def _apply_filter(cls,
                       base_query: str,
@@ -123,7 +246,8 @@ class BaseServices:
                       and_filter: Optional[List[Tuple]] = None,
                       or_filter: Optional[List[Tuple]] = None,
                       order_by: Optional[List[Tuple[str, str]]] = None,
-                      group_by: Optional[List[str]] = None
+                      group_by: Optional[List[str]] = None,
+                      seek: Optional[Tuple[List[str], str, Tuple]] = None
                       ):
         ALLOWED_OPERATORS = {'=', '>', '<', '>=', '<=', '!=', 'LIKE', 'IN', 'BETWEEN'}
         query = ''
@@ -156,6 +280,14 @@ class BaseServices:
             if or_conditions:
                 conditions.append("(" + " OR ".join(or_conditions) + ")")
 
+        if seek:
+            columns, opt, values = seek
+            if opt not in {'>', '<', '>=', '<='}:
+                raise ValidationError(f"Invalid operator: {opt}")
+            placeholders = ', '.join('?' * len(columns))
+            conditions.append(f"({', '.join(columns)}) {opt} ({placeholders})")
+            args.extend(values)
+
 
         if conditions:
             query += " WHERE " + " AND ".join(conditions)
@@ -189,16 +321,11 @@ class BaseServices:
                 **kwargs
                 ) -> Iterator:
 
-        res = {}
-        if params:
-            model_map = {cls.model: cls.table_name}
-            res = FilterParser.parse_params(params, model_map=model_map)
-        else:
-            res = _legacy_to_params(**kwargs)
         query = f"SELECT * from {cls.table_name}"
-        query, args = cls._apply_filter(query,
-                                        **res)
-        db = get_db()
+        query, args = cls._build_query(query, params,
+                                       model_map={cls.model: cls.table_name},
+                                       **kwargs)
+        db = cls._connection()
         rows = db.execute(query, args)
         for row in rows:
             yield cls._row_to_model(row, cls.model)
@@ -1,4 +1,6 @@
 from .base import BaseServices
+from app import app
+from app.db import _read_only_connector
 from google import genai
 from google.genai import types
 from groq import Groq, RateLimitError, APIStatusError
@@ -65,8 +67,9 @@ Question: "What is the total service utilization last month?"
 """
 
     def __init__(self) -> None:
-        self.db = sqlite3.connect(f"file:{Config.DATABASE}?mode=ro", uri=True, check_same_thread=False, timeout=7)
-        self.db.row_factory = sqlite3.Row
+        # a connection of its own, never pooled: the model's SQL may change PRAGMAs, ATTACH
+        # databases or create temp tables, which must not carry over to later requests
+        self.db = _read_only_connector(app.config['DATABASE'], check_same_thread=False)
         self.MAX_ITER_LOOP = 10
         self.execute_sql_query_schema = {
         "type": "function",
@@ -93,6 +96,9 @@ Question: "What is the total service utilization last month?"
     }
 
 
+    def close(self):
+        self.db.close()
+
     def execute_sql_query(self, query: str):
 
         """
@@ -1,20 +1,126 @@
-from app.db import get_db
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from flask import g
+from app import app
+from app.db import _is_memory_database
 from app.models import (
     Encounter, Facility, TreatmentOutcome, EncounterDiseases,
-    ServiceCategory, Service, DiseaseCategory, User, Disease
+    ServiceCategory, Service, DiseaseCategory, User, Disease, InsuranceScheme
 )
 from app.constants import ONDO_LGAS_LOWER, AgeGroup
-from app.filter_parser import FilterParser, Params
+from app.exceptions import QueryParameterError
+from app.filter_parser import Params
+from app.result_cache import cached_result
+from app.columnar import EncounterColumns, column_store, columnar
+from dataclasses import dataclass, replace
 from datetime import datetime, date, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 from dateutil.relativedelta import relativedelta
-import pandas as pd
 
 from .base import BaseServices
 from .encounter import EncounterServices
 
+
+@dataclass(frozen=True)
+class EncounterSource:
+    '''Table read as `ec` by the encounter counting queries and how to count its rows'''
+    table: str
+    count: str
+    weight: str
+
+
+RAW_ENCOUNTERS = EncounterSource('encounters', 'COUNT(*)', '1')
+DAILY_ROLLUP = EncounterSource('daily_encounter_rollup',
+                               'COALESCE(SUM(ec.encounter_count), 0)', 'ec.encounter_count')
+ROLLUP_COLUMNS = frozenset({'date', 'facility_id', 'scheme', 'gender', 'age_group', 'outcome'})
+# tables the rollup still joins to through its dimension columns
+ROLLUP_JOINS = (Facility, TreatmentOutcome, InsuranceScheme)
+# dimensions the encounter page widgets cross-filter on: each widget ignores the filter on its own
+PAGE_DIMENSIONS = {(Encounter, 'date'): 'date', (Encounter, 'gender'): 'gender',
+                   (Facility, 'local_government'): 'lga', (Encounter, 'scheme'): 'scheme'}
+PAGE_DIMENSION_OPS = {'=', '!=', '<', '<=', '>', '>=', 'BETWEEN'}
+
+# SQL for the period an encounter date falls in, labelled like the calendar below
+TREND_BUCKETS = {
+    'week': "date(ec.date, '-6 days', 'weekday 1')",
+    'month': "substr(ec.date, 1, 7)",
+    'quarter': "substr(ec.date, 1, 4) || '-Q' || ((CAST(substr(ec.date, 6, 2) AS INTEGER) + 2) / 3)",
+    'year': "substr(ec.date, 1, 4)",
+}
+# columns a grouped series is split by: (SQL expression, output key)
+SERIES_DIMENSIONS = {
+    'scheme': (('isc.scheme_name', 'scheme_name'), ('isc.color_scheme', 'color_scheme')),
+    'lga': (('fc.local_government', 'lga'),),
+    'facility': (('fc.name', 'facility_name'),),
+}
+SERIES_METRICS = ('encounters', 'mortality', 'utilization')
+
+
+def trend_periods(start_date: date, end_date: date, granularity: str = 'month') -> Iterator[str]:
+    '''Labels of every week (its Monday), month (YYYY-MM), quarter (YYYY-Qn) or year from start_date to end_date'''
+    if granularity == 'year':
+        yield from (str(year) for year in range(start_date.year, end_date.year + 1))
+        return
+    if granularity == 'week':
+        day = start_date - timedelta(days=start_date.weekday())
+        while day <= end_date:
+            yield day.isoformat()
+            day += timedelta(days=7)
+        return
+
+    step = 3 if granularity == 'quarter' else 1
+    year, month = start_date.year, start_date.month - (start_date.month - 1) % step
+    while (year, month) <= (end_date.year, end_date.month):
+        yield f'{year}-Q{(month + 2) // 3}' if step == 3 else f'{year}-{month:02d}'
+        month += step
+        if month > 12:
+            year, month = year + 1, month - 12
+
+
+_executor: ThreadPoolExecutor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_worker_state = threading.local()
+
+
+def _widget_executor(workers: int) -> ThreadPoolExecutor:
+    global _executor, _executor_pid
+    with _executor_lock:
+        # threads do not survive a fork, so every worker process starts its own pool
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dashboard-widget')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _timed(call: Callable[[], Any]) -> Tuple[Any, float]:
+    start = time.perf_counter()
+    result = call()
+    return result, (time.perf_counter() - start) * 1000
+
+
+def _run_widget(call: Callable[[], Any]) -> Tuple[Any, float]:
+    # a fresh app context gives the widget its own g, and so its own read-only connection
+    _worker_state.active = True
+    try:
+        with app.app_context():
+            return _timed(call)
+    finally:
+        _worker_state.active = False
+
+
 class DashboardServices(BaseServices):
     model = None
     table_name = None
+    read_only = True
     MODEL_ALIAS_MAP = {**EncounterServices.MODEL_ALIAS_MAP,
                        User : 'u',
                        Disease: 'dis',
@@ -24,22 +130,269 @@ class DashboardServices(BaseServices):
                        EncounterServices: 'ecs'}
 
     @classmethod
+    def run_widgets(cls, widgets: Dict[str, Callable[[], Any]]) -> Dict[str, Any]:
+        '''
+        Run independent widget calls on DASHBOARD_WORKERS threads, each on its own read-only
+        connection (sqlite releases the GIL while a statement runs). Returns the results under
+        the same names; the time of each call in ms is added to g.widget_timings.
+        '''
+        workers = app.config.get('DASHBOARD_WORKERS', 1)
+        timings = g.setdefault('widget_timings', {})
+        results = {}
+        if (workers <= 1 or len(widgets) <= 1 or getattr(_worker_state, 'active', False)
+                or _is_memory_database(app.config['DATABASE'])):
+            for name, call in widgets.items():
+                results[name], timings[name] = _timed(call)
+            return results
+
+        executor = _widget_executor(workers)
+        futures = {name: executor.submit(_run_widget, call) for name, call in widgets.items()}
+        for name, future in futures.items():
+            results[name], timings[name] = future.result()
+        return results
+
+    @classmethod
+    def _encounter_source(cls, params: Params) -> Tuple[EncounterSource, Params]:
+        '''
+        Read from daily_encounter_rollup when every filter, grouping and sort in params is on a
+        rollup dimension or a table joined through one, otherwise from encounters.
+        '''
+        if not app.config.get('DASHBOARD_USE_ROLLUP') or not cls._table_exists('daily_encounter_rollup'):
+            return RAW_ENCOUNTERS, params
+
+        and_filter = []
+        for fil in params.and_filter:
+            if (fil.model is Encounter and fil.col == 'age' and fil.op.upper() == 'BETWEEN'
+                    and fil.value[0] <= 0 and fil.value[1] >= 120):
+                continue  # the whole age range filters nothing
+            and_filter.append(fil)
+
+        for fil in and_filter + list(params.or_filter):
+            if fil.model is None:
+                return RAW_ENCOUNTERS, params
+        for item in and_filter + list(params.or_filter + params.group_by + params.order_by):
+            if item.model is Encounter:
+                if item.col not in ROLLUP_COLUMNS:
+                    return RAW_ENCOUNTERS, params
+            elif item.model is not None and item.model not in ROLLUP_JOINS:
+                return RAW_ENCOUNTERS, params
+        return DAILY_ROLLUP, replace(params, _and_filter=tuple(and_filter))
+
+    @staticmethod
+    def _date_text(value) -> Optional[str]:
+        # date filter values as sqlite3 binds them, so they compare like the stored text
+        if isinstance(value, datetime):
+            return value.isoformat(' ')
+        if isinstance(value, date):
+            return value.isoformat()
+        return value if isinstance(value, str) else None
+
+    @classmethod
+    def _date_filters(cls, params: Params) -> Optional[List[Tuple[str, List[Optional[str]]]]]:
+        '''(op, values as text) of each AND filter on the encounter date, None when one is OR-ed'''
+        if any(fil.model is Encounter and fil.col == 'date' for fil in params.or_filter):
+            return None
+        # like FilterParser, a later AND filter on the same column and operator replaces the earlier one
+        filters = {(fil.col, fil.op): fil for fil in params.and_filter if fil.model is Encounter and fil.col == 'date'}
+        return [(fil.op.upper(), [cls._date_text(value) for value in
+                                  (fil.value if fil.op.upper() == 'BETWEEN' else (fil.value,))])
+                for fil in filters.values()]
+
+    @staticmethod
+    def _whole_month(month: str, date_filters) -> bool:
+        '''Whether every day of month passes the date filters'''
+        first = f'{month}-01'
+        last = (date.fromisoformat(first) + relativedelta(months=1, days=-1)).isoformat()
+        for op, values in date_filters:
+            if None in values:
+                return False
+            if op == 'BETWEEN':
+                whole = first >= values[0] and last <= values[1]
+            elif op in ('>=', '>'):
+                whole = first >= values[0] if op == '>=' else first > values[0]
+            elif op in ('<=', '<'):
+                whole = last <= values[0] if op == '<=' else last < values[0]
+            else:
+                whole = False
+            if not whole:
+                return False
+        return True
+
+    @staticmethod
+    def _date_span(date_filters) -> Tuple[Optional[str], Optional[str]]:
+        '''Earliest and latest date the filters let through, None where unbounded'''
+        low = high = None
+        for op, values in date_filters:
+            if None in values:
+                continue
+            if op in ('>=', '>', '=', 'BETWEEN'):
+                low = max(low or values[0], values[0])
+            if op in ('<=', '<', '=', 'BETWEEN'):
+                high = min(high or values[-1], values[-1])
+        return low, high
+
+    @classmethod
+    def _frozen_months(cls, date_filters, granularity: str) -> Dict[str, int]:
+        '''Closed months the date filters take whole, with the generation they were closed at'''
+        if (date_filters is None or granularity == 'week' or not app.config.get('DASHBOARD_FROZEN_MONTHS')
+                or not cls._table_exists('closed_months')):
+            return {}
+        rows = cls._connection().execute('SELECT month, generation FROM closed_months ORDER BY month')
+        return {row['month']: row['generation'] for row in rows if cls._whole_month(row['month'], date_filters)}
+
+    @staticmethod
+    def _month_ranges(months, outside: bool = False, span=(None, None)) -> Tuple[str, List[str]]:
+        '''
+        Condition on date for the days of months, and its arguments. With outside, for the other
+        days within span instead.
+        '''
+        runs = []
+        for month in sorted(months):
+            start = f'{month}-01'
+            end = (date.fromisoformat(start) + relativedelta(months=1)).isoformat()
+            if runs and runs[-1][1] == start:
+                runs[-1][1] = end
+            else:
+                runs.append([start, end])
+        if not outside:
+            return ' OR '.join(['(date >= ? AND date < ?)'] * len(runs)), [bound for run in runs for bound in run]
+
+        low, high = span
+        conditions = ['(date >= ? AND date < ?)'] * (len(runs) - 1)
+        args = [bound for run in runs for bound in run][1:-1]
+        conditions.insert(0, 'date < ?' if low is None else '(date >= ? AND date < ?)')
+        args[:0] = [runs[0][0]] if low is None else [low, runs[0][0]]
+        conditions.append('date >= ?' if high is None else '(date >= ? AND date <= ?)')
+        args += [runs[-1][1]] if high is None else [runs[-1][1], high]
+        return ' OR '.join(conditions), args
+
+    @staticmethod
+    def _month_period(month: str, granularity: str) -> str:
+        if granularity == 'quarter':
+            return f'{month[:4]}-Q{(int(month[5:7]) + 2) // 3}'
+        return month[:4] if granularity == 'year' else month
+
+    @classmethod
+    def _freeze(cls, db: sqlite3.Connection, query_key: str, generations: Dict[str, int],
+                by_month: Dict[str, Dict[Tuple, int]]):
+        # a month re-opened (or re-closed) since it was counted fails the generation check
+        with db:
+            for month, counts in by_month.items():
+                frozen = db.execute('''
+                INSERT OR REPLACE INTO frozen_month_queries(query_key, month, generation)
+                SELECT ?, month, generation FROM closed_months WHERE month = ? AND generation = ?
+                ''', (query_key, month, generations[month]))
+                if frozen.rowcount:
+                    db.executemany('INSERT OR REPLACE INTO frozen_month_counts VALUES (?, ?, ?, ?)',
+                                   [(query_key, month, json.dumps(group), count)
+                                    for group, count in counts.items()])
+
+    @classmethod
+    def _period_counts(cls, source: EncounterSource, params: Params, granularity: str,
+                       select: Callable[[EncounterSource, str], str], keys: Tuple[str, ...] = ()) -> Dict[Tuple, int]:
+        '''
+        Counts per (period, *keys) of the query select(source, bucket), with columns period,
+        keys and count, under params. Month, quarter and year periods take the closed months
+        the date filters cover whole from frozen_month_counts and count only the other months
+        live. Only freeze_closed_months writes the frozen counts, through g.frozen_month_writer.
+        '''
+        bucket = cls._trend_bucket(granularity)
+        grouped = params.group(None, 'period')
+        for key in keys:
+            grouped = grouped.group(None, key)
+
+        def count(period_bucket: str, months_sql: str = None, months_args: List = (), limit: str = '') -> Dict[Tuple, int]:
+            table = f'(SELECT * FROM {source.table} WHERE {months_sql}{limit})' if months_sql else source.table
+            query, args = cls._build_query(select(replace(source, table=table), period_bucket), grouped)
+            return {(row['period'], *(row[key] for key in keys)): row['count']
+                    for row in cls._connection().execute(query, list(months_args) + args)}
+
+        date_filters = cls._date_filters(params)
+        generations = cls._frozen_months(date_filters, granularity)
+        if not generations:
+            return count(bucket)
+
+        undated = replace(params, _and_filter=tuple(fil for fil in params.and_filter
+                                                    if not (fil.model is Encounter and fil.col == 'date')))
+        shape = select(EncounterSource('{table}', '{count}', '{weight}'), '{period}')
+        query_key = hashlib.sha1(pickle.dumps((shape, keys, undated.cache_key()))).hexdigest()
+        frozen: Dict[str, Dict[Tuple, int]] = {}
+        for row in cls._connection().execute('''
+        SELECT fq.month, fq.generation, fc.group_key, fc.count
+        FROM frozen_month_queries AS fq
+        LEFT JOIN frozen_month_counts AS fc ON fc.query_key = fq.query_key AND fc.month = fq.month
+        WHERE fq.query_key = ?
+        ''', (query_key,)):
+            if generations.get(row['month']) == row['generation']:
+                counts = frozen.setdefault(row['month'], {})
+                if row['group_key'] is not None:
+                    counts[tuple(json.loads(row['group_key']))] = row['count']
+
+        writer = g.get('frozen_month_writer')
+        missing = [month for month in generations if month not in frozen]
+        if writer is not None and missing:
+            by_month: Dict[str, Dict[Tuple, int]] = {month: {} for month in missing}
+            for (month, *group), value in count(TREND_BUCKETS['month'], *cls._month_ranges(missing)).items():
+                by_month[month][tuple(group)] = value
+            cls._freeze(writer, query_key, generations, by_month)
+            frozen.update(by_month)
+        if not frozen:
+            return count(bucket)
+
+        # LIMIT keeps SQLite from flattening the subquery, so the open month ranges pick the index
+        counts = count(bucket, *cls._month_ranges(frozen, True, cls._date_span(date_filters)), ' LIMIT -1')
+        for month, groups in frozen.items():
+            period = cls._month_period(month, granularity)
+            for group, value in groups.items():
+                counts[(period, *group)] = counts.get((period, *group), 0) + value
+        return counts
+
+    @classmethod
+    def freeze_closed_months(cls, db: sqlite3.Connection) -> int:
+        '''
+        Count and freeze, through db, the closed months the unfiltered trends and scheme series
+        have not frozen yet; `flask close-months` runs it after closing months. Returns how many
+        (query, month) counts are frozen afterwards.
+        '''
+        if not app.config.get('DASHBOARD_FROZEN_MONTHS') or not cls._table_exists('closed_months'):
+            return 0
+        first, last = db.execute('SELECT MIN(month), MAX(month) FROM closed_months').fetchone()
+        if first is None:
+            return 0
+        start_date = date.fromisoformat(f'{first}-01')
+        end_date = date.fromisoformat(f'{last}-01') + relativedelta(months=1, days=-1)
+        # past the result cache and the column engine, which would skip _period_counts
+        call = lambda method, *args: inspect.unwrap(method.__func__)(cls, Params(), *args)
+        g.frozen_month_writer = db
+        try:
+            for method in (cls.get_utilization_trend, cls.get_encounter_trend, cls.get_mortality_trend):
+                call(method, start_date, end_date, 'month')
+            for metric in ('utilization', 'mortality', 'encounters'):
+                call(cls.grouped_series, metric, 'month', 'scheme', start_date, end_date)
+        finally:
+            g.pop('frozen_month_writer', None)
+        return db.execute('SELECT COUNT(*) FROM frozen_month_queries').fetchone()[0]
+
+    @classmethod
+    @cached_result
+    @columnar('_top_encounter_facilities_columns')
     def get_top_encounter_facilities(cls, params: Params):
+        source, params = cls._encounter_source(params)
         query = f'''
         SELECT
             fc.name AS facility_name,
-            COUNT(ec.id) as encounter_count
-           FROM encounters as ec
+            {source.count} as encounter_count
+           FROM {source.table} as ec
            JOIN facility as fc on ec.facility_id = fc.id
           '''
 
         params = params.group(Facility, 'id')
         params = params.sort(None, 'encounter_count', 'DESC')
+        params = params.sort(Facility, 'name')
         if not params.limit:
             params = params.set_limit(5)
 
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(base_query=query, **res)
+        query, args = cls._build_query(query, params)
 
         return cls._run_query(query, args,
                               lambda row: {'facility_name': row['facility_name'],
@@ -47,13 +400,14 @@ class DashboardServices(BaseServices):
                                            })
 
     @classmethod
+    @cached_result
     def get_top_utilization_facilities(cls, params: Params):
         query = f'''
         SELECT
             fc.name AS facility_name,
             COUNT(DISTINCT ec.id) as encounter_count
         FROM encounters as ec
-        LEFT JOIN view_utilization_items as vui ON vui.encounter_id = ec.id
+        LEFT JOIN {cls._utilization_table()} as vui ON vui.encounter_id = ec.id
         JOIN facility as fc on ec.facility_id = fc.id
           '''
 
@@ -62,8 +416,7 @@ class DashboardServices(BaseServices):
         if not params.limit:
             params = params.set_limit(5)
 
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(base_query=query, **res)
+        query, args = cls._build_query(query, params)
 
         return cls._run_query(query, args,
                               lambda row: {'facility_name': row['facility_name'],
@@ -72,8 +425,12 @@ class DashboardServices(BaseServices):
 
     @classmethod
     def get_age_group(cls, query, args):
-        db = get_db()
+        db = cls._connection()
         rows = db.execute(query, args).fetchall()
+        return cls._fill_age_groups(rows)
+
+    @staticmethod
+    def _fill_age_groups(rows):
         age_group = [g.value for g in AgeGroup]
         used = set()
         result = []
@@ -97,14 +454,15 @@ class DashboardServices(BaseServices):
         return result
 
     @classmethod
+    @cached_result
     def top_utilized_items(cls,
                      params:Params):
 
-        query = '''
+        query = f'''
         SELECT
          vui.item_name || " (" || vui.item_type || ")" as disease_name,
          COUNT(*) as count
-        FROM view_utilization_items as vui
+        FROM {cls._utilization_table()} as vui
 
         JOIN encounters as ec on vui.encounter_id = ec.id
         JOIN facility as fc on fc.id = ec.facility_id
@@ -115,36 +473,40 @@ class DashboardServices(BaseServices):
         if not params.limit:
             params = params.set_limit(10)
 
-        res:Dict = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
+        query, args = cls._build_query(query, params)
 
         return cls._run_query(query,
                               args,
                               lambda row: {'disease_name': row['disease_name'], 'count': row['count']})
     @classmethod
+    @cached_result
+    @columnar('_gender_distribution_columns')
     def encounter_gender_distribution(cls,
                             params: Params):
-        query = '''
+        source, params = cls._encounter_source(params)
+        query = f'''
             SELECT
               CASE
                 WHEN ec.gender = 'M' THEN 'Male'
                 WHEN ec.gender = 'F' THEN 'Female'
               END as gender,
-            COUNT(ec.gender) as gender_count
-            FROM encounters AS ec
+            {source.count} as gender_count
+            FROM {source.table} AS ec
             JOIN facility as fc ON fc.id = ec.facility_id
         '''
         params = params.group(Encounter, 'gender')
         if not params.limit:
             params = params.set_limit(5)
 
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
+        query, args = cls._build_query(query, params)
 
         result =  cls._run_query(query,
                              args,
                              lambda row: {'gender': row['gender'], 'count': row['gender_count']})
+        return cls._fill_genders(result)
 
+    @staticmethod
+    def _fill_genders(result):
         gender = ['Male', 'Female']
         used_gender = set(row['gender'] for row in result)
         for row in gender:
@@ -155,139 +517,110 @@ class DashboardServices(BaseServices):
 
 
     @classmethod
+    @cached_result
+    @columnar('_age_group_distribution_columns')
     def encounter_age_group_distribution(cls,
                                params:Params):
 
-        query = '''
-            SELECT age_group, COUNT(*) as age_group_count
-            FROM encounters as ec
+        source, params = cls._encounter_source(params)
+        query = f'''
+            SELECT age_group, {source.count} as age_group_count
+            FROM {source.table} as ec
             JOIN facility as fc ON fc.id = ec.facility_id
         '''
 
         params = params.group(Encounter, 'age_group')
-        res  = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
+        query, args = cls._build_query(query, params)
 
         return cls.get_age_group(query, args)
 
     @classmethod
+    @cached_result
     def utilization_age_group_distribution(cls,
                                params:Params):
 
-        query = '''
+        query = f'''
             SELECT age_group, COUNT(*) as age_group_count
             FROM encounters as ec
-            LEFT JOIN  view_utilization_items as vui on vui.encounter_id = ec.id
+            LEFT JOIN  {cls._utilization_table()} as vui on vui.encounter_id = ec.id
             JOIN facility as fc ON fc.id = ec.facility_id
         '''
 
         params = params.group(Encounter, 'age_group')
-        res  = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
+        query, args = cls._build_query(query, params)
 
         return cls.get_age_group(query, args)
 
     @classmethod
-    def get_utilization_trend(cls, params: Params, start_date, end_date):
-        # ensure at least 6 months range
-        start_date = start_date.replace(day=1)
-        supposed_start = (end_date.replace(day=1) - relativedelta(months=6))
-        if start_date > supposed_start:
-            start_date = supposed_start
-
-        query = '''
-            SELECT ec.date, COUNT(*) AS date_count
-            FROM encounters AS ec
-            LEFT JOIN  view_utilization_items as vui on vui.encounter_id = ec.id
-            JOIN facility AS fc ON fc.id = ec.facility_id
-        '''
-
+    @cached_result
+    def get_utilization_trend(cls, params: Params, start_date, end_date, granularity: str = 'month'):
+        start_date = cls._trend_start(start_date, end_date)
         params = params.where(Encounter, 'date', '>=', start_date)
         params = params.where(Encounter, 'date', '<=', end_date)
-        params = params.group(Encounter, 'date')
-
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
-
-        db = get_db()
-        rows = db.execute(query, args).fetchall()
-        df = pd.DataFrame([dict(row) for row in rows])
-
-        if df.empty:
-            return pd.DataFrame(columns=['date', 'date_count']).to_json(orient="records")
-
-        df['date'] = pd.to_datetime(df['date'])
-        df['date'] = df['date'].dt.to_period('M')
 
-        trend = df.groupby('date')['date_count'].sum().reset_index()
-
-        # Fill missing months
-        all_months = pd.period_range(start=start_date, end=end_date, freq='M')
-        trend = trend.set_index('date').reindex(all_months, fill_value=0)
-        trend.index.name = 'date'
-        trend = trend.reset_index()
-
-        trend['date'] = trend['date'].astype(str)
-        trend.rename(columns={'date_count': 'count'})
-        return trend.to_dict(orient="records")
+        counts = cls._period_counts(RAW_ENCOUNTERS, params, granularity, lambda source, bucket: f'''
+            SELECT {bucket} AS period, COUNT(*) AS count
+            FROM {source.table} AS ec
+            LEFT JOIN  {cls._utilization_table()} as vui on vui.encounter_id = ec.id
+            JOIN facility AS fc ON fc.id = ec.facility_id
+        ''')
+        return cls._fill_trend({period: count for (period,), count in counts.items()},
+                               start_date, end_date, granularity)
 
-    @classmethod
-    def get_encounter_trend(cls, params: Params, start_date, end_date):
+    @staticmethod
+    def _trend_start(start_date, end_date):
         # ensure at least 6 months range
         start_date = start_date.replace(day=1)
         supposed_start = (end_date.replace(day=1) - relativedelta(months=6))
-        if start_date > supposed_start:
-            start_date = supposed_start
-
-        query = '''
-            SELECT ec.date, COUNT(*) AS date_count
-            FROM encounters AS ec
-            JOIN facility AS fc ON fc.id = ec.facility_id
-        '''
+        return min(start_date, supposed_start)
 
+    @classmethod
+    @cached_result
+    @columnar('_encounter_trend_columns')
+    def get_encounter_trend(cls, params: Params, start_date, end_date, granularity: str = 'month'):
+        start_date = cls._trend_start(start_date, end_date)
+        source, params = cls._encounter_source(params)
         params = params.where(Encounter, 'date', '>=', start_date)
         params = params.where(Encounter, 'date', '<=', end_date)
-        params = params.group(Encounter, 'date')
-
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
-
-        db = get_db()
-        rows = db.execute(query, args).fetchall()
-        df = pd.DataFrame([dict(row) for row in rows])
-
-        if df.empty:
-            return pd.DataFrame(columns=['date', 'date_count']).to_json(orient="records")
-
-        df['date'] = pd.to_datetime(df['date'])
-        df['date'] = df['date'].dt.to_period('M')
-
-        trend = df.groupby('date')['date_count'].sum().reset_index()
-
-        # Fill missing months
-        all_months = pd.period_range(start=start_date, end=end_date, freq='M')
-        trend = trend.set_index('date').reindex(all_months, fill_value=0)
-        trend.index.name = 'date'
-        trend = trend.reset_index()
 
-        trend['date'] = trend['date'].astype(str)
-        return trend.to_dict(orient='records')
+        counts = cls._period_counts(source, params, granularity, lambda source, bucket: f'''
+            SELECT {bucket} AS period, {source.count} AS count
+            FROM {source.table} AS ec
+            JOIN facility AS fc ON fc.id = ec.facility_id
+        ''')
+        return cls._fill_trend({period: count for (period,), count in counts.items()},
+                               start_date, end_date, granularity)
+
+    @staticmethod
+    def _trend_bucket(granularity: str) -> str:
+        if granularity not in TREND_BUCKETS:
+            raise QueryParameterError(f"Unknown trend granularity {granularity}")
+        return TREND_BUCKETS[granularity]
+
+    @staticmethod
+    def _fill_trend(counts: Dict[str, int], start_date, end_date, granularity: str = 'month') -> List[Dict]:
+        if not counts:
+            return []
+        return [{'date': period, 'date_count': counts.get(period, 0)}
+                for period in trend_periods(start_date, end_date, granularity)]
 
     @classmethod
+    @cached_result
+    @columnar('_per_scheme_columns')
     def get_encounter_per_scheme(cls, params: Params):
-        query = '''
+        source, params = cls._encounter_source(params)
+        query = f'''
         SELECT
-            COUNT(*) as encounter_count,
+            {source.count} as encounter_count,
             isc.scheme_name as encounter_scheme,
             isc.color_scheme as color_scheme
-        FROM encounters as ec
+        FROM {source.table} as ec
         JOIN insurance_scheme as isc on isc.id = ec.scheme
         JOIN facility as fc on ec.facility_id = fc.id
         '''
 
         params = params.group(Encounter, 'scheme')
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(base_query= query, **res)
+        query, args = cls._build_query(query, params)
         return cls._run_query(query=query,
                         params=args,
                         row_mapper = lambda row: {'scheme_name': row['encounter_scheme'],
@@ -297,21 +630,23 @@ class DashboardServices(BaseServices):
 
 
     @classmethod
+    @cached_result
+    @columnar('_mortality_per_scheme_columns')
     def get_mortality_per_scheme(cls, params: Params):
-        query = '''
+        source, params = cls._encounter_source(params)
+        query = f'''
         SELECT
-            COUNT(*) as encounter_count,
+            {source.count} as encounter_count,
             isc.scheme_name as encounter_scheme,
             isc.color_scheme as color_scheme
-        FROM encounters as ec
+        FROM {source.table} as ec
         JOIN insurance_scheme as isc on isc.id = ec.scheme
         JOIN facility as fc on ec.facility_id = fc.id
         JOIN treatment_outcome as tc on tc.id = ec.outcome
         '''
         params = params.where(TreatmentOutcome, 'type', '=', 'Death')
         params = params.group(Encounter, 'scheme')
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(base_query= query, **res)
+        query, args = cls._build_query(query, params)
         return cls._run_query(query=query,
                         params=args,
                         row_mapper = lambda row: {'scheme_name': row['encounter_scheme'],
@@ -319,40 +654,42 @@ class DashboardServices(BaseServices):
                                                   'count': row['encounter_count']}
                        )
     @classmethod
+    @cached_result
+    @columnar('_case_fatality_columns')
     def case_fatality(cls, params: Params):
-        query = '''
+        source, params = cls._encounter_source(params)
+        query = f'''
         SELECT
-            CASE WHEN COUNT(ec.id) = 0 THEN 0
+            CASE WHEN {source.count} = 0 THEN 0
             ELSE
-                (SUM(CASE WHEN LOWER(tc.type) = 'death' THEN 1 ELSE 0 END) * 1.0/
-                COUNT(ec.id)) * 100.0
+                (SUM(CASE WHEN LOWER(tc.type) = 'death' THEN {source.weight} ELSE 0 END) * 1.0/
+                {source.count}) * 100.0
             END as fatality_count
-        FROM encounters as ec
+        FROM {source.table} as ec
         JOIN facility as fc on ec.facility_id = fc.id
         JOIN treatment_outcome as tc on tc.id = ec.outcome
         '''
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
-        db = get_db()
+        query, args = cls._build_query(query, params)
+        db = cls._connection()
         row = db.execute(query, args).fetchone()
         return row['fatality_count'] if row else 0.0
 
     @classmethod
+    @cached_result
     def get_utilization_per_scheme(cls, params: Params):
-        query = '''
+        query = f'''
         SELECT
             COUNT(*) as encounter_count,
             isc.scheme_name as encounter_scheme,
             isc.color_scheme as color_scheme
         FROM encounters as ec
-        LEFT JOIN  view_utilization_items as vui on vui.encounter_id = ec.id
+        LEFT JOIN  {cls._utilization_table()} as vui on vui.encounter_id = ec.id
         JOIN insurance_scheme as isc on isc.id = ec.scheme
         JOIN facility as fc on ec.facility_id = fc.id
         '''
 
         params = params.group(Encounter, 'scheme')
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(base_query= query, **res)
+        query, args = cls._build_query(query, params)
         return cls._run_query(query=query,
                         params=args,
                         row_mapper = lambda row: {'scheme_name': row['encounter_scheme'],
@@ -360,60 +697,65 @@ class DashboardServices(BaseServices):
                                                   'count': row['encounter_count']}
                        )
     @classmethod
+    @cached_result
+    @columnar('_treatment_outcome_distribution_columns')
     def get_treatment_outcome_distribution(cls, params: Params):
-        inner_query = '''
+        source, params = cls._encounter_source(params)
+        inner_query = f'''
         SELECT
-            CASE WHEN tc.type = 'Death' THEN 'Death' ELSE tc.name END AS outcome
-        FROM encounters AS ec
+            CASE WHEN tc.type = 'Death' THEN 'Death' ELSE tc.name END AS outcome,
+            {source.weight} AS encounter_weight
+        FROM {source.table} AS ec
         JOIN facility as fc on fc.id = ec.facility_id
         JOIN treatment_outcome AS tc ON tc.id = ec.outcome
         '''
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(base_query = inner_query, **res)
-        new_query = f'SELECT outcome, COUNT(*) as outcome_count FROM ({query}) GROUP BY outcome'
+        query, args = cls._build_query(inner_query, params)
+        new_query = f'SELECT outcome, SUM(encounter_weight) as outcome_count FROM ({query}) GROUP BY outcome'
         return cls._run_query(query =new_query,
                       params = args,
                       row_mapper = lambda row: {'outcome': row['outcome'],
                                                 'count': row['outcome_count']})
 
     @classmethod
+    @cached_result
+    @columnar('_referral_count_columns')
     def get_referral_count(cls, params: Params):
-        query = '''
+        source, params = cls._encounter_source(params)
+        query = f'''
         SELECT
-            COUNT(*) as referral_count
-        FROM encounters as ec
+            {source.count} as referral_count
+        FROM {source.table} as ec
         JOIN facility as fc on fc.id = ec.facility_id
         JOIN treatment_outcome as tc on tc.id = ec.outcome
         '''
         params = params.where(TreatmentOutcome, 'name', '=', 'Referral')
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args =  cls._apply_filter(query, **res)
-        db = get_db()
+        query, args = cls._build_query(query, params)
+        db = cls._connection()
         row = db.execute(query, args).fetchone()
         return row['referral_count'] if row else 0
 
 
     @classmethod
+    @cached_result
     def get_total_utilization(cls, params: Params, start_date, end_date):
         diff = end_date - start_date
         prev_start_date = start_date - diff
         prev_end_date = start_date - timedelta(days=1)
 
-        query = '''
+        query = f'''
         SELECT
             COALESCE(SUM(CASE WHEN ec.date BETWEEN ? AND ? THEN 1 ELSE 0 END), 0) AS current_count,
             COALESCE(SUM(CASE WHEN ec.date BETWEEN ? AND ? THEN 1 ELSE 0 END), 0) AS prev_count
         FROM encounters AS ec
-        LEFT JOIN  view_utilization_items as vui on vui.encounter_id = ec.id
+        LEFT JOIN  {cls._utilization_table()} as vui on vui.encounter_id = ec.id
         JOIN facility AS fc ON fc.id = ec.facility_id
         '''
 
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, filter_args = cls._apply_filter(query, **res)
+        query, filter_args = cls._build_query(query, params)
 
         args = [start_date, end_date, prev_start_date, prev_end_date] + filter_args
 
-        db = get_db()
+        db = cls._connection()
         row = db.execute(query, args).fetchone()
         current = row['current_count'] if row else 0
         prev = row['prev_count'] if row else 0
@@ -427,30 +769,38 @@ class DashboardServices(BaseServices):
         return current, pct_change
 
 
+    @staticmethod
+    def _previous_period(start_date, end_date):
+        diff = end_date - start_date
+        return start_date - diff, start_date - timedelta(days=1)
+
     @classmethod
+    @cached_result
+    @columnar('_total_encounters_columns')
     def get_total_encounters(cls, params: Params, start_date, end_date):
-        diff = end_date - start_date
-        prev_start_date = start_date - diff
-        prev_end_date = start_date - timedelta(days=1)
+        prev_start_date, prev_end_date = cls._previous_period(start_date, end_date)
 
-        query = '''
+        source, params = cls._encounter_source(params)
+        query = f'''
         SELECT
-            COALESCE(SUM(CASE WHEN ec.date BETWEEN ? AND ? THEN 1 ELSE 0 END), 0) AS current_count,
-            COALESCE(SUM(CASE WHEN ec.date BETWEEN ? AND ? THEN 1 ELSE 0 END), 0) AS prev_count
-        FROM encounters AS ec
+            COALESCE(SUM(CASE WHEN ec.date BETWEEN ? AND ? THEN {source.weight} ELSE 0 END), 0) AS current_count,
+            COALESCE(SUM(CASE WHEN ec.date BETWEEN ? AND ? THEN {source.weight} ELSE 0 END), 0) AS prev_count
+        FROM {source.table} AS ec
         JOIN facility AS fc ON fc.id = ec.facility_id
         '''
 
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, filter_args = cls._apply_filter(query, **res)
+        query, filter_args = cls._build_query(query, params)
 
         args = [start_date, end_date, prev_start_date, prev_end_date] + filter_args
 
-        db = get_db()
+        db = cls._connection()
         row = db.execute(query, args).fetchone()
         current = row['current_count'] if row else 0
         prev = row['prev_count'] if row else 0
+        return cls._period_change(current, prev)
 
+    @staticmethod
+    def _period_change(current, prev):
         pct_change = 0.0
         if prev:
             pct_change = ((current - prev) / prev) * 100
@@ -461,20 +811,26 @@ class DashboardServices(BaseServices):
 
 
     @classmethod
+    @cached_result
+    @columnar('_lga_distribution_columns')
     def encounter_distribution_across_lga(cls, params: Params):
-        query = '''
+        source, params = cls._encounter_source(params)
+        query = f'''
         SELECT
             fc.local_government as lga,
-            COUNT(*) as count
-        FROM encounters as ec
+            {source.count} as count
+        FROM {source.table} as ec
         JOIN facility as fc on fc.id = ec.facility_id
         '''
         params = params.group(Facility, 'local_government')
         params = params.sort(None, 'count', 'DESC')
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
-        db = get_db()
+        query, args = cls._build_query(query, params)
+        db = cls._connection()
         rows = db.execute(query, args).fetchall()
+        return cls._lga_counts(rows)
+
+    @staticmethod
+    def _lga_counts(rows):
         result = dict.fromkeys([x.upper() for x in ONDO_LGAS_LOWER], 0)
         for row in rows:
             result[row['lga'].upper()] = row['count']
@@ -482,21 +838,25 @@ class DashboardServices(BaseServices):
 
 
     @classmethod
+    @cached_result
     def utilization_distribution_across_lga(cls, params: Params):
-        query = '''
+        query = f'''
         SELECT
             fc.local_government as lga,
             COUNT(*) as count
         FROM encounters as ec
-        LEFT JOIN  view_utilization_items as vui on vui.encounter_id = ec.id
+        LEFT JOIN  {cls._utilization_table()} as vui on vui.encounter_id = ec.id
         JOIN facility as fc on fc.id = ec.facility_id
         '''
         params = params.group(Facility, 'local_government')
         params = params.sort(Facility, 'local_government', 'DESC')
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
-        db = get_db()
+        query, args = cls._build_query(query, params)
+        db = cls._connection()
         rows = db.execute(query, args).fetchall()
+        return cls._lga_counts(rows)
+
+    @staticmethod
+    def _lga_counts(rows):
         result = dict.fromkeys([x.upper() for x in ONDO_LGAS_LOWER], 0)
         for row in rows:
             result[row['lga'].upper()] = row['count']
@@ -504,93 +864,109 @@ class DashboardServices(BaseServices):
 
 
     @classmethod
-    def total_utilization_by_scheme_grouped(cls, params: Params, start_date, end_date):
-        query = '''
-        SELECT
-            ec.date,
-            isc.scheme_name,
-            isc.color_scheme
-        FROM encounters as ec
-        LEFT JOIN  view_utilization_items as vui on vui.encounter_id = ec.id
-        JOIN insurance_scheme as isc on isc.id = ec.scheme
-        JOIN facility as fc on fc.id = ec.facility_id
+    def _series_source(cls, params: Params, metric: str) -> Tuple[EncounterSource, str, Params]:
+        '''Source of a series metric, the joins it needs and params with its own filters'''
+        if metric == 'utilization':
+            # encounters without recorded items still count once
+            return RAW_ENCOUNTERS, f'LEFT JOIN {cls._utilization_table()} AS vui ON vui.encounter_id = ec.id', params
+        if metric not in SERIES_METRICS:
+            raise QueryParameterError(f"Unknown series metric {metric}")
+        outcome_join = ''
+        if metric == 'mortality':
+            params = params.where(TreatmentOutcome, 'type', '=', 'Death')
+            outcome_join = 'JOIN treatment_outcome AS tc ON tc.id = ec.outcome'
+        source, params = cls._encounter_source(params)
+        return source, outcome_join, params
+
+    @classmethod
+    @cached_result
+    def grouped_series(cls, params: Params, metric: str, time_bucket: str, dimension: str,
+                       start_date, end_date) -> List[Dict]:
+        '''
+        Count of metric ('encounters', 'mortality' or 'utilization') per time_bucket
+        (week, month, quarter or year) and dimension (scheme, lga or facility) between
+        start_date and end_date. Every value of the dimension seen in the range gets a row
+        for every period, zero when it has none, ordered by period and then by the period
+        the value first appears in.
         '''
-        if (end_date - start_date).days < (365 * 5): #minumum of 5 display years
-            # print("In here")
-            start_date = end_date.replace(day=1, month=1, year = end_date.year - 5)
+        if dimension not in SERIES_DIMENSIONS:
+            raise QueryParameterError(f"Unknown series dimension {dimension}")
+        columns = SERIES_DIMENSIONS[dimension]
+        keys = tuple(key for _, key in columns)
 
         params = params.where(Encounter, 'date', 'BETWEEN', (start_date, end_date))
-        # params = params.group(Encounter, 'date').group(InsuranceScheme, 'scheme_name')\
-                # .group(InsuranceScheme, 'color_scheme')
-
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
-
-        db = get_db()
-        rows = db.execute(query, args).fetchall()
-        df = pd.DataFrame([dict(row) for row in rows])
-        if df.empty:
-            return {}
+        source, joins, params = cls._series_source(params, metric)
+        counts = cls._period_counts(source, params, time_bucket, lambda source, bucket: f'''
+        SELECT {bucket} AS period, {', '.join(f'{expr} AS {key}' for expr, key in columns)},
+               {source.count} AS count
+        FROM {source.table} AS ec
+        {joins}
+        JOIN facility AS fc ON fc.id = ec.facility_id
+        JOIN insurance_scheme AS isc ON isc.id = ec.scheme
+        ''', keys)
+
+        first_period: Dict[Tuple, str] = {}
+        for period, *values in counts:
+            first_period[tuple(values)] = min(period, first_period.get(tuple(values), period))
+        # as SQLite orders the keys: NULL first, then text by code point
+        series = sorted(first_period, key=lambda values: (first_period[values],
+                                                          [(value is not None, value) for value in values]))
+        return [{'date': period, **dict(zip(keys, values)), 'count': counts.get((period, *values), 0)}
+                for period in trend_periods(start_date, end_date, time_bucket) for values in series]
 
-        df['date'] =  pd.to_datetime(df['date'])
-        df['date'] = df['date'].dt.to_period('Y')
-        df.sort_values('date')
-        df = df.groupby(['date', 'scheme_name', 'color_scheme']).size().reset_index(name='count')
-        all_schemes = df[['scheme_name', 'color_scheme']].drop_duplicates()
-        all_years = pd.period_range(start_date, end_date, freq='Y')
-        full_index = []
-        for year in all_years:
-            for scheme in all_schemes.itertuples(name=None, index=False):
-                full_index.append((year, *scheme))
-        df = (
-            df.set_index(['date', 'scheme_name', 'color_scheme'])
-            .reindex(full_index, fill_value=0)
-            .reset_index()
-        )
-        df['date'] = df['date'].astype('str')
-        return df.to_dict(orient="records")
+    @classmethod
+    @cached_result
+    def total_utilization_by_scheme_grouped(cls, params: Params, start_date, end_date):
+        if (end_date - start_date).days < 365 * 5: # minimum of 5 display years
+            start_date = end_date.replace(year = end_date.year - 5, day = 1, month = 1)
+        return cls.grouped_series(params, 'utilization', 'year', 'scheme', start_date, end_date) or {}
 
     @classmethod
+    @cached_result
+    @columnar('_mortality_by_type_columns')
     def mortality_distribution_by_type(cls, params: Params):
-        query = '''
+        source, params = cls._encounter_source(params)
+        query = f'''
         SELECT
             tc.name,
-            COUNT(*) as count
-        FROM encounters as ec
+            {source.count} as count
+        FROM {source.table} as ec
         JOIN facility as fc ON ec.facility_id = fc.id
         JOIN treatment_outcome as tc on tc.id = ec.outcome
         '''
         params = params.where(TreatmentOutcome, 'type', '=', 'Death')
         params = params.group(TreatmentOutcome, 'name')
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
+        query, args = cls._build_query(query, params)
         return cls._run_query(query, args,
                             lambda row: {'death_type': row['name'], 'count': row['count']})
 
     @classmethod
+    @cached_result
+    @columnar('_mortality_by_age_group_columns')
     def mortality_distribution_by_age_group(cls, params: Params):
-        query = '''
+        source, params = cls._encounter_source(params)
+        query = f'''
         SELECT
             ec.age_group,
-            COUNT(*) as age_group_count
-        FROM encounters as ec
+            {source.count} as age_group_count
+        FROM {source.table} as ec
         JOIN facility as fc ON ec.facility_id = fc.id
         JOIN treatment_outcome as tc on tc.id = ec.outcome
         '''
         params = params.group(Encounter, 'age_group')
         params = params.where(TreatmentOutcome, 'type', '=', 'Death')
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
+        query, args = cls._build_query(query, params)
 
         return cls.get_age_group(query, args)
 
     @classmethod
+    @cached_result
     def get_top_cause_of_mortality(cls, params: Params):
-        query = '''
+        query = f'''
         SELECT
          vui.item_name || " (" || vui.item_type || ")" as cause_name,
          COUNT(*) as count
-        FROM view_utilization_items as vui
+        FROM {cls._utilization_table()} as vui
         JOIN encounters as ec on vui.encounter_id = ec.id
         JOIN facility as fc on fc.id = ec.facility_id
         JOIN treatment_outcome as tc on tc.id = ec.outcome
@@ -602,28 +978,29 @@ class DashboardServices(BaseServices):
         if not params.limit:
             params = params.set_limit(10)
 
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
+        query, args = cls._build_query(query, params)
         return cls._run_query(query, args,
                               lambda row: {'name': row['cause_name'], 'count': row['count']})
 
     @classmethod
+    @cached_result
+    @columnar('_mortality_by_gender_columns')
     def get_mortality_distribution_by_gender(cls, params: Params):
-        query = '''
+        source, params = cls._encounter_source(params)
+        query = f'''
         SELECT
             CASE
                 WHEN ec.gender = 'M' THEN 'Male'
                 WHEN ec.gender = 'F' THEN 'Female'
             END as gender,
-            COUNT(ec.id) as count
-        FROM encounters as ec
+            {source.count} as count
+        FROM {source.table} as ec
         JOIN facility as fc on fc.id = ec.facility_id
         JOIN treatment_outcome as tc on tc.id = ec.outcome
         '''
         params = params.where(TreatmentOutcome, 'type', '=', 'Death')
         params = params.group(Encounter, 'gender')
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
+        query, args = cls._build_query(query, params)
         result =  cls._run_query(query,
                              args,
                              lambda row: {'gender': row['gender'], 'count': row['count']})
@@ -637,186 +1014,108 @@ class DashboardServices(BaseServices):
         return result
 
     @classmethod
+    @cached_result
     def total_mortality_by_scheme_grouped(cls, params: Params, start_date, end_date):
-        query = '''
-        SELECT
-            ec.date ,
-            isc.scheme_name,
-            isc.color_scheme
-        FROM encounters as ec
-        JOIN insurance_scheme as isc on isc.id = ec.scheme
-        JOIN facility as fc on fc.id = ec.facility_id
-        JOIN treatment_outcome as tc on tc.id = ec.outcome
-        '''
-        if (end_date - start_date).days < 365 * 5:
+        if (end_date - start_date).days < 365 * 5: # minimum of 5 display years
             start_date = end_date.replace(year = end_date.year - 5, day = 1, month = 1)
-        params = params.where(Encounter, 'date', 'BETWEEN', (start_date, end_date))
-        params = params.where(TreatmentOutcome, 'type', '=', 'Death')
-        # print("Params: ", params)
-
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
-
-        db = get_db()
-        rows = db.execute(query, args).fetchall()
-        df = pd.DataFrame([dict(row) for row in rows])
-        if df.empty:
-            return {}
-        df['date'] =  pd.to_datetime(df['date'])
-        df['date'] = df['date'].dt.to_period('Y')
-        df.sort_values('date')
-        df = df.groupby(['date', 'scheme_name', 'color_scheme']).size().reset_index(name='count')
-        all_schemes = df[['scheme_name', 'color_scheme']].drop_duplicates()
-        all_years = pd.period_range(start_date, end_date, freq='Y')
-        full_index = []
-        for year in all_years:
-            for scheme in all_schemes.itertuples(name=None, index=False):
-                full_index.append((year, *scheme))
-        df = (
-            df.set_index(['date', 'scheme_name', 'color_scheme'])
-            .reindex(full_index, fill_value=0)
-            .reset_index()
-        )
-        df['date'] = df['date'].astype('str')
-        return df.to_dict(orient='records')
-
-
+        return cls.grouped_series(params, 'mortality', 'year', 'scheme', start_date, end_date) or {}
 
     @classmethod
+    @cached_result
     def total_encounter_by_scheme_grouped(cls, params: Params, start_date, end_date):
-        query = '''
-        SELECT
-            ec.date,
-            isc.scheme_name,
-            isc.color_scheme
-        FROM encounters as ec
-        JOIN insurance_scheme as isc on isc.id = ec.scheme
-        JOIN facility as fc on fc.id = ec.facility_id
-        '''
-        if (end_date - start_date).days < 365 * 5:
+        if (end_date - start_date).days < 365 * 5: # minimum of 5 display years
             start_date = end_date.replace(year = end_date.year - 5, day = 1, month = 1)
-        params = params.where(Encounter, 'date', 'BETWEEN', (start_date, end_date))
-        # params = params.group(Encounter, 'date').group(InsuranceScheme, 'scheme_name')\
-                # .group(InsuranceScheme, 'color_scheme')
-
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
-
-        db = get_db()
-        rows = db.execute(query, args).fetchall()
-        df = pd.DataFrame([dict(row) for row in rows])
-        if df.empty:
-            return  {}
-
-        df['date'] =  pd.to_datetime(df['date'])
-        df['date'] = df['date'].dt.to_period('Y')
-        df.sort_values('date')
-        df = df.groupby(['date', 'scheme_name', 'color_scheme']).size().reset_index(name='count')
-        all_schemes = df[['scheme_name', 'color_scheme']].drop_duplicates()
-        all_years = pd.period_range(start_date, end_date, freq='Y')
-        full_index = []
-        for year in all_years:
-            for scheme in all_schemes.itertuples(name=None, index=False):
-                full_index.append((year, *scheme))
-        df = (
-            df.set_index(['date', 'scheme_name', 'color_scheme'])
-            .reindex(full_index, fill_value=0)
-            .reset_index()
-        )
-        df['date'] = df['date'].astype('str')
-        return df.to_dict(orient='records')
+        return cls.grouped_series(params, 'encounters', 'year', 'scheme', start_date, end_date) or {}
 
     @classmethod
+    @cached_result
+    @columnar('_mortality_per_facility_columns')
     def get_mortality_count_per_facility(cls, params: Params):
-        query = '''
+        source, params = cls._encounter_source(params)
+        query = f'''
             SELECT
                 fc.name as facility_name,
-                COUNT(*) as count
-            FROM encounters as ec
+                {source.count} as count
+            FROM {source.table} as ec
             JOIN facility as fc on ec.facility_id = fc.id
             JOIN treatment_outcome as tc on tc.id = ec.outcome
         '''
         params = params.where(TreatmentOutcome, 'type', '=', 'Death')
         params = params.group(Facility, 'id')
         params = params.sort(None, 'count', 'desc')
+        params = params.sort(Facility, 'name')
         if not params.limit:
             params = params.set_limit(10)
 
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
+        query, args = cls._build_query(query, params)
         return cls._run_query(query,
                               args,
                               lambda row: {'facility_name': row['facility_name'],
                                             'count': row['count']})
 
     @classmethod
-    def get_mortality_trend(cls, params: Params, start_date, end_date):
-        query = '''
+    @cached_result
+    @columnar('_mortality_trend_columns')
+    def get_mortality_trend(cls, params: Params, start_date, end_date, granularity: str = 'month'):
+        start_date = cls._mortality_trend_start(start_date, end_date)
+        source, params = cls._encounter_source(params)
+        params = params.where(TreatmentOutcome, 'type', '=', 'Death')
+        params = params.where(Encounter, 'date', 'BETWEEN', (start_date, end_date))
+
+        counts = cls._period_counts(source, params, granularity, lambda source, bucket: f'''
         SELECT
-            ec.date,
+            {bucket} AS period,
             tc.name as death_type,
-            COUNT(ec.id) as death_count
-        FROM encounters as ec
+            {source.count} as count
+        FROM {source.table} as ec
         JOIN facility as fc on fc.id = ec.facility_id
         JOIN treatment_outcome as tc on tc.id = ec.outcome
-        '''
-        if (end_date - start_date).days < 30 * 6:
-            print("In mortality trend, adjusting start date")
-            start_date = end_date.replace(day = 1) - relativedelta(months=6)
-            print(start_date)
-        params = params.where(TreatmentOutcome, 'type', '=', 'Death')
-        params = params.where(Encounter, 'date', 'BETWEEN', (start_date, end_date))
-        params = params.group(Encounter, 'date')
-        params = params.group(TreatmentOutcome, 'name')
-        print("In mortality trend: params: ", params)
-
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        print("Mortality trend res: ", res)
-        query, args = cls._apply_filter(query, **res)
-        print("Mortality trend query: ", query)
-        db = get_db()
-        rows = db.execute(query, args).fetchall()
-        df = pd.DataFrame([dict(row) for row in rows])
-        if df.empty:
+        ''', keys=('death_type',))
+        if not counts:
             return {}
 
-        df['date'] = pd.to_datetime(df['date'])
-        df['date'] = df['date'].dt.to_period(freq='M')
+        db = cls._connection()
         rows =  db.execute('SELECT tc.name  as death_type from \
                                   treatment_outcome as tc where tc.type = "Death"').fetchall()
-        death_type = [ row['death_type'] for row in rows]
-        all_month = list(set(pd.period_range(start=start_date, end=end_date, freq='M')))
-        df = df.groupby(['date', 'death_type'], as_index=False)['death_count'].sum()
-        df = df.set_index(['date', 'death_type'])
-        df = df.reindex(pd.MultiIndex.from_product([all_month, death_type], names = ['date', 'death_type']),
-                        fill_value=0).reset_index()
-        df.date = df.date.astype(str)
-        pivot = df.pivot_table(
-            index = 'date',
-            columns = 'death_type',
-            values= 'death_count',\
-            aggfunc= 'sum',
-        ).reset_index()
-        pivot['total'] = pivot.drop('date', axis=1).sum(axis=1)
-        return pivot.to_dict(orient='records')
+        return cls._fill_mortality_trend(counts, [row['death_type'] for row in rows],
+                                         start_date, end_date, granularity)
+
+    @staticmethod
+    def _mortality_trend_start(start_date, end_date):
+        if (end_date - start_date).days < 30 * 6:
+            return end_date.replace(day = 1) - relativedelta(months=6)
+        return start_date
+
+    @staticmethod
+    def _fill_mortality_trend(counts, death_types, start_date, end_date, granularity):
+        death_type = sorted(set(death_types))
+        result = []
+        for period in trend_periods(start_date, end_date, granularity):
+            entry = {'date': period}
+            entry.update((name, counts.get((period, name), 0)) for name in death_type)
+            entry['total'] = sum(entry[name] for name in death_type)
+            result.append(entry)
+        return result
 
 
     @classmethod
+    @cached_result
+    @columnar('_mortality_by_lga_columns')
     def get_mortality_by_lga(cls, params: Params):
-        query = '''
+        source, params = cls._encounter_source(params)
+        query = f'''
         SELECT
             fc.local_government as lga,
-            COUNT(*) as count
-        FROM encounters as ec
+            {source.count} as count
+        FROM {source.table} as ec
         JOIN facility as fc on ec.facility_id = fc.id
         JOIN treatment_outcome as tc on tc.id = ec.outcome
         '''
         params = params.where(TreatmentOutcome, 'type', '=', 'Death')
         params = params.group(Facility, 'local_government')
         params = params.sort(None, 'count', 'DESC')
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
-        db = get_db()
+        query, args = cls._build_query(query, params)
+        db = cls._connection()
         rows = db.execute(query, args)
         result = dict.fromkeys([lga.upper() for lga in ONDO_LGAS_LOWER], 0)
         for row in rows:
@@ -824,92 +1123,98 @@ class DashboardServices(BaseServices):
         return sorted([{'lga': key, 'count': value} for key, value in result.items()], key= lambda row: row['count'])
 
     @classmethod
+    @cached_result
+    @columnar('_average_mortality_per_day_columns')
     def get_average_mortality_per_day(cls, params: Params, start_date, end_date):
-        query = '''
+        source, params = cls._encounter_source(params)
+        query = f'''
         SELECT
             CASE WHEN COUNT(DISTINCT ec.date) = 0 THEN 0
-            ELSE COUNT(*) * 1.0/ COUNT(DISTINCT ec.date)
+            ELSE {source.count} * 1.0/ COUNT(DISTINCT ec.date)
             END as count
-        FROM encounters as ec
+        FROM {source.table} as ec
         JOIN facility as fc on fc.id = ec.facility_id
         JOIN treatment_outcome as tc on tc.id = ec.outcome
         '''
         params = params.where(Encounter, 'date', '>=', start_date)\
                         .where(Encounter, 'date', "<=", end_date)
         params = params.where(TreatmentOutcome, 'type', '=', 'Death')
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
-        db = get_db()
+        query, args = cls._build_query(query, params)
+        db = cls._connection()
         row = db.execute(query, args).fetchone()
         res = row['count'] if row else 0
         return res or 0
 
     @classmethod
+    @cached_result
+    @columnar('_average_encounter_per_day_columns')
     def get_average_encounter_per_day(cls, params: Params, start_date, end_date):
-        query = '''
+        source, params = cls._encounter_source(params)
+        query = f'''
         SELECT
             CASE WHEN COUNT(DISTINCT ec.date) = 0 THEN 0
-            ELSE COUNT(*) * 1.0/ COUNT(DISTINCT ec.date)
+            ELSE {source.count} * 1.0/ COUNT(DISTINCT ec.date)
             END as count
-        FROM encounters as ec
+        FROM {source.table} as ec
         JOIN facility as fc on fc.id = ec.facility_id
         '''
         params = params.where(Encounter, 'date', '>=', start_date)\
                         .where(Encounter, 'date', "<=", end_date)
 
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
-        db = get_db()
+        query, args = cls._build_query(query, params)
+        db = cls._connection()
         row = db.execute(query, args).fetchone()
         res = row['count'] if row else 0
         return res or 0
 
 
     @classmethod
+    @cached_result
     def get_average_utilization_per_day(cls, params: Params, start_date, end_date):
-        query = '''
+        query = f'''
         SELECT
             CASE WHEN COUNT(DISTINCT ec.date) = 0 THEN 0
             ELSE COUNT(*) * 1.0/ COUNT(DISTINCT ec.date)
             END as count
         FROM encounters as ec
         JOIN facility as fc on fc.id = ec.facility_id
-        LEFT JOIN view_utilization_items as vui on ec.id =  vui.encounter_id
+        LEFT JOIN {cls._utilization_table()} as vui on ec.id =  vui.encounter_id
         '''
         params = params.where(Encounter, 'date', '>=', start_date)\
                         .where(Encounter, 'date', "<=", end_date)
 
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
+        query, args = cls._build_query(query, params)
 
-        db = get_db()
+        db = cls._connection()
         row = db.execute(query, args).fetchone()
         res = row['count'] if row else 0
         return res or 0
 
     @classmethod
+    @cached_result
     def get_service_utilization_rate(cls, params: Params, start_date: date, end_date: date):
-        query = '''
+        query = f'''
         SELECT
             CASE WHEN COUNT(DISTINCT ec.id) = 0 THEN 0
             ELSE ((COUNT(DISTINCT ec.id) * 1.0) /COUNT(*)) *100
             END AS rate
         FROM encounters as ec
         JOIN facility as fc on fc.id = ec.facility_id
-        LEFT JOIN view_utilization_items as vui on ec.id =  vui.encounter_id
+        LEFT JOIN {cls._utilization_table()} as vui on ec.id =  vui.encounter_id
         '''
         params = params.where(Encounter, 'date', '>=', start_date)\
                         .where(Encounter, 'date', "<=", end_date)
 
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
-        db = get_db()
+        query, args = cls._build_query(query, params)
+        db = cls._connection()
         row = db.execute(query, args).fetchone()
 
         res = row['rate'] if row else 0
         return res or 0
 
     @classmethod
+    @cached_result
+    @columnar('_total_death_outcome_columns')
     def get_total_death_outcome(cls, params: Params, start_date: date, end_date: date):
         ''''
         Return total death outcome and the percentage difference based on the prevous month
@@ -919,20 +1224,20 @@ class DashboardServices(BaseServices):
         diff = end_date - start_date
         prev_start_date = start_date - diff
         prev_end_date = start_date - timedelta(days=1)
-        query = '''
+        source, params = cls._encounter_source(params)
+        query = f'''
         SELECT
-            COALESCE(SUM(CASE WHEN ec.date >= ? and ec.date <= ? THEN 1 ELSE 0 END), 0)  as prev_count,
-            COALESCE(SUM(CASE WHEN ec.date >= ? and ec.date <= ? THEN 1 ELSE 0 END), 0)  as current_count
-        FROM encounters as ec
+            COALESCE(SUM(CASE WHEN ec.date >= ? and ec.date <= ? THEN {source.weight} ELSE 0 END), 0)  as prev_count,
+            COALESCE(SUM(CASE WHEN ec.date >= ? and ec.date <= ? THEN {source.weight} ELSE 0 END), 0)  as current_count
+        FROM {source.table} as ec
         JOIN facility as fc on ec.facility_id = fc.id
         JOIN treatment_outcome as tc on ec.outcome = tc.id
         '''
         params = params.where(TreatmentOutcome, 'type', '=', 'Death')
-        db = get_db()
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
+        db = cls._connection()
 
 
-        query, args = cls._apply_filter(base_query= query, **res)
+        query, args = cls._build_query(query, params)
         args = [prev_start_date, prev_end_date, start_date, end_date] + args
         row = db.execute(query, args).fetchone()
 
@@ -948,52 +1253,386 @@ class DashboardServices(BaseServices):
 
 
     @classmethod
+    @cached_result
+    @columnar('_active_facility_columns')
     def get_active_encounter_facility(cls, params: Params):
-        query = '''
+        source, params = cls._encounter_source(params)
+        query = f'''
         SELECT
             COUNT (DISTINCT fc.id) as facility_count
-        FROM encounters as ec
+        FROM {source.table} as ec
         JOIN facility as fc on fc.id = ec.facility_id
         '''
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query, **res)
-        db = get_db()
+        query, args = cls._build_query(query, params)
+        db = cls._connection()
         row = db.execute(query, args).fetchone()
         return row['facility_count'] if row else 0
 
     @classmethod
+    @cached_result
     def get_top_facilities_summaries(cls, params: Params, start_date, end_date,):
-        query = '''
+        '''
+        Busiest facilities in the period with their most recorded disease in that same period,
+        ranked for all of them in one window pass, and the date of their latest submission.
+        '''
+        params = (params.where(Encounter, 'date', '>=', start_date)
+                        .where(Encounter, 'date', '<=', end_date))
+        top_params = params.group(Encounter, 'facility_id').sort(None, 'encounter_count', 'DESC')
+        if not top_params.limit:
+            top_params = top_params.set_limit(10)
+        top_query, top_args = cls._build_query('''
+        SELECT ec.facility_id, COUNT(ec.id) AS encounter_count
+        FROM encounters AS ec
+        JOIN facility AS fc ON ec.facility_id = fc.id
+        ''', top_params)
+        disease_query, disease_args = cls._build_query('''
+        SELECT ec.facility_id, ecd.disease_id,
+               ROW_NUMBER() OVER (PARTITION BY ec.facility_id
+                                  ORDER BY COUNT(*) DESC, ecd.disease_id) AS disease_rank
+        FROM encounters AS ec
+        JOIN top_facilities AS tf ON tf.facility_id = ec.facility_id
+        JOIN facility AS fc ON ec.facility_id = fc.id
+        JOIN encounters_diseases AS ecd ON ecd.encounter_id = ec.id
+        ''', replace(params, _group_by=(), _order_by=(), _limit=0, _offset=0)
+                .group(Encounter, 'facility_id').group(EncounterDiseases, 'disease_id'))
+
+        if cls._table_exists('facility_last_submission'):
+            last_submission = '''(SELECT last_submission FROM facility_last_submission
+                                 WHERE facility_id = tf.facility_id)'''
+        else:
+            last_submission = '''(SELECT MAX(created_at) FROM encounters
+                                 WHERE facility_id = tf.facility_id)'''
+        query = f'''
+        WITH top_facilities AS ({top_query}),
+        disease_ranks AS ({disease_query})
         SELECT
             fc.name AS facility_name,
-            COUNT(ec.id) as encounter_count,
-            (
-                SELECT dis.name
-                FROM encounters AS ec2
-                JOIN encounters_diseases as ecd ON ec2.id = ecd.encounter_id
-                JOIN diseases AS dis ON ecd.disease_id = dis.id
-                WHERE ec2.facility_id = ec.facility_id
-                 GROUP BY ecd.disease_id
-                 ORDER BY COUNT(ecd.disease_id) DESC
-                 LIMIT 1
-            ) AS top_disease,
-           MAX(ec.created_at) as last_submission
-           FROM encounters as ec
-            JOIN facility as fc on ec.facility_id = fc.id
-          '''
-        params = (params.where(Encounter, 'date', '>=', start_date)
-                        .where(Encounter, 'date', '<=', end_date)
-                        .group(Encounter, 'facility_id')
-                        .sort(None, 'encounter_count', 'DESC'))
-        if not params.limit:
-            params = params.set_limit(10)
-        res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        query, args = cls._apply_filter(query,  **res)
-        # print(query)
-
-        return cls._run_query(query, args,
+            tf.encounter_count,
+            dis.name AS top_disease,
+            {last_submission} AS last_submission
+        FROM top_facilities AS tf
+        JOIN facility AS fc ON fc.id = tf.facility_id
+        LEFT JOIN disease_ranks AS dr ON dr.facility_id = tf.facility_id AND dr.disease_rank = 1
+        LEFT JOIN diseases AS dis ON dis.id = dr.disease_id
+        ORDER BY tf.encounter_count DESC
+        '''
+        return cls._run_query(query, top_args + disease_args,
                               lambda row: {'facility_name': row['facility_name'],
                                            'encounter_count': row['encounter_count'],
                                            'top_disease': row['top_disease'],
                                            'last_submission': row['last_submission']})
 
+    @staticmethod
+    def _without(params: Params, dimension: str) -> Params:
+        return replace(params, _and_filter=tuple(
+            fil for fil in params.and_filter if PAGE_DIMENSIONS.get((fil.model, fil.col)) != dimension))
+
+    @classmethod
+    def _encounter_page_separately(cls, params: Params, start_date, end_date) -> Dict:
+        without_date = cls._without(params, 'date')
+        return cls.run_widgets({
+            'total_encounter': partial(cls.get_total_encounters, without_date, start_date, end_date),
+            'encounter_gender_distribution': partial(cls.encounter_gender_distribution,
+                                                     cls._without(params, 'gender')),
+            'encounter_age_distribution': partial(cls.encounter_age_group_distribution, params),
+            'encounter_per_scheme': partial(cls.get_encounter_per_scheme, cls._without(params, 'scheme')),
+            'treatment_outcome_distribution': partial(cls.get_treatment_outcome_distribution, params),
+            'top_encounter_facilities': partial(cls.get_top_encounter_facilities, params),
+            'average_daily_encounter': partial(cls.get_average_encounter_per_day, params, start_date, end_date),
+            'encounter_trend': partial(cls.get_encounter_trend, without_date, start_date, end_date),
+            'encounter_per_lga': partial(cls.encounter_distribution_across_lga, cls._without(params, 'lga')),
+        })
+
+    @classmethod
+    @cached_result
+    def encounter_page_summary(cls, params: Params, start_date, end_date) -> Dict:
+        '''
+        Every widget of the encounter dashboard from a single read of the filtered encounters.
+        As on the page, each widget ignores the filter on its own dimension (gender, lga,
+        scheme or date), so the scan applies only the shared filters plus a date window
+        covering every widget, and one UNION ALL branch per widget regroups the scanned rows.
+        Params the scan cannot split fall back to the separate widget methods.
+        '''
+        if column_store.answers(params):
+            # every widget is a few masked counts on the column store
+            return cls._encounter_page_separately(params, start_date, end_date)
+        dimension_filters = [fil for fil in params.and_filter if (fil.model, fil.col) in PAGE_DIMENSIONS]
+        if (params.or_filter or params.group_by or params.order_by or params.limit or params.offset
+                or any(fil.op.upper() not in PAGE_DIMENSION_OPS for fil in dimension_filters)):
+            return cls._encounter_page_separately(params, start_date, end_date)
+
+        prev_start_date, prev_end_date = cls._previous_period(start_date, end_date)
+        trend_start = cls._trend_start(start_date, end_date)
+        window_start, window_end = min(prev_start_date, trend_start), end_date
+        bounded_below = bounded_above = False
+        for fil in dimension_filters:
+            if PAGE_DIMENSIONS[(fil.model, fil.col)] != 'date':
+                continue
+            op = fil.op.upper()
+            low, high = fil.value if op == 'BETWEEN' else (fil.value, fil.value)
+            if not isinstance(low, date) or not isinstance(high, date):
+                return cls._encounter_page_separately(params, start_date, end_date)
+            if op in ('BETWEEN', '=', '>', '>='):
+                window_start, bounded_below = min(window_start, low), True
+            if op in ('BETWEEN', '=', '<', '<='):
+                window_end, bounded_above = max(window_end, high), True
+        if not (bounded_below and bounded_above):
+            # widgets using the date filter would need encounters outside any window
+            return cls._encounter_page_separately(params, start_date, end_date)
+
+        shared = replace(params, _and_filter=tuple(
+            fil for fil in params.and_filter if (fil.model, fil.col) not in PAGE_DIMENSIONS))
+        source, shared = cls._encounter_source(shared)
+        scan = f'''
+        SELECT
+            ec.date, ec.facility_id, fc.name AS facility_name, fc.local_government AS lga,
+            ec.scheme, isc.scheme_name, isc.color_scheme, ec.gender, ec.age_group,
+            CASE WHEN tc.type = 'Death' THEN 'Death' ELSE tc.name END AS outcome,
+            {source.count} AS weight
+        FROM {source.table} AS ec
+        JOIN facility AS fc ON fc.id = ec.facility_id
+        LEFT JOIN insurance_scheme AS isc ON isc.id = ec.scheme
+        LEFT JOIN treatment_outcome AS tc ON tc.id = ec.outcome
+        '''
+        shared = shared.where(Encounter, 'date', '>=', window_start).where(Encounter, 'date', '<=', window_end)
+        # pre-aggregate to the rollup grain so every branch reads as few rows as possible
+        for col in ('date', 'facility_id', 'scheme', 'gender', 'age_group', 'outcome'):
+            shared = shared.group(Encounter, col)
+        scan, args = cls._build_query(scan, shared)
+
+        def where(ignore: str = None, *conditions: Tuple[str, tuple]):
+            parts = []
+            for fil in dimension_filters:
+                column = PAGE_DIMENSIONS[(fil.model, fil.col)]
+                if column == ignore:
+                    continue
+                if fil.op.upper() == 'BETWEEN':
+                    parts.append(f'{column} BETWEEN ? AND ?')
+                    args.extend(fil.value)
+                else:
+                    parts.append(f'{column} {fil.op} ?')
+                    args.append(fil.value)
+            for condition, values in conditions:
+                parts.append(condition)
+                args.extend(values)
+            return f"WHERE {' AND '.join(parts)}" if parts else ''
+
+        # the placeholders are appended to args in the order the branches are written
+        args.extend([start_date, end_date, prev_start_date, prev_end_date])
+        query = f'''
+        WITH scan AS MATERIALIZED ({scan})
+        SELECT 'total' AS widget, NULL AS key, NULL AS label, NULL AS color,
+            COALESCE(SUM(CASE WHEN date BETWEEN ? AND ? THEN weight ELSE 0 END), 0) AS value,
+            COALESCE(SUM(CASE WHEN date BETWEEN ? AND ? THEN weight ELSE 0 END), 0) AS extra
+        FROM scan {where('date')}
+        UNION ALL
+        SELECT 'gender', gender, NULL, NULL, SUM(weight), NULL FROM scan {where('gender')} GROUP BY gender
+        UNION ALL
+        SELECT 'age_group', age_group, NULL, NULL, SUM(weight), NULL FROM scan {where()} GROUP BY age_group
+        UNION ALL
+        SELECT 'scheme', scheme, scheme_name, color_scheme, SUM(weight), NULL
+        FROM scan {where('scheme', ('scheme_name IS NOT NULL', ()))} GROUP BY scheme
+        UNION ALL
+        SELECT 'outcome', outcome, NULL, NULL, SUM(weight), NULL
+        FROM scan {where(None, ('outcome IS NOT NULL', ()))} GROUP BY outcome
+        UNION ALL
+        SELECT 'facility', facility_id, facility_name, NULL, SUM(weight), NULL
+        FROM scan {where()} GROUP BY facility_id
+        UNION ALL
+        SELECT 'average', NULL, NULL, NULL, SUM(weight), COUNT(DISTINCT date)
+        FROM scan {where(None, ('date >= ? AND date <= ?', (start_date, end_date)))}
+        UNION ALL
+        SELECT 'trend', substr(date, 1, 7), NULL, NULL, SUM(weight), NULL
+        FROM scan {where('date', ('date >= ? AND date <= ?', (trend_start, end_date)))} GROUP BY 2
+        UNION ALL
+        SELECT 'lga', lga, NULL, NULL, SUM(weight), NULL FROM scan {where('lga')} GROUP BY lga
+        '''
+
+        widgets = {}
+        for row in cls._connection().execute(query, args):
+            widgets.setdefault(row['widget'], []).append(row)
+
+        total = widgets['total'][0]
+        average = widgets['average'][0]
+        genders = {'M': 'Male', 'F': 'Female'}
+        facilities = sorted(widgets.get('facility', []), key=lambda row: (-row['value'], row['label']))[:5]
+        return {
+            'total_encounter': cls._period_change(total['value'], total['extra']),
+            'encounter_gender_distribution': cls._fill_genders(
+                [{'gender': genders.get(row['key']), 'count': row['value']} for row in widgets.get('gender', [])]),
+            'encounter_age_distribution': cls._fill_age_groups(
+                [{'age_group': row['key'], 'age_group_count': row['value']} for row in widgets.get('age_group', [])]),
+            'encounter_per_scheme': [{'scheme_name': row['label'], 'color': row['color'], 'count': row['value']}
+                                     for row in widgets.get('scheme', [])],
+            'treatment_outcome_distribution': [{'outcome': row['key'], 'count': row['value']}
+                                               for row in widgets.get('outcome', [])],
+            'top_encounter_facilities': [{'facility_name': row['label'], 'encounter_count': row['value']}
+                                         for row in facilities],
+            'average_daily_encounter': (average['value'] * 1.0 / average['extra'] if average['extra'] else 0),
+            'encounter_trend': cls._fill_trend(
+                {row['key']: row['value'] for row in widgets.get('trend', [])}, trend_start, end_date),
+            'encounter_per_lga': cls._lga_counts(
+                [{'lga': row['key'], 'count': row['value']} for row in widgets.get('lga', [])]),
+        }
+
+    # Column store counterparts of the widgets marked @columnar: the same filters as the SQL
+    # above, as masks over EncounterColumns, and rows in the order the SQL returns them.
+
+    @staticmethod
+    def _deaths(params: Params) -> Params:
+        return params.where(TreatmentOutcome, 'type', '=', 'Death')
+
+    @staticmethod
+    def _gender_rows(columns: EncounterColumns, params: Params) -> List[Dict]:
+        genders = {'M': 'Male', 'F': 'Female'}
+        return [{'gender': genders.get(gender), 'count': count}
+                for gender, count in sorted(columns.count_by(columns.mask(params), 'gender').items())]
+
+    @staticmethod
+    def _lga_rows(columns: EncounterColumns, params: Params) -> List[Dict]:
+        counts = columns.count_by(columns.mask(params), 'lga')
+        return [{'lga': lga, 'count': count}
+                for lga, count in sorted(counts.items(), key=lambda item: (-item[1], item[0].lower()))]
+
+    @staticmethod
+    def _facility_rows(columns: EncounterColumns, params: Params, limit: int) -> List[Tuple[str, int]]:
+        counts = columns.count_by(columns.mask(params), 'facility_id')
+        rows = sorted(((columns.facility_names[facility], count) for facility, count in counts.items()),
+                      key=lambda row: (-row[1], row[0]))
+        return rows[:limit]
+
+    @classmethod
+    def _top_encounter_facilities_columns(cls, columns: EncounterColumns, params: Params):
+        return [{'facility_name': name, 'encounter_count': count}
+                for name, count in cls._facility_rows(columns, params, 5)]
+
+    @classmethod
+    def _gender_distribution_columns(cls, columns: EncounterColumns, params: Params):
+        return cls._fill_genders(cls._gender_rows(columns, params)[:5])
+
+    @classmethod
+    def _age_group_distribution_columns(cls, columns: EncounterColumns, params: Params):
+        counts = columns.count_by(columns.mask(params), 'age_group')
+        return cls._fill_age_groups([{'age_group': age_group, 'age_group_count': count}
+                                     for age_group, count in sorted(counts.items())])
+
+    @classmethod
+    def _encounter_trend_columns(cls, columns: EncounterColumns, params: Params, start_date, end_date,
+                                 granularity: str = 'month'):
+        cls._trend_bucket(granularity)
+        start_date = cls._trend_start(start_date, end_date)
+        params = params.where(Encounter, 'date', '>=', start_date).where(Encounter, 'date', '<=', end_date)
+        counts = columns.count_by(columns.mask(params), granularity)
+        return cls._fill_trend(counts, start_date, end_date, granularity)
+
+    @classmethod
+    def _per_scheme_columns(cls, columns: EncounterColumns, params: Params):
+        counts = columns.count_by(columns.mask(params) & columns.has_scheme, 'scheme')
+        return [{'scheme_name': columns.scheme_labels[scheme][0],
+                 'color': columns.scheme_labels[scheme][1],
+                 'count': count} for scheme, count in counts.items()]
+
+    @classmethod
+    def _mortality_per_scheme_columns(cls, columns: EncounterColumns, params: Params):
+        return cls._per_scheme_columns(columns, cls._deaths(params))
+
+    @classmethod
+    def _case_fatality_columns(cls, columns: EncounterColumns, params: Params):
+        mask = columns.mask(params) & columns.has_outcome
+        total = columns.count(mask)
+        if total == 0:
+            return 0
+        return (columns.count(mask & columns.outcome_type_is('Death')) * 1.0 / total) * 100.0
+
+    @classmethod
+    def _treatment_outcome_distribution_columns(cls, columns: EncounterColumns, params: Params):
+        result = {}
+        for outcome, count in columns.count_by(columns.mask(params) & columns.has_outcome, 'outcome').items():
+            name = ('Death' if columns.outcome_types[outcome].lower() == 'death'
+                    else columns.outcome_names[outcome])
+            result[name] = result.get(name, 0) + count
+        return [{'outcome': name, 'count': count} for name, count in sorted(result.items())]
+
+    @classmethod
+    def _referral_count_columns(cls, columns: EncounterColumns, params: Params):
+        return columns.count(columns.mask(params.where(TreatmentOutcome, 'name', '=', 'Referral')))
+
+    @classmethod
+    def _total_encounters_columns(cls, columns: EncounterColumns, params: Params, start_date, end_date):
+        prev_start_date, prev_end_date = cls._previous_period(start_date, end_date)
+        mask = columns.mask(params)
+        return cls._period_change(columns.count(mask & columns.between(start_date, end_date)),
+                                  columns.count(mask & columns.between(prev_start_date, prev_end_date)))
+
+    @classmethod
+    def _lga_distribution_columns(cls, columns: EncounterColumns, params: Params):
+        return cls._lga_counts(cls._lga_rows(columns, params))
+
+    @classmethod
+    def _mortality_by_type_columns(cls, columns: EncounterColumns, params: Params):
+        counts = columns.count_by(columns.mask(cls._deaths(params)), 'outcome')
+        return [{'death_type': name, 'count': count} for name, count in
+                sorted((columns.outcome_names[outcome], count) for outcome, count in counts.items())]
+
+    @classmethod
+    def _mortality_by_age_group_columns(cls, columns: EncounterColumns, params: Params):
+        return cls._age_group_distribution_columns(columns, cls._deaths(params))
+
+    @classmethod
+    def _mortality_by_gender_columns(cls, columns: EncounterColumns, params: Params):
+        return cls._fill_genders(cls._gender_rows(columns, cls._deaths(params)))
+
+    @classmethod
+    def _mortality_per_facility_columns(cls, columns: EncounterColumns, params: Params):
+        return [{'facility_name': name, 'count': count}
+                for name, count in cls._facility_rows(columns, cls._deaths(params), 10)]
+
+    @classmethod
+    def _mortality_trend_columns(cls, columns: EncounterColumns, params: Params, start_date, end_date,
+                                 granularity: str = 'month'):
+        cls._trend_bucket(granularity)
+        start_date = cls._mortality_trend_start(start_date, end_date)
+        params = cls._deaths(params).where(Encounter, 'date', 'BETWEEN', (start_date, end_date))
+        counts = {(period, columns.outcome_names[outcome]): count for (period, outcome), count
+                  in columns.count_by(columns.mask(params), granularity, 'outcome').items()}
+        if not counts:
+            return {}
+        death_types = [name for outcome, name in columns.outcome_names.items()
+                       if columns.outcome_types[outcome].lower() == 'death']
+        return cls._fill_mortality_trend(counts, death_types, start_date, end_date, granularity)
+
+    @classmethod
+    def _mortality_by_lga_columns(cls, columns: EncounterColumns, params: Params):
+        return cls._lga_counts(cls._lga_rows(columns, cls._deaths(params)))
+
+    @classmethod
+    def _average_per_day_columns(cls, columns: EncounterColumns, params: Params, start_date, end_date):
+        mask = columns.mask(params.where(Encounter, 'date', '>=', start_date)
+                                  .where(Encounter, 'date', '<=', end_date))
+        days = columns.distinct_days(mask)
+        return columns.count(mask) * 1.0 / days if days else 0
+
+    @classmethod
+    def _average_mortality_per_day_columns(cls, columns: EncounterColumns, params: Params, start_date, end_date):
+        return cls._average_per_day_columns(columns, cls._deaths(params), start_date, end_date)
+
+    @classmethod
+    def _average_encounter_per_day_columns(cls, columns: EncounterColumns, params: Params, start_date, end_date):
+        return cls._average_per_day_columns(columns, params, start_date, end_date)
+
+    @classmethod
+    def _total_death_outcome_columns(cls, columns: EncounterColumns, params: Params, start_date, end_date):
+        prev_start_date, prev_end_date = cls._previous_period(start_date, end_date)
+        deaths = columns.mask(cls._deaths(params))
+        current = columns.count(deaths & columns.between(start_date, end_date))
+        prev = columns.count(deaths & columns.between(prev_start_date, prev_end_date))
+        pct_change = 0
+        if prev:
+            pct_change =  ((current - prev)/prev) * 100
+        elif current:
+            pct_change = 100
+        return (current, pct_change)
+
+    @classmethod
+    def _active_facility_columns(cls, columns: EncounterColumns, params: Params):
+        return len(columns.count_by(columns.mask(params), 'facility_id'))
@@ -1,12 +1,12 @@
 import io
 import sqlite3
-import pandas as pd
+from itertools import chain, islice
 from typing import Dict, Callable
-from openpyxl import load_workbook
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
 
-from app.db import get_db
-from app.utils import autofit_columns
 from app.filter_parser import Params, FilterParser
 from app.models import (
     Facility, FacilityScheme, InsuranceScheme,
@@ -16,41 +16,54 @@ from app.models import (
 from .base import BaseServices
 
 class DownloadServices(BaseServices):
+    read_only = True
+
+    # rows read before the column widths are fixed; longer sheets stream on at those widths
+    WIDTH_SAMPLE_ROWS = 1000
 
     @classmethod
     def build_dataframe_buffer(cls, query: str,
                                params: Params,
                                model_map: Dict,
-                               row_processor: Callable[[sqlite3.Row], dict] = lambda row: dict(row)):
-
-        res = FilterParser.parse_params(params, model_map)
-        query, args = cls._apply_filter(query, **res)
+                               row_processor: Callable[[sqlite3.Row], dict] = lambda row: dict(row),
+                               max_width: int = 55):
+        '''
+        XLSX of the query rows behind an S/N column, written in one pass by a write-only
+        workbook. The header is bold and the columns are autofitted on the header and the
+        first WIDTH_SAMPLE_ROWS rows; the rest are written straight from the cursor.
+        '''
+        query, args = cls._build_query(query, params, model_map)
 
-        db = get_db()
-        rows = db.execute(query, args).fetchall()
-        df = pd.DataFrame([row_processor(row) for row in rows])
+        db = cls._connection()
+        cursor = db.execute(query, args)
+        records = (row_processor(row) for row in cursor)
+        sample = list(islice(records, cls.WIDTH_SAMPLE_ROWS))
+        columns = ['S/N'] + (list(sample[0]) if sample else [column[0] for column in cursor.description])
 
-        if not df.empty:
-            df.index = range(1, len(df) + 1)
-            df.reset_index(inplace=True)
-            df.columns = ['S/N'] + df.columns[1:].tolist()
+        # the lengths autofit_columns measures, str(None) included
+        lengths = [len(str(name)) for name in columns]
+        for sn, record in enumerate(sample, 1):
+            for idx, value in enumerate((sn, *record.values())):
+                lengths[idx] = max(lengths[idx], len(str(value)))
 
-        output_buffer = io.BytesIO()
-        with pd.ExcelWriter(output_buffer) as writer:
-            df.to_excel(writer, index=False)
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet()
+        for idx, length in enumerate(lengths, 1):
+            ws.column_dimensions[get_column_letter(idx)].width = min((length + 2) * 1.2, max_width)
 
-        output_buffer.seek(0)
-        wb = load_workbook(output_buffer)
-        ws = wb.active
-
-        for cell in ws[1]:
+        header = []
+        for name in columns:
+            cell = WriteOnlyCell(ws, name)
             cell.font = Font(bold=True)
+            header.append(cell)
+        ws.append(header)
+        for sn, record in enumerate(chain(sample, records), 1):
+            ws.append([sn, *record.values()])
 
-        autofit_columns(ws, 55)
-        new_buffer = io.BytesIO()
-        wb.save(new_buffer)
-        new_buffer.seek(0)
-        return new_buffer
+        output_buffer = io.BytesIO()
+        wb.save(output_buffer)
+        output_buffer.seek(0)
+        return output_buffer
 
     @classmethod
     def download_facilities_sheet(cls, params: Params):
@@ -1,8 +1,12 @@
+import re
 import sqlite3
 from datetime import date, datetime
-from typing import Dict, List, Optional, Iterator, Literal
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Iterator, Literal, Sequence, Type, Union
 from collections import defaultdict
+from pydantic import ValidationError as SchemaValidationError
 
+from app import app
 from app.db import get_db
 from app.filter_parser import Params, FilterParser
 from app.exceptions import (
@@ -10,6 +14,11 @@ from app.exceptions import (
     ServiceError, QueryParameterError
 )
 from app.constants import EncType, DeliveryMode, BabyOutcome
+from app.schemas import (
+    BaseEncounterSchema, EncounterSchema, ANCEncounterSchema,
+    DeliveryEncounterSchema, ChildHealthEncounterSchema, format_validation_errors
+)
+from app.utils import get_age_group, calculate_edd
 from app.models import (
     Encounter, Facility, TreatmentOutcome, InsuranceScheme,
     EncounterDiseases, ANCRegistry, DeliveryBaby,
@@ -22,6 +31,16 @@ from app.models import (
 from .base import BaseServices, _legacy_to_params
 from .facility import FacilityServices
 
+_SEARCH_TOKEN = re.compile(r'\w+')
+
+
+@dataclass
+class BulkRowResult:
+    index: int
+    id: Optional[int] = None
+    error: Optional[str] = None
+    duplicate: bool = False
+
 class EncounterServices(BaseServices):
     table_name = 'encounters'
     model = Encounter
@@ -38,6 +57,16 @@ class EncounterServices(BaseServices):
          InsuranceScheme: 'isc',
          EncounterDiseases: 'ecd'}
 
+    # newest first; id breaks ties between encounters on the same date
+    cursor_key = ((Encounter, 'date'), (Encounter, 'id'))
+    cursor_order = 'DESC'
+
+    # subclasses first: a delivery schema is also an ANC schema
+    SCHEMA_ENC_TYPES = ((DeliveryEncounterSchema, EncType.DELIVERY),
+                        (ANCEncounterSchema, EncType.ANC),
+                        (ChildHealthEncounterSchema, EncType.CHILDHEALTH),
+                        (EncounterSchema, EncType.GENERAL))
+
     @classmethod
     def get_total(cls,
                   params: Optional[Params] = None,
@@ -51,21 +80,10 @@ class EncounterServices(BaseServices):
             LEFT JOIN users AS u ON ec.created_by = u.id
         '''
 
-        res ={}
-        if params is not None:
-            if params.group_by or params.order_by:
-                raise QueryParameterError("You can't groupby or order by to get_total")
+        if params is not None and (params.group_by or params.order_by):
+            raise QueryParameterError("You can't groupby or order by to get_total")
 
-            mapper = cls.MODEL_ALIAS_MAP
-            res = FilterParser.parse_params(params, model_map=mapper)
-        else:
-            res = _legacy_to_params(**kwargs)
-
-        query, args = cls._apply_filter(
-            base_query=query,
-            base_arg=[],
-            **res
-        )
+        query, args = cls._build_query(query, params, **kwargs)
         db = get_db()
 
         res =db.execute(query, args).fetchone()
@@ -419,6 +437,233 @@ class EncounterServices(BaseServices):
             db.rollback()
             raise ServiceError(f"Failed to create child health encounter: {str(e)}")
 
+    @staticmethod
+    def _existing_ids(db, table: str, ids: set) -> set:
+        if not ids:
+            return set()
+        placeholders = ','.join('?' * len(ids))
+        rows = db.execute(f'SELECT id FROM {table} WHERE id IN ({placeholders})', list(ids))
+        return {row['id'] for row in rows}
+
+    @staticmethod
+    def _service_id_like(db, identifier: str) -> Optional[int]:
+        row = db.execute('SELECT id from services WHERE LOWER(name) LIKE ?',
+                         (f'%{identifier}%',)).fetchone()
+        return row['id'] if row else None
+
+    @classmethod
+    def create_encounters_bulk(cls,
+                               encounters: List,
+                               scheme: Union[int, Sequence[int]],
+                               created_by: int,
+                               schema: Optional[Type[BaseEncounterSchema]] = None,
+                               idempotency_keys: Optional[Sequence[Optional[str]]] = None
+                               ) -> List[BulkRowResult]:
+        '''
+        Create a batch of encounters in one transaction.
+        Items are schema instances (their class decides the encounter type) or dicts
+        validated against `schema`; `scheme` is one scheme id for all rows or one per row.
+        Rows failing validation, reference checks or the ANC registry rules get an error
+        in their BulkRowResult and the rest are still inserted.
+        A delivery needs an active ANC registry for its ORIN, in the database or created
+        earlier in the same batch.
+        A row whose idempotency key was already used by created_by is not inserted again:
+        its result carries the existing encounter id and duplicate=True.
+        '''
+        schemes = list(scheme) if isinstance(scheme, (list, tuple)) else [scheme] * len(encounters)
+        keys = list(idempotency_keys) if idempotency_keys is not None else [None] * len(encounters)
+        if len(schemes) != len(encounters) or len(keys) != len(encounters):
+            raise ValidationError("scheme and idempotency_keys must match the number of encounters")
+
+        results = [BulkRowResult(index) for index in range(len(encounters))]
+        validated = []
+        for index, item in enumerate(encounters):
+            try:
+                if isinstance(item, dict):
+                    if schema is None:
+                        raise ValidationError("No schema given to validate encounter data")
+                    item = schema(**item)
+                enc_type = next((t for schema_cls, t in cls.SCHEMA_ENC_TYPES
+                                 if isinstance(item, schema_cls)), None)
+                if enc_type is None:
+                    raise ValidationError(f"Unsupported encounter schema {type(item).__name__}")
+                validated.append((index, item, enc_type))
+            except SchemaValidationError as e:
+                results[index].error = format_validation_errors(e)
+            except ValidationError as e:
+                results[index].error = str(e)
+
+        if not validated:
+            return results
+
+        db = get_db()
+        # every lookup is done once for the whole batch
+        known_schemes = cls._existing_ids(db, 'insurance_scheme', {schemes[index] for index, _, _ in validated})
+        facilities = cls._existing_ids(db, 'facility', {item.facility_id for _, item, _ in validated})
+        outcomes = cls._existing_ids(db, 'treatment_outcome', {item.outcome for _, item, _ in validated})
+        diseases = cls._existing_ids(db, 'diseases', {d for _, item, _ in validated
+                                                      for d in getattr(item, 'diseases', [])})
+        services = cls._existing_ids(db, 'services', {s for _, item, _ in validated
+                                                      for s in getattr(item, 'services', [])})
+        enc_types = {enc_type for _, _, enc_type in validated}
+        maternal_services = {}
+        if EncType.ANC in enc_types:
+            maternal_services['antenatal'] = cls._service_id_like(db, 'antenatal')
+        if EncType.DELIVERY in enc_types:
+            maternal_services['delivery'] = cls._service_id_like(db, 'delivery')
+            maternal_services['cesarean'] = cls._service_id_like(db, 'cesarean')
+
+        disease_rows, service_rows = [], []
+        anc_rows, delivery_rows, baby_rows, child_health_rows = [], [], [], []
+        registry_counts, closed_registries = {}, []
+        key_rows, created = [], []
+        # encounters and registries are inserted one at a time so SQLite assigns their ids,
+        # which the child rows inserted with executemany below refer to
+        insert_encounter = f'''INSERT INTO {cls.table_name} (facility_id, date, policy_number,
+            client_name, gender, age, age_group, scheme, nin, phone_number, enc_type,
+            referral_reason, mode_of_entry, treatment, treatment_cost, medication,
+            medication_cost, investigation, investigation_cost, outcome, doctor_name,
+            address, hospital_number, created_by, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+        insert_registry = '''INSERT INTO anc_registry(orin, kia_date, client_name,
+            booking_date, parity, place_of_issue, hospital_number, address, lmp,
+            expected_delivery_date, anc_count, status, nin, phone_number, age, age_group)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+
+        try:
+            if not db.in_transaction:
+                db.execute('BEGIN IMMEDIATE')
+
+            orins = list({item.policy_number.strip() for _, item, enc_type in validated
+                          if enc_type in (EncType.ANC, EncType.DELIVERY)})
+            registries = {}
+            if orins:
+                placeholders = ','.join('?' * len(orins))
+                for row in db.execute(f'''SELECT id, orin, anc_count FROM anc_registry
+                                      WHERE status = 'active' AND orin IN ({placeholders})''', orins):
+                    registries.setdefault(row['orin'], [row['id'], row['anc_count']])
+
+            # looked up inside the write transaction so concurrent retries cannot both insert
+            used_keys = {}
+            batch_keys = list({key for key in keys if key})
+            if batch_keys:
+                placeholders = ','.join('?' * len(batch_keys))
+                used_keys = {row['idempotency_key']: row['encounter_id'] for row in db.execute(
+                    f'''SELECT idempotency_key, encounter_id FROM encounter_idempotency_keys
+                    WHERE created_by = ? AND idempotency_key IN ({placeholders})''',
+                    [created_by] + batch_keys)}
+
+            created_at = datetime.now().date()
+            for index, item, enc_type in validated:
+                key = keys[index]
+                if key and key in used_keys:
+                    results[index].id = used_keys[key]
+                    results[index].duplicate = True
+                    continue
+
+                orin = item.policy_number.strip()
+                errors = []
+                if schemes[index] not in known_schemes:
+                    errors.append(f"Insurance scheme {schemes[index]} does not exist")
+                if item.facility_id not in facilities:
+                    errors.append(f"Facility {item.facility_id} does not exist")
+                if item.outcome not in outcomes:
+                    errors.append(f"Treatment outcome {item.outcome} does not exist")
+                missing = [d for d in getattr(item, 'diseases', []) if d not in diseases]
+                missing += [s for s in getattr(item, 'services', []) if s not in services]
+                if missing:
+                    errors.append(f"Invalid disease or service id(s): {missing}")
+
+                registry = registries.get(orin)
+                maternal_service = None
+                if enc_type == EncType.ANC:
+                    maternal_service = maternal_services['antenatal']
+                    if not maternal_service:
+                        errors.append("ANC service not found in services table")
+                    if registry is None and not 15 <= item.age <= 60:
+                        errors.append("ANC registry age must be between 15 and 60")
+                elif enc_type == EncType.DELIVERY:
+                    identifier = 'cesarean' if item.mode_of_delivery == DeliveryMode.CS.value else 'delivery'
+                    maternal_service = maternal_services[identifier]
+                    if not maternal_service:
+                        errors.append(f"Service {identifier} not found")
+                    if registry is None:
+                        errors.append(f"No active ANC registry for ORIN {orin}")
+                if errors:
+                    results[index].error = '; '.join(errors)
+                    continue
+
+                age_group = item.age_group or get_age_group(item.age)
+                enc_id = db.execute(insert_encounter, (
+                    item.facility_id, item.date, orin, item.client_name.strip(),
+                    item.gender.upper().strip(), item.age, age_group, schemes[index], item.nin.strip(),
+                    item.phone_number.strip(), enc_type.value, item.referral_reason,
+                    item.mode_of_entry, item.treatment.strip() if item.treatment else item.treatment,
+                    int(item.treatment_cost * 100) if item.treatment_cost else 0,
+                    item.medication, int(item.medication_cost * 100) if item.medication_cost else 0,
+                    item.investigation,
+                    int(item.investigation_cost * 100) if item.investigation_cost else 0,
+                    item.outcome, item.doctor_name.strip(), item.address, item.hospital_number,
+                    created_by, created_at)).lastrowid
+
+                disease_rows.extend((enc_id, d) for d in set(getattr(item, 'diseases', [])))
+                service_ids = set(getattr(item, 'services', []))
+                if maternal_service:
+                    service_ids.add(maternal_service)
+                service_rows.extend((enc_id, s) for s in service_ids)
+
+                if enc_type == EncType.ANC:
+                    if registry is None:
+                        registry_id = db.execute(insert_registry, (
+                            orin, item.kia_date, item.client_name, item.booking_date,
+                            item.parity, item.place_of_issue, item.hospital_number, item.address,
+                            item.lmp, calculate_edd(item.lmp), 1, 'active', item.nin,
+                            item.phone_number, item.age, age_group)).lastrowid
+                        registry = registries[orin] = [registry_id, 1]
+                    else:
+                        registry[1] += 1
+                        registry_counts[registry[0]] = registry[1]
+                    anc_rows.append((enc_id, registry[0], registry[1]))
+                elif enc_type == EncType.DELIVERY:
+                    delivery_rows.append((registry[0], enc_id, registry[1], item.mode_of_delivery))
+                    baby_rows.extend((enc_id, baby.gender, baby.outcome) for baby in item.babies)
+                    closed_registries.append((registry[0],))
+                    del registries[orin]
+                elif enc_type == EncType.CHILDHEALTH:
+                    child_health_rows.append((enc_id, orin, item.dob, item.address, item.guardian_name))
+                if key:
+                    used_keys[key] = enc_id
+                    key_rows.append((created_by, key, enc_id, created_at))
+                created.append((index, enc_id))
+
+            db.executemany('INSERT INTO encounters_diseases(encounter_id, disease_id) VALUES(?, ?)',
+                           disease_rows)
+            db.executemany('INSERT INTO encounters_services(encounter_id, service_id) VALUES(?, ?)',
+                           service_rows)
+            db.executemany('INSERT INTO anc_encounters(encounter_id, anc_id, anc_count) VALUES (?, ?, ?)',
+                           anc_rows)
+            db.executemany('UPDATE anc_registry SET anc_count = ? WHERE id = ?',
+                           [(count, registry_id) for registry_id, count in registry_counts.items()])
+            db.executemany('''INSERT INTO delivery_encounters(anc_id, encounter_id, anc_count,
+                mode_of_delivery) VALUES(?, ?, ?, ?)''', delivery_rows)
+            db.executemany('INSERT INTO delivery_babies(encounter_id, gender, outcome) VALUES (?, ?, ?)',
+                           baby_rows)
+            db.executemany('''UPDATE anc_registry SET status = 'inactive' WHERE id = ?''',
+                           closed_registries)
+            db.executemany('''INSERT INTO child_health_encounters(encounter_id, orin, dob, address,
+                guardian_name) VALUES(?, ?, ?, ?, ?)''', child_health_rows)
+            if key_rows:
+                db.executemany('''INSERT INTO encounter_idempotency_keys(created_by, idempotency_key,
+                    encounter_id, created_at) VALUES (?, ?, ?, ?)''', key_rows)
+            db.commit()
+        except sqlite3.Error as e:
+            db.rollback()
+            raise ServiceError(f"Failed to create encounters: {str(e)}")
+
+        for index, enc_id in created:
+            results[index].id = enc_id
+        return results
+
     @classmethod
     def get_anc_record_by_registry(cls, orin: str) -> ANCRegistry:
         orin = orin.strip()
@@ -453,6 +698,7 @@ class EncounterServices(BaseServices):
     @classmethod
     def _get_base_encounter(cls,
                 params: Optional[Params] = None,
+                match: Optional[str] = None,
                 **kwargs
                 ):
         query = '''
@@ -497,20 +743,18 @@ class EncounterServices(BaseServices):
             JOIN treatment_outcome as tc on ec.outcome = tc.id
             LEFT JOIN users AS u ON ec.created_by = u.id
         '''   #polymorphism for all encounters
+        base_arg = None
+        if match is not None:
+            query += '''
+            JOIN (SELECT rowid, rank FROM encounters_fts WHERE encounters_fts MATCH ?) AS fts
+                ON fts.rowid = ec.id
+            '''
+            base_arg = [match]
 
-        if params:
-            res =FilterParser.parse_params(params,cls.MODEL_ALIAS_MAP)
-        else:
-            res = _legacy_to_params(**kwargs)
-
-        query, args = cls._apply_filter(
-            base_query=query,
-            base_arg=[],
-            **res
-        )
+        query, args = cls._build_query(query, params, base_arg=base_arg, **kwargs)
 
         db = get_db()
-        return db.execute(query, args).fetchall()
+        return db.execute(query, args)
 
     @classmethod
     def _get_diseases_mapping(cls, encounter_ids: List) -> Dict:
@@ -823,13 +1067,7 @@ class EncounterServices(BaseServices):
         )
 
     @classmethod
-    def get_all(cls,
-                params: Optional[Params] = None,
-                **kwargs
-                ) -> Iterator:
-
-        encounters_rows = cls._get_base_encounter(params, **kwargs)
-
+    def _build_encounter_chunk(cls, encounters_rows: List, scheme_map: Dict) -> Iterator:
         encounter_ids = []
         delivery_ids = []
         anc_ids = []
@@ -844,17 +1082,17 @@ class EncounterServices(BaseServices):
             elif row['enc_type'] == EncType.CHILDHEALTH.value:
                 child_health_id.append(row['id'])
 
-        if not encounter_ids:
-            return []
-
         diseases_by_encounter = cls._get_diseases_mapping(encounter_ids)
         services_by_encounter = cls._get_services_mapping(encounter_ids=encounter_ids)
         anc_by_encounters = cls._get_anc_mapping(anc_ids)
         delivery_by_encounters = cls._get_delivery_mapping(delivery_ids)
         child_health_by_encounters = cls._get_child_health_mapping(child_health_ids=child_health_id)
 
-        facility_ids = [row['facility_id'] for row in encounters_rows]
-        scheme_map = FacilityServices.get_insurance_list(facility_ids)
+        # facility schemes are shared by every chunk, only look up facilities not seen yet
+        facility_ids = list({row['facility_id'] for row in encounters_rows} - scheme_map.keys())
+        if facility_ids:
+            new_schemes = FacilityServices.get_insurance_list(facility_ids)
+            scheme_map.update({fid: new_schemes[fid] for fid in facility_ids})
 
         for row in encounters_rows:
             encounter = None
@@ -912,6 +1150,47 @@ class EncounterServices(BaseServices):
 
             yield encounter
 
+    @classmethod
+    def get_all(cls,
+                params: Optional[Params] = None,
+                chunk_size: Optional[int] = None,
+                match: Optional[str] = None,
+                **kwargs
+                ) -> Iterator:
+        '''
+        Stream encounter views chunk_size rows at a time (ENCOUNTER_CHUNK_SIZE by default).
+        The diseases, services and ANC/delivery/child health queries run once per chunk,
+        so memory and the size of their IN lists stay bounded however many rows match.
+        '''
+        chunk_size = chunk_size or app.config.get('ENCOUNTER_CHUNK_SIZE', 1000)
+        encounters_rows = cls._get_base_encounter(params, match=match, **kwargs)
+        scheme_map = {}
+        while chunk := encounters_rows.fetchmany(chunk_size):
+            yield from cls._build_encounter_chunk(chunk, scheme_map)
+
+    @staticmethod
+    def _fts_match(text: str) -> str:
+        # every word must match as a prefix; quoting keeps FTS5 syntax out of user input
+        tokens = _SEARCH_TOKEN.findall(text or '')[:16]
+        if not tokens:
+            raise ValidationError("Search text must contain letters or digits")
+        return ' '.join(f'"{token}"*' for token in tokens)
+
+    @classmethod
+    def search(cls,
+               text: str,
+               params: Optional[Params] = None,
+               chunk_size: Optional[int] = None) -> Iterator:
+        '''
+        Full text search over client name, ORIN/policy number, NIN, phone number, address,
+        treatment, medication, investigation and doctor, best matches first.
+        params filters, limit and offset apply as in get_all; an explicit sort replaces the ranking.
+        '''
+        params = Params() if params is None else params
+        if not params.order_by:
+            params = params.sort(None, 'fts.rank').sort(Encounter, 'id', 'DESC')
+        return cls.get_all(params=params, chunk_size=chunk_size, match=cls._fts_match(text))
+
     @classmethod
     def get_encounter_by_facility(cls, facility_id: int) -> Iterator:
         return cls.get_all(params=Params().where(Encounter, 'id', '=', facility_id))
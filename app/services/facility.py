@@ -130,16 +130,7 @@ class FacilityServices(BaseServices):
         '''
         params = params if params else Params()
         params = params.group(Facility, 'id')
-        res = {}
-        if params:
-            res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        else:
-            res = _legacy_to_params(**kwargs)
-
-        query, args = cls._apply_filter(
-            base_query=query,
-            **res
-        )
+        query, args = cls._build_query(query, params, **kwargs)
 
         db = get_db()
         facility_rows = list(db.execute(query, args).fetchall())
@@ -163,21 +154,11 @@ class FacilityServices(BaseServices):
     @classmethod
     def get_total(cls, params: Optional[Params] = None, **kwargs) -> int:
         query = f'SELECT COUNT(DISTINCT fc.id) from {cls.table_name} as fc LEFT JOIN facility_scheme as fsc on fsc.facility_id = fc.id'
-        res = {}
-        if params is not None:
-             if params.group_by or params.order_by:
-                raise QueryParameterError("You can't groupby or order by to get_total")
-
-             mapper = {cls.model: cls.table_name} if not cls.MODEL_ALIAS_MAP else cls.MODEL_ALIAS_MAP
-             res = FilterParser.parse_params(params, model_map=mapper)
-        else:
-            res = _legacy_to_params(**kwargs)
+        if params is not None and (params.group_by or params.order_by):
+            raise QueryParameterError("You can't groupby or order by to get_total")
 
-        query, args = cls._apply_filter(
-            base_query=query,
-            base_arg=[],
-            **res
-        )
+        mapper = {cls.model: cls.table_name} if not cls.MODEL_ALIAS_MAP else cls.MODEL_ALIAS_MAP
+        query, args = cls._build_query(query, params, model_map=mapper, **kwargs)
         db = get_db()
         res =db.execute(query, args).fetchone()
         if res:
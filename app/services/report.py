@@ -1,16 +1,16 @@
 import pandas as pd
 from datetime import datetime, timedelta
-from typing import Tuple, Optional, List
+from typing import Iterator, Tuple, Optional, List
 
 from .base import BaseServices
 from .facility import FacilityServices
 
 from app.models import Encounter, Facility, TreatmentOutcome, InsuranceScheme, EncounterDiseases
-from app.db import get_db
 from app.constants import AgeGroup
 from app.exceptions import MissingError, ValidationError
 
 class ReportServices(BaseServices):
+    read_only = True
 
     MODEL_ALIAS_MAP = {Encounter: 'ec',
          Facility: 'fc',
@@ -18,6 +18,56 @@ class ReportServices(BaseServices):
          InsuranceScheme: 'isc',
          EncounterDiseases: 'ecd'}
 
+    # one row per counted item; the pivot reports group these in SQLite and count policy numbers
+    SERVICE_UTILIZATION_ROWS = '''
+        SELECT
+            ec.policy_number,
+            vui.item_name AS disease_name,
+            ec.gender,
+            ec.age_group
+        FROM encounters AS ec
+        LEFT JOIN {utilization} as vui on vui.encounter_id = ec.id
+        WHERE ec.date >= ? and ec.date <= ?
+        AND ec.facility_id = ?
+    '''
+    ENCOUNTER_ROWS = '''
+        SELECT
+            f.name as facility_name,
+            ec.policy_number,
+            ec.gender,
+            ec.age_group
+        FROM encounters as ec
+        JOIN facility as f ON ec.facility_id = f.id
+        WHERE  ec.date >= ? AND ec.date <= ?
+    '''
+    CATEGORIZATION_ROWS = '''
+        SELECT
+          ec.policy_number,
+          cg.category_name,
+          f.name as facility_name
+        FROM encounters as ec
+        JOIN facility as f on ec.facility_id = f.id
+        LEFT JOIN encounters_diseases as ed on ed.encounter_id = ec.id
+        JOIN diseases as dis on dis.id = ed.disease_id
+        JOIN diseases_category as cg on cg.id = dis.category_id
+        WHERE ec.date >= ? AND ec.date <= ?
+    '''
+
+    @classmethod
+    def _pivot_counts(cls, rows_query: str, args, keys: Tuple[str, ...]) -> pd.DataFrame:
+        '''
+        Policy numbers counted per keys over the rows of rows_query, one row per group.
+        NULL keys stay their own group, so the frame is empty only when no row matched
+        and pivot_table drops them as it would the raw rows.
+        '''
+        columns = ', '.join(keys)
+        query = f'''
+            SELECT {columns}, COUNT(policy_number) AS count
+            FROM ({rows_query})
+            GROUP BY {columns}
+        '''
+        return pd.DataFrame([dict(row) for row in cls._connection().execute(query, args)])
+
     @classmethod
     def generate_service_utilization_report(cls, facility: int, start_date, end_date) -> Tuple:
         try:
@@ -25,22 +75,8 @@ class ReportServices(BaseServices):
         except MissingError:
             raise MissingError("Facility does not exist. No report generated")
 
-        query = '''
-            SELECT
-                ec.policy_number,
-                vui.item_name AS disease_name,
-                ec.gender,
-                ec.age_group
-            FROM encounters AS ec
-            LEFT JOIN view_utilization_items as vui on vui.encounter_id = ec.id
-            WHERE ec.date >= ? and ec.date <= ?
-            AND ec.facility_id = ?
-        '''
-        args = (start_date, end_date, facility)
-        db = get_db()
-
-        rows = db.execute(query, args)
-        df = pd.DataFrame([dict(row) for row in rows])
+        query = cls.SERVICE_UTILIZATION_ROWS.format(utilization=cls._utilization_table())
+        df = cls._pivot_counts(query, (start_date, end_date, facility), ('disease_name', 'age_group', 'gender'))
 
         if df.empty:
             raise MissingError("No report available for this timeframe!")
@@ -50,9 +86,9 @@ class ReportServices(BaseServices):
 
         table = df.pivot_table(
             index='disease_name',
-            values='policy_number',
+            values='count',
             columns=['age_group', 'gender'],
-            aggfunc='count',
+            aggfunc='sum',
             fill_value=0
         ).reindex(
             pd.MultiIndex.from_product([age_groups, gender]),
@@ -76,20 +112,7 @@ class ReportServices(BaseServices):
     @classmethod
     def generate_encounter_report(cls, start_date, end_date) -> Tuple:
 
-        query = '''
-            SELECT
-                f.name as facility_name,
-                ec.policy_number,
-                ec.gender,
-                ec.age_group
-            FROM encounters as ec
-            JOIN facility as f ON ec.facility_id = f.id
-            WHERE  ec.date >= ? AND ec.date <= ?
-        '''
-
-        db = get_db()
-        rows = db.execute(query, (start_date, end_date))
-        df = pd.DataFrame([dict(row) for row in rows])
+        df = cls._pivot_counts(cls.ENCOUNTER_ROWS, (start_date, end_date), ('facility_name', 'age_group', 'gender'))
 
         if df.empty:
             raise MissingError("No report available for this timeframe!")
@@ -99,9 +122,9 @@ class ReportServices(BaseServices):
 
         table = df.pivot_table(
             index='facility_name',
-            values='policy_number',
+            values='count',
             columns=['age_group', 'gender'],
-            aggfunc='count',
+            aggfunc='sum',
             fill_value=0,
 
         ).reindex(
@@ -122,11 +145,25 @@ class ReportServices(BaseServices):
         return start_date, table
 
 
-    @classmethod
-    def generate_nhia_encounter_report(cls, start_date, end_date):
-                                     
-        # 1. Base Query (Note: No GROUP BY yet)
+    NHIA_COLUMNS = [
+        'STATE', 'LGA', 'FACILITY NAME', 'FACILITY TYPE', 'FACILITY OWNERSHIP',
+        'ENCOUNTER DATE(DD/MM/YYYY)', 'NIN', 'HOSPITAL NUMBER', 'ENROLLEE NUMBER',
+        'TYPE OF PROGRAMME', 'ENROLLEE NAME', 'RESIDENTIAL ADDRESS', 'PHONE NUMBER',
+        'GENDER', 'AGE GROUP', 'MODE OF ENTRY', # Removed 'NATURE OF VISIT', 'TYPE OF SERVICE' as they aren't in query
+        'INVESTIGATION', "COST OF INVESTIGATION", 'DIAGNOSIS', 'TREATMENT', 'COST OF TREATMENT',
+        'MEDICATION', 'COST OF MEDICATION', 'TOTAL COST', 'OUTCOME', 'REASON FOR REFERRAL',
+        'CLAIMS AMOUNT SUBMITTED', 'CLAIMS PAID AMOUNT', 'CLAIMS AMOUNT REJECTED', "REASON FOR REJECTION"
+    ]
+    NHIA_COST_COLUMNS = ['COST OF INVESTIGATION', 'COST OF TREATMENT', 'COST OF MEDICATION']
+    # filled in by NHIA, left blank in the report
+    NHIA_CLAIM_COLUMNS = ['CLAIMS AMOUNT SUBMITTED', 'CLAIMS PAID AMOUNT', 'CLAIMS AMOUNT REJECTED', 'REASON FOR REJECTION']
 
+    @classmethod
+    def iter_nhia_encounter_rows(cls, start_date, end_date) -> Iterator[List]:
+        '''
+        Rows of the NHIA encounter report in NHIA_COLUMNS order, one per encounter, read
+        from the cursor as they are produced so the period length does not matter
+        '''
         query = '''
         SELECT
             "Ondo State" as STATE,
@@ -163,78 +200,42 @@ class ReportServices(BaseServices):
         WHERE ec.date >= ? AND ec.date <= ?
         GROUP BY ec.id
         '''
+        date_col = 'ENCOUNTER DATE(DD/MM/YYYY)'
+        for row in cls._connection().execute(query, (start_date, end_date)):
+            record = dict(row)
+            record['TOTAL COST'] = sum(record[col] or 0 for col in cls.NHIA_COST_COLUMNS)
+            for col in cls.NHIA_CLAIM_COLUMNS:
+                record[col] = ''
+            encounter_date = record[date_col]
+            if isinstance(encounter_date, str):
+                encounter_date = datetime.fromisoformat(encounter_date)
+            record[date_col] = encounter_date.strftime("%d/%m/%Y")
+            yield [record[col] for col in cls.NHIA_COLUMNS]
 
-        db = get_db()
-
-        rows = db.execute(query, (start_date, end_date))
-        # print("query", query, "start_date", start_date, "end_date", end_date)
-
-        if not rows:
+    @classmethod
+    def generate_nhia_encounter_report(cls, start_date, end_date):
+        df = pd.DataFrame(list(cls.iter_nhia_encounter_rows(start_date, end_date)), columns=cls.NHIA_COLUMNS)
+        if df.empty:
             raise MissingError("No report available for this timeframe!")
 
-        df = pd.DataFrame([dict(row) for row in rows])
-        # print("df", df)
-        cols_to_sum = ['COST OF INVESTIGATION', 'COST OF TREATMENT', 'COST OF MEDICATION']
-
-        for col in cols_to_sum:
-            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-
-        df['TOTAL COST'] = df[cols_to_sum].sum(axis=1)
-
-        df['CLAIMS AMOUNT SUBMITTED'] = ''
-        df['CLAIMS PAID AMOUNT'] = ''
-        df['CLAIMS AMOUNT REJECTED'] = ''
-        df['REASON FOR REJECTION'] = ''
-
-        date_col = 'ENCOUNTER DATE(DD/MM/YYYY)'
-        if date_col in df.columns:
-             df[date_col] = pd.to_datetime(df[date_col]).dt.strftime("%d/%m/%Y")
-
-        new_order = [
-            'STATE', 'LGA', 'FACILITY NAME', 'FACILITY TYPE', 'FACILITY OWNERSHIP',
-            'ENCOUNTER DATE(DD/MM/YYYY)', 'NIN', 'HOSPITAL NUMBER', 'ENROLLEE NUMBER',
-            'TYPE OF PROGRAMME', 'ENROLLEE NAME', 'RESIDENTIAL ADDRESS', 'PHONE NUMBER',
-            'GENDER', 'AGE GROUP', 'MODE OF ENTRY', # Removed 'NATURE OF VISIT', 'TYPE OF SERVICE' as they aren't in query
-            'INVESTIGATION', "COST OF INVESTIGATION", 'DIAGNOSIS', 'TREATMENT', 'COST OF TREATMENT',
-            'MEDICATION', 'COST OF MEDICATION', 'TOTAL COST', 'OUTCOME', 'REASON FOR REFERRAL',
-            'CLAIMS AMOUNT SUBMITTED', 'CLAIMS PAID AMOUNT', 'CLAIMS AMOUNT REJECTED', "REASON FOR REJECTION"
-        ]
         df.index = range(1, len(df) + 1)
         df.index.name = 'S/N'
-        df = df.reindex(columns=new_order)
         return start_date, df
 
     @classmethod
-    def generate_categorization_report(cls, month: Optional[int], year: Optional[int]):
-        if month and (month < 1 or month > 12):
-            raise ValidationError("Invalid Month selection")
-        start_date, end_date = cls.get_start_end_date(month, year)
-        query = '''
-            SELECT
-              ec.policy_number,
-              cg.category_name,
-              f.name as facility_name
-            FROM encounters as ec
-            JOIN facility as f on ec.facility_id = f.id
-            LEFT JOIN encounters_diseases as ed on ed.encounter_id = ec.id
-            JOIN diseases as dis on dis.id = ed.disease_id
-            JOIN diseases_category as cg on cg.id = dis.category_id
-            WHERE ec.date >= ? AND ec.date <= ?
-        '''
-        db = get_db()
-        rows = db.execute(query, (start_date, end_date))
-        df = pd.DataFrame([dict(row) for row in rows])
+    def generate_categorization_report(cls, start_date, end_date):
+        df = cls._pivot_counts(cls.CATEGORIZATION_ROWS, (start_date, end_date), ('facility_name', 'category_name'))
         if df.empty:
             raise MissingError("No report available for the time frame")
 
         table = df.pivot_table(
             index='facility_name',
-            values='policy_number',
+            values='count',
             columns=['category_name'],
-            aggfunc='count',
+            aggfunc='sum',
             fill_value=0
         )
-        rows = db.execute('SELECT category_name from diseases_category')
+        rows = cls._connection().execute('SELECT category_name from diseases_category')
         categories = [row['category_name'] for row in rows]
         table.reindex(categories, axis=1, fill_value=0)
         table['TOTAL'] = table.sum(axis=1)
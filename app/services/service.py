@@ -51,16 +51,7 @@ class ServiceServices(BaseServices):
         JOIN service_category as scg
         ON srv.category_id = scg.id'''
 
-        if params:
-            res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        else:
-            res = _legacy_to_params(**kwargs)
-
-        query, args = cls._apply_filter(
-            base_query=query,
-            base_arg=[],
-            **res
-        )
+        query, args = cls._build_query(query, params, **kwargs)
         db = get_db()
         rows = db.execute(query, args)
         for row in rows:
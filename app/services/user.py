@@ -104,17 +104,7 @@ class UserServices(BaseServices):
             FROM users AS u
             LEFT JOIN facility AS fc ON u.facility_id = fc.id
         '''
-        res = {}
-        if params:
-            res = FilterParser.parse_params(params, cls.MODEL_ALIAS_MAP)
-        else:
-            res = _legacy_to_params(**kwargs)
-
-        query, args = cls._apply_filter(
-            base_query=query,
-            base_arg=[],
-            **res
-        )
+        query, args = cls._build_query(query, params, **kwargs)
 
         rows = db.execute(query, args).fetchall()
         facility_ids = [row['facility_id'] for row in rows]
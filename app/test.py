@@ -43,7 +43,7 @@ class FacilityServicesTestCase(BaseServicesTestCase):
     def setUp(self):
         super().setUp()
         # Create a default facility for tests
-        FacilityServices.create_facility("TestFacility1", "Owo", "Primary")
+        FacilityServices.create_facility("TestFacility1", "Owo", "Primary", [], "public")
 
     def test_create_and_get_facility(self):
         facility = FacilityServices.get_facility_by_name("TestFacility1")
@@ -58,9 +58,9 @@ class FacilityServicesTestCase(BaseServicesTestCase):
         self.assertEqual(facility2.facility_type, "Primary")
 
     def test_create_duplicate_facility(self):
-        FacilityServices.create_facility("TestFacility2", "Akure South", "Secondary")
+        FacilityServices.create_facility("TestFacility2", "Akure South", "Secondary", [], "public")
         with self.assertRaises(DuplicateError):
-            FacilityServices.create_facility("TestFacility2", "Akure North", "Secondary")
+            FacilityServices.create_facility("TestFacility2", "Akure North", "Secondary", [], "public")
 
     def test_update_facility(self):
         facility = FacilityServices.get_facility_by_name("TestFacility1")
@@ -77,7 +77,7 @@ class FacilityServicesTestCase(BaseServicesTestCase):
             FacilityServices.get_facility_by_name("NonExistentFacility")
 
     def test_delete_facility(self):
-        facility = FacilityServices.create_facility("TestFacility3", "Okitipupa", "Tertiary")
+        facility = FacilityServices.create_facility("TestFacility3", "Okitipupa", "Tertiary", [], "public")
         FacilityServices.delete_facility(facility)
         with self.assertRaises(MissingError):
             FacilityServices.get_facility_by_name("TestFacility3")
@@ -91,8 +91,8 @@ class UserServicesTestCase(BaseServicesTestCase):
     def setUp(self):
         super().setUp()
         # Create facilities required for users
-        FacilityServices.create_facility("TestFacility1", "Owo", "Primary")
-        FacilityServices.create_facility("TestFacility2", "Akure South", "Secondary")
+        FacilityServices.create_facility("TestFacility1", "Owo", "Primary", [], "public")
+        FacilityServices.create_facility("TestFacility2", "Akure South", "Secondary", [], "public")
 
     def test_create_and_get_user(self):
         user1 = UserServices.create_user("user1", 1, "damilare20")
@@ -257,7 +257,7 @@ class DiseaseServicesTestCase(BaseServicesTestCase):
 class EncounterServicesTestCase(BaseServicesTestCase):
     def setUp(self):
         super().setUp()
-        FacilityServices.create_facility("TestFacility1", "Owo", "Primary")
+        FacilityServices.create_facility("TestFacility1", "Owo", "Primary", [], "public")
         self.category = DiseaseCategoryServices.create_category("Infectious Diseases")
         self.disease = DiseaseServices.create_disease("Malaria", self.category.id)
         self.user = UserServices.create_user("user1", 1, "damilare20")
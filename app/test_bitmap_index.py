@@ -0,0 +1,103 @@
+import os
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from app import app, bitmap_index
+from app.bitmap_index import Bitmap, BitmapIndex, CHUNK_ROWS, popcount
+from app.columnar import ColumnStore
+from app.test_support import SeededDatabaseTestCase
+
+
+class BitmapIndexTestCase(unittest.TestCase):
+    SIZE = 3 * CHUNK_ROWS + 1234
+
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        # a frequent value fills bitset chunks, a rare one stays in array chunks
+        self.values = {'scheme': rng.choice([1, 2, 3], self.SIZE, p=[0.9, 0.08, 0.02]),
+                       'outcome': rng.integers(1, 5, self.SIZE), 'facility_id': rng.integers(1, 50, self.SIZE),
+                       'gender': rng.integers(0, 2, self.SIZE), 'age_group': rng.integers(0, 6, self.SIZE),
+                       'enc_type': rng.integers(0, 4, self.SIZE)}
+        self.keys = {'gender': ['m', 'f'], 'age_group': [f'group {i}' for i in range(6)],
+                     'enc_type': ['general', 'anc', 'delivery', 'child_health']}
+        split = CHUNK_ROWS + 100
+        # built in two steps, so some chunks are extended across calls
+        self.index = BitmapIndex().extended({k: v[:split] for k, v in self.values.items()}, self.keys).extended(
+            {k: v[split:] for k, v in self.values.items()}, self.keys)
+        self.filter = rng.random(self.SIZE) < 0.3
+
+    def test_has_both_chunk_kinds(self):
+        kinds = {container.dtype for bitmap in self.index.bitmaps['scheme'].values()
+                 for container in bitmap.chunks.values()}
+        self.assertEqual(kinds, {np.dtype(np.uint16), np.dtype('<u8')})
+
+    def test_mask_and_counts_match_numpy(self):
+        self.assertEqual(self.index.size, self.SIZE)
+        for value in (1, 2, 3):
+            expected = self.values['scheme'] == value
+            np.testing.assert_array_equal(self.index.mask('scheme', [value], self.SIZE), expected)
+        np.testing.assert_array_equal(self.index.mask('facility_id', [4, 9, 99], self.SIZE),
+                                      np.isin(self.values['facility_id'], [4, 9]))
+        for column in BitmapIndex.COLUMNS:
+            codes, counts = np.unique(self.values[column][self.filter], return_counts=True)
+            expected = {self.keys[column][code] if column in self.keys else code: count
+                        for code, count in zip(codes.tolist(), counts.tolist())}
+            self.assertEqual({k: v for k, v in self.index.counts(column, self.filter).items() if v}, expected)
+
+    def test_set_operations_match_numpy(self):
+        scheme, facility = self.values['scheme'], self.values['facility_id']
+        common, rare = self.index.union('scheme', [1]), self.index.union('scheme', [3])
+        some = self.index.union('facility_id', range(1, 20))
+        cases = [(common & some, (scheme == 1) & (facility < 20)),
+                 (rare & some, (scheme == 3) & (facility < 20)),
+                 (common & rare, np.zeros(self.SIZE, dtype=bool)),
+                 (Bitmap.union([rare, some]), (scheme == 3) | (facility < 20)),
+                 (common.complement(self.SIZE), scheme != 1),
+                 (rare.complement(self.SIZE) & common, scheme == 1)]
+        for rows, expected in cases:
+            np.testing.assert_array_equal(rows.mask(self.SIZE), expected)
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'index.npz')
+            ids = np.arange(1, self.SIZE + 1) * 2
+            self.index.save(path, rewrites=3, max_id=int(ids[-1]))
+            loaded = BitmapIndex.load(path, 3, ids)
+            for column in BitmapIndex.COLUMNS:
+                self.assertEqual(loaded.counts(column, self.filter), self.index.counts(column, self.filter))
+            # stale after an update or delete, or when the rows it indexed are gone
+            self.assertIsNone(BitmapIndex.load(path, 4, ids))
+            self.assertIsNone(BitmapIndex.load(path, 3, ids + 1))
+            self.assertIsNone(BitmapIndex.load(path + '.missing', 3, ids))
+
+    def test_popcount_without_bitwise_count(self):
+        words = np.random.default_rng(1).integers(0, 2 ** 63, 4096, dtype=np.int64).view('<u8')
+        expected = sum(bin(word).count('1') for word in words.tolist())
+        self.assertEqual(popcount(words), expected)
+        legacy = types.SimpleNamespace(unpackbits=np.unpackbits, uint8=np.uint8)
+        with mock.patch.object(bitmap_index, 'np', legacy):
+            self.assertEqual(popcount(words), expected)
+
+
+class SavedBitmapIndexTestCase(SeededDatabaseTestCase):
+    def test_saved_index_is_reused(self):
+        app.config.update(DASHBOARD_ENGINE='numpy', BITMAP_INDEX_FILE=os.path.join(self.directory.name, 'index.npz'))
+        with app.app_context():
+            columns = ColumnStore().current()
+        self.assertTrue(os.path.exists(app.config['BITMAP_INDEX_FILE']))
+        with mock.patch.object(BitmapIndex, 'extended', autospec=True, side_effect=BitmapIndex.extended) as extended, \
+                app.app_context():
+            reloaded = ColumnStore().current()
+        # only the rows inserted since the save are indexed again, here none
+        self.assertEqual(extended.call_args[0][1]['scheme'].size, 0)
+        for column in BitmapIndex.COLUMNS:
+            self.assertEqual(reloaded.bitmaps.counts(column, np.ones(reloaded.size, dtype=bool)),
+                             columns.bitmaps.counts(column, np.ones(columns.size, dtype=bool)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import unittest
+from datetime import date
+
+from app import app
+from app.columnar import column_store, _same
+from app.db import get_db
+from app.filter_parser import Params
+from app.models import Encounter, Facility
+from app.services import DashboardServices
+from app.test_support import SeededDatabaseTestCase
+
+START, END = date(2024, 1, 1), date(2024, 12, 31)
+
+# extra arguments after params of every method answered by the column store
+COLUMNAR_CALLS = {
+    'get_top_encounter_facilities': (),
+    'encounter_gender_distribution': (),
+    'encounter_age_group_distribution': (),
+    'get_encounter_trend': (START, END),
+    'get_encounter_per_scheme': (),
+    'get_mortality_per_scheme': (),
+    'case_fatality': (),
+    'get_treatment_outcome_distribution': (),
+    'get_referral_count': (),
+    'get_total_encounters': (START, END),
+    'encounter_distribution_across_lga': (),
+    'mortality_distribution_by_type': (),
+    'mortality_distribution_by_age_group': (),
+    'get_mortality_distribution_by_gender': (),
+    'get_mortality_count_per_facility': (),
+    'get_mortality_trend': (START, END),
+    'get_mortality_by_lga': (),
+    'get_average_mortality_per_day': (START, END),
+    'get_average_encounter_per_day': (START, END),
+    'get_total_death_outcome': (START, END),
+    'get_active_encounter_facility': (),
+}
+
+
+def columnar_methods():
+    '''Names of the DashboardServices methods wrapped by @columnar'''
+    return [name for name in dir(DashboardServices)
+            if getattr(getattr(DashboardServices, name), 'columnar_method', None)]
+
+
+class ColumnarEngineTestCase(SeededDatabaseTestCase):
+    PARAMS = [
+        Params(),
+        Params().where(Encounter, 'date', 'BETWEEN', (START, END)),
+        Params().where(Encounter, 'date', 'BETWEEN', (START, END)).where(Encounter, 'gender', '=', 'F'),
+        Params().where(Facility, 'local_government', '=', 'akure south'),
+        Params().where(Encounter, 'date', '>=', START).where(Encounter, 'scheme', '=', 2),
+        Params().where(Encounter, 'age', 'BETWEEN', (5, 40)).where(Encounter, 'date', '<=', END),
+        Params().where(Encounter, 'gender', '=', 'X'),
+        Params().or_where(Encounter, 'scheme', '=', 1).or_where(Encounter, 'scheme', '=', 3),
+        Params().where(Encounter, 'scheme', '!=', 2).where(Encounter, 'gender', '=', 'M')
+                .where(Facility, 'local_government', '=', 'owo').where(Encounter, 'date', '<=', END),
+        Params().where(Encounter, 'gender', '=', 'F')
+                .or_where(Encounter, 'scheme', '=', 3).or_where(Encounter, 'age', '>=', 60),
+    ]
+
+    def run_engine(self, engine: str, name: str, params: Params, *args, **kwargs):
+        app.config['DASHBOARD_ENGINE'] = engine
+        return getattr(DashboardServices, name)(params, *args, **kwargs)
+
+    def test_every_columnar_method_is_compared(self):
+        self.assertCountEqual(columnar_methods(), COLUMNAR_CALLS)
+
+    def test_numpy_matches_sql(self):
+        app.config['DASHBOARD_ENGINE'] = 'numpy'
+        self.assertIsNotNone(column_store.current())
+        for params in self.PARAMS:
+            app.config['DASHBOARD_ENGINE'] = 'numpy'
+            self.assertTrue(column_store.answers(params), params)
+            for name, args in COLUMNAR_CALLS.items():
+                granularities = ('week', 'month', 'quarter', 'year') if name.endswith('_trend') else (None,)
+                for granularity in granularities:
+                    kwargs = {'granularity': granularity} if granularity else {}
+                    with self.subTest(method=name, params=params, **kwargs):
+                        expected = self.run_engine('sql', name, params, *args, **kwargs)
+                        result = self.run_engine('numpy', name, params, *args, **kwargs)
+                        self.assertTrue(_same(result, expected), f'{result!r} != {expected!r}')
+
+    def test_ties_are_ordered_by_name(self):
+        # every facility has the same count, so the order is the facility name on both engines
+        for engine in ('sql', 'numpy'):
+            top = self.run_engine(engine, 'get_top_encounter_facilities', Params())
+            self.assertEqual([row['facility_name'] for row in top],
+                             ['Alpha Clinic', 'Beta Clinic', 'Delta Clinic', 'Kappa Clinic', 'Omega Clinic'])
+            self.assertEqual({row['encounter_count'] for row in top}, {120})
+
+    def test_inserts_are_appended(self):
+        app.config['DASHBOARD_ENGINE'] = 'numpy'
+        with app.app_context():
+            before = column_store.current()
+        db = get_db()
+        db.execute('''
+        INSERT INTO encounters(facility_id, date, policy_number, client_name, gender, age, enc_type, address,
+            scheme, nin, phone_number, hospital_number, age_group, mode_of_entry, doctor_name, outcome,
+            created_by, created_at)
+        SELECT 3, '2024-07-01', policy_number, client_name, 'F', age, enc_type, address, 2, nin, phone_number,
+            hospital_number, age_group, mode_of_entry, doctor_name, 3, created_by, created_at
+        FROM encounters WHERE id = 1
+        ''')
+        db.commit()
+        with app.app_context():
+            after = column_store.current()
+            self.assertEqual((after.size, after.bitmaps.size), (before.size + 1, before.size + 1))
+            self.assertEqual(after.rewrites, before.rewrites)
+            params = Params().where(Encounter, 'gender', '=', 'F').where(Encounter, 'scheme', '=', 2)
+            self.assertTrue(_same(self.run_engine('numpy', 'get_mortality_count_per_facility', params),
+                                  self.run_engine('sql', 'get_mortality_count_per_facility', params)))
+
+
+if __name__ == '__main__':
+    unittest.main()
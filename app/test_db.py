@@ -0,0 +1,203 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from app import app
+from app.db import (ConnectionPool, _connect, _read_only_connector, get_db, get_read_db, close_db, apply_derived_schema,
+                    close_months, reopen_months, rebuild_daily_rollup, rebuild_utilization_items,
+                    rebuild_facility_last_submission)
+from app.exceptions import PoolTimeoutError
+from app.test_support import SeededDatabaseTestCase
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.database = os.path.join(self.directory.name, 'pool.db')
+        with sqlite3.connect(self.database) as conn:
+            conn.execute('CREATE TABLE items(id INTEGER PRIMARY KEY)')
+        self.pool = ConnectionPool(self.database, connect=_connect, max_size=2, timeout=0.05)
+
+    def tearDown(self):
+        self.pool.close()
+        self.directory.cleanup()
+
+    def test_released_connection_is_reused(self):
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+        self.assertIs(self.pool.acquire(), conn)
+        self.assertEqual((self.pool.hits, self.pool.misses), (1, 1))
+
+    def test_acquire_times_out_when_exhausted(self):
+        held = [self.pool.acquire(), self.pool.acquire()]
+        with self.assertRaises(PoolTimeoutError):
+            self.pool.acquire()
+        self.assertEqual(self.pool.timeouts, 1)
+        self.pool.release(held.pop())
+        self.assertIsNotNone(self.pool.acquire())
+
+    def test_release_rolls_back_open_transaction(self):
+        conn = self.pool.acquire()
+        conn.execute('INSERT INTO items VALUES (1)')
+        self.assertTrue(conn.in_transaction)
+        self.pool.release(conn)
+        conn = self.pool.acquire()
+        self.assertFalse(conn.in_transaction)
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM items').fetchone()[0], 0)
+
+    def test_closed_connection_is_discarded(self):
+        conn = self.pool.acquire()
+        conn.close()
+        self.pool.release(conn)
+        self.assertEqual(self.pool.discarded, 1)
+        self.assertIsNot(self.pool.acquire(), conn)
+
+    def test_idle_connections_are_dropped_after_fork(self):
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+        self.pool._pid = -1  # as if this process had been forked from another
+        self.assertIsNot(self.pool.acquire(), conn)
+        self.assertEqual(self.pool.stats()['checked_out'], 1)
+
+    def test_read_only_connection_cannot_write(self):
+        conn = _read_only_connector(self.database)
+        with self.assertRaises(sqlite3.OperationalError):
+            conn.execute('INSERT INTO items VALUES (1)')
+        conn.close()
+
+
+class PooledAppConnectionTestCase(SeededDatabaseTestCase):
+    seed = False
+
+    def setUp(self):
+        super().setUp()
+        app.config['DB_POOL_ENABLED'] = True
+
+    def test_connections_return_to_their_pools(self):
+        close_db()
+        db, read_db = get_db(), get_read_db()
+        self.assertIsNot(db, read_db)
+        close_db()
+        self.assertIs(get_db(), db)
+        self.assertIs(get_read_db(), read_db)
+        with self.assertRaises(sqlite3.OperationalError):
+            read_db.execute("INSERT INTO diseases_category(category_name) VALUES ('x')")
+        close_db()
+
+
+class DerivedSchemaTestCase(SeededDatabaseTestCase):
+    seed = False
+
+    def test_applies_to_an_existing_database(self):
+        db = get_db()
+        db.execute('DROP TABLE encounter_idempotency_keys')
+        apply_derived_schema(db)
+        apply_derived_schema(db)
+        self.assertIsNotNone(db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'encounter_idempotency_keys'").fetchone())
+
+
+class DerivedTriggersTestCase(SeededDatabaseTestCase):
+    '''Each derived table stays equal to a rebuild from encounters after every kind of write'''
+
+    def assert_in_sync(self, table: str, rebuild, order_by: str):
+        db = get_db()
+        maintained = db.execute(f'SELECT * FROM {table} ORDER BY {order_by}').fetchall()
+        rebuild(db)
+        rebuilt = db.execute(f'SELECT * FROM {table} ORDER BY {order_by}').fetchall()
+        self.assertEqual([tuple(row) for row in maintained], [tuple(row) for row in rebuilt])
+        db.rollback()
+
+    def write(self):
+        db = get_db()
+        db.execute('''
+        INSERT INTO encounters(facility_id, date, policy_number, client_name, gender, age, enc_type, address,
+            scheme, nin, phone_number, hospital_number, age_group, mode_of_entry, doctor_name, outcome,
+            created_by, created_at, treatment_cost)
+        SELECT facility_id, '2024-06-01', policy_number, 'Ngozi Okafor', gender, age, enc_type, address,
+            scheme, nin, phone_number, hospital_number, age_group, mode_of_entry, doctor_name, outcome,
+            created_by, '2025-02-01', 700
+        FROM encounters WHERE id = 1
+        ''')
+        db.execute('INSERT INTO encounters_diseases(encounter_id, disease_id) VALUES (721, 2)')
+        db.execute("UPDATE encounters SET date = '2023-02-02', gender = 'F', treatment_cost = 5 WHERE id = 2")
+        db.execute('UPDATE encounters SET facility_id = 5, scheme = 3 WHERE id = 3')
+        db.execute('DELETE FROM encounters_diseases WHERE encounter_id = 4')
+        db.execute('DELETE FROM encounters WHERE id = 5')
+        db.execute("UPDATE diseases SET name = 'Malaria Fever' WHERE id = 1")
+        db.commit()
+
+    def test_fts_follows_encounter_writes(self):
+        self.write()
+        db = get_db()
+        match = lambda text: [row[0] for row in db.execute(
+            'SELECT rowid FROM encounters_fts WHERE encounters_fts MATCH ?', (text,))]
+        self.assertEqual(match('"Ngozi" "Okafor"'), [721])
+        db.execute("UPDATE encounters SET client_name = 'Chidi Obi' WHERE id = 721")
+        self.assertEqual(match('"Ngozi"'), [])
+        self.assertEqual(match('"Chidi"'), [721])
+        db.execute('DELETE FROM encounters WHERE id = 721')
+        self.assertEqual(match('"Chidi"'), [])
+        db.rollback()
+
+    def test_daily_rollup_follows_encounter_writes(self):
+        self.write()
+        self.assert_in_sync('daily_encounter_rollup', rebuild_daily_rollup,
+                            'date, facility_id, scheme, gender, age_group, outcome')
+
+    def test_utilization_items_follow_encounter_writes(self):
+        self.write()
+        self.assert_in_sync('utilization_items', rebuild_utilization_items, 'encounter_id, item_type, item_id')
+        db = get_db()
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM utilization_items').fetchone()[0],
+                         db.execute('SELECT COUNT(*) FROM view_utilization_items').fetchone()[0])
+
+    def test_facility_last_submission_follows_encounter_writes(self):
+        self.write()
+        self.assert_in_sync('facility_last_submission', rebuild_facility_last_submission, 'facility_id')
+
+    def test_data_version_moves_on_writes_the_dashboard_reads(self):
+        db = get_db()
+        version = lambda: db.execute("SELECT version FROM data_version WHERE name = 'encounters'").fetchone()[0]
+        for statement in ("UPDATE encounters SET age = 40 WHERE id = 1",
+                          'DELETE FROM encounters_services WHERE encounter_id = 1',
+                          "UPDATE facility SET name = 'Zeta Hospital' WHERE id = 1",
+                          "UPDATE insurance_scheme SET color_scheme = '#000000' WHERE id = 1",
+                          "UPDATE treatment_outcome SET name = 'Referred' WHERE name = 'Referral'"):
+            before = version()
+            db.execute(statement)
+            self.assertGreater(version(), before, statement)
+        db.rollback()
+
+
+class ClosedMonthsTestCase(SeededDatabaseTestCase):
+    def closed(self):
+        return {row[0] for row in get_db().execute('SELECT month FROM closed_months')}
+
+    def test_close_and_reopen(self):
+        db = get_db()
+        months = close_months(db, '2024-06')
+        db.commit()
+        self.assertEqual((months[0], months[-1], len(months)), ('2023-01', '2024-06', 18))
+        self.assertEqual(close_months(db, '2024-06'), [])
+        self.assertEqual(reopen_months(db, ['2024-06']), 1)
+        self.assertNotIn('2024-06', self.closed())
+
+    def test_writes_reopen_their_month(self):
+        db = get_db()
+        close_months(db, '2024-12')
+        enc_id, month = db.execute("SELECT id, substr(date, 1, 7) FROM encounters WHERE date LIKE '2023-03%'").fetchone()
+        db.execute("UPDATE encounters SET doctor_name = 'Dr. Bello', treatment_cost = 1 WHERE id = ?", (enc_id,))
+        self.assertIn(month, self.closed())
+        db.execute("UPDATE encounters SET gender = CASE gender WHEN 'M' THEN 'F' ELSE 'M' END WHERE id = ?", (enc_id,))
+        self.assertNotIn(month, self.closed())
+
+        enc_id, month = db.execute("SELECT id, substr(date, 1, 7) FROM encounters WHERE date LIKE '2024-04%'").fetchone()
+        db.execute('INSERT OR IGNORE INTO encounters_diseases(encounter_id, disease_id) VALUES (?, 2)', (enc_id,))
+        self.assertNotIn(month, self.closed())
+        db.rollback()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+
+from app.db import get_db
+from app.exceptions import ValidationError
+from app.filter_parser import Params
+from app.models import Encounter
+from app.schemas import EncounterSchema, ANCEncounterSchema
+from app.services import EncounterServices
+from app.test_support import SeededDatabaseTestCase
+
+ENCOUNTER = dict(policy_number='1234567890', client_name=' Ada Bello ', date='2025-05-01', gender='F', age=25,
+                 phone_number='08012345678', hospital_number='H1', address='Akure', nin='12345678901',
+                 facility_id=1, outcome=1, doctor_name='Dr. Musa', mode_of_entry='Outpatient',
+                 treatment_cost='12.5')
+ANC = dict(ENCOUNTER, kia_date='2025-01-01', place_of_issue='Akure', booking_date='2025-01-02',
+           lmp='2024-12-01', parity=1)
+
+
+class CursorPaginationTestCase(SeededDatabaseTestCase):
+    def expected_ids(self, where: str = '', args: tuple = ()):
+        return [row[0] for row in get_db().execute(
+            f'SELECT id FROM encounters {where} ORDER BY date DESC, id DESC', args)]
+
+    def walk(self, params: Params):
+        pages, cursor = [], None
+        while True:
+            page = EncounterServices.list_row_by_cursor(cursor, params)
+            pages.append(page)
+            if page.next_cursor is None:
+                return pages
+            cursor = page.next_cursor
+
+    def test_pages_cover_every_row_once_in_order(self):
+        pages = self.walk(Params().set_limit(50))
+        self.assertEqual([item.id for page in pages for item in page.items], self.expected_ids())
+        self.assertEqual(len(pages), 15)
+        self.assertIsNone(pages[0].prev_cursor)
+        self.assertEqual(len(pages[-1].items), 720 % 50)
+
+    def test_previous_cursor_returns_the_previous_page(self):
+        pages = self.walk(Params().set_limit(50))
+        for before, page in zip(pages, pages[1:]):
+            previous = EncounterServices.list_row_by_cursor(page.prev_cursor, Params().set_limit(50))
+            self.assertEqual([item.id for item in previous.items], [item.id for item in before.items])
+            self.assertIsNotNone(previous.next_cursor)
+
+    def test_filters_apply_to_every_page(self):
+        pages = self.walk(Params().where(Encounter, 'gender', '=', 'F').set_limit(40))
+        self.assertEqual([item.id for page in pages for item in page.items],
+                         self.expected_ids("WHERE gender = 'F'"))
+
+    def test_invalid_cursor(self):
+        for cursor in ('not a cursor', 'eyJrIjpbMV0sImIiOmZhbHNlfQ'):  # the second has one key, not two
+            with self.assertRaises(ValidationError):
+                EncounterServices.list_row_by_cursor(cursor)
+
+
+class BulkCreateTestCase(SeededDatabaseTestCase):
+    def test_encounters_are_created_with_their_links(self):
+        results = EncounterServices.create_encounters_bulk(
+            [EncounterSchema(**ENCOUNTER, diseases=[1, 2], services=[3]) for _ in range(3)], scheme=1, created_by=1)
+        self.assertEqual([result.id for result in results], [721, 722, 723])
+
+        view = EncounterServices.get_view_by_id(722)
+        self.assertEqual(view.client_name, 'Ada Bello')
+        self.assertCountEqual([disease.name for disease in view.diseases], ['Malaria', 'Typhoid'])
+        self.assertEqual([service.name for service in view.services], ['Normal Delivery'])
+
+    def test_row_errors_do_not_stop_the_batch(self):
+        results = EncounterServices.create_encounters_bulk(
+            [ENCOUNTER, dict(ENCOUNTER, nin='bad'), dict(ENCOUNTER, facility_id=99),
+             dict(ENCOUNTER, diseases=[42]), ENCOUNTER],
+            scheme=[1, 1, 1, 1, 9], created_by=1, schema=EncounterSchema)
+        self.assertEqual([result.error is None for result in results], [True, False, False, False, False])
+        self.assertIn('Facility 99', results[2].error)
+        self.assertIn('[42]', results[3].error)
+        self.assertIn('scheme 9', results[4].error)
+        self.assertEqual(get_db().execute('SELECT COUNT(*) FROM encounters').fetchone()[0], 721)
+
+    def test_anc_visits_in_one_batch_share_a_registry(self):
+        results = EncounterServices.create_encounters_bulk(
+            [ANCEncounterSchema(**ANC), ANCEncounterSchema(**ANC)], scheme=1, created_by=1)
+        self.assertTrue(all(result.id for result in results))
+        registry = get_db().execute("SELECT id, anc_count FROM anc_registry WHERE orin = '1234567890'").fetchall()
+        self.assertEqual([tuple(row)[1:] for row in registry], [(2,)])
+        visits = get_db().execute('SELECT anc_id, anc_count FROM anc_encounters ORDER BY anc_count').fetchall()
+        self.assertEqual([tuple(row) for row in visits], [(registry[0][0], 1), (registry[0][0], 2)])
+
+    def test_idempotency_keys(self):
+        first = EncounterServices.create_encounters_bulk([ENCOUNTER, ENCOUNTER], scheme=1, created_by=1,
+                                                         schema=EncounterSchema, idempotency_keys=['a', 'b'])
+        retry = EncounterServices.create_encounters_bulk([ENCOUNTER, ENCOUNTER, ENCOUNTER], scheme=1, created_by=1,
+                                                         schema=EncounterSchema, idempotency_keys=['b', 'c', 'c'])
+        self.assertEqual([result.duplicate for result in first], [False, False])
+        self.assertEqual(retry[0].id, first[1].id)
+        self.assertEqual([result.duplicate for result in retry], [True, False, True])
+        self.assertEqual(retry[2].id, retry[1].id)
+        self.assertEqual(get_db().execute('SELECT COUNT(*) FROM encounters').fetchone()[0], 723)
+
+        with self.assertRaises(ValidationError):
+            EncounterServices.create_encounters_bulk([ENCOUNTER], scheme=1, created_by=1,
+                                                     schema=EncounterSchema, idempotency_keys=[])
+
+
+if __name__ == '__main__':
+    unittest.main()
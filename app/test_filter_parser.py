@@ -0,0 +1,79 @@
+import unittest
+from datetime import date
+
+from app.filter_parser import FilterParser, Params, query_shape_cache
+from app.models import Encounter, Facility
+from app.services.base import BaseServices
+
+MODEL_MAP = {Encounter: 'e', Facility: 'f'}
+BASE_QUERY = 'SELECT e.id FROM encounters e JOIN facility f ON f.id = e.facility_id'
+
+
+def uncached(params: Params, base_arg=None):
+    '''The SQL and arguments built straight from the params, without the shape cache'''
+    return BaseServices._apply_filter(BASE_QUERY, list(base_arg or []), **FilterParser.parse_params(params, MODEL_MAP))
+
+
+class QueryShapeCacheTestCase(unittest.TestCase):
+    CASES = [
+        Params(),
+        Params().where(Encounter, 'gender', '=', 'F'),
+        Params().where(Encounter, 'date', 'BETWEEN', (date(2024, 1, 1), date(2024, 6, 30)))
+                .where(Facility, 'local_government', '=', 'owo'),
+        Params().or_where(Encounter, 'scheme', '=', 1).or_where(Encounter, 'scheme', '=', 3)
+                .where(Encounter, 'age', '>=', 18),
+        Params().where(Encounter, 'age', 'BETWEEN', (5, 40)).or_where(Encounter, 'outcome', '=', 2)
+                .or_where(Encounter, 'date', 'BETWEEN', ('2023-01-01', '2023-03-31')),
+        Params().group(Facility, 'name').sort(Facility, 'name', 'DESC').set_limit(10).set_offset(30),
+        Params().where(Encounter, 'gender', '=', 'M')
+                .seek(((Encounter, 'date'), (Encounter, 'id')), '<', ('2024-03-01', 420))
+                .sort(Encounter, 'date', 'DESC').sort(Encounter, 'id', 'DESC').set_limit(21),
+        # a second and filter on the same column and operator replaces the first
+        Params().where(Encounter, 'gender', '=', 'M').where(Encounter, 'gender', '=', 'F'),
+    ]
+
+    def setUp(self):
+        query_shape_cache.clear()
+
+    def test_matches_uncached_query(self):
+        for params in self.CASES:
+            with self.subTest(params=params):
+                self.assertEqual(BaseServices._build_query(BASE_QUERY, params, MODEL_MAP), uncached(params))
+                # the second call comes from the cache
+                self.assertEqual(BaseServices._build_query(BASE_QUERY, params, MODEL_MAP), uncached(params))
+
+    def test_same_shape_is_compiled_once(self):
+        hits, misses = query_shape_cache.hits, query_shape_cache.misses
+        for gender, limit in (('M', 10), ('F', 20), ('X', 5)):
+            params = Params().where(Encounter, 'gender', '=', gender).set_limit(limit)
+            query, args = BaseServices._build_query(BASE_QUERY, params, MODEL_MAP)
+            self.assertEqual(args, [gender, limit])
+            self.assertEqual((query, args), uncached(params))
+        self.assertEqual(query_shape_cache.misses - misses, 1)
+        self.assertEqual(query_shape_cache.hits - hits, 2)
+
+    def test_different_shapes_are_compiled_apart(self):
+        first = Params().where(Encounter, 'gender', '=', 'M')
+        second = Params().where(Encounter, 'gender', '!=', 'M')
+        self.assertNotEqual(BaseServices._build_query(BASE_QUERY, first, MODEL_MAP)[0],
+                            BaseServices._build_query(BASE_QUERY, second, MODEL_MAP)[0])
+        self.assertEqual(query_shape_cache.stats()['size'], 2)
+
+    def test_base_args_come_first(self):
+        params = Params().where(Encounter, 'gender', '=', 'F')
+        query, args = BaseServices._build_query(BASE_QUERY, params, MODEL_MAP, base_arg=['2024-01-01'])
+        self.assertEqual(args, ['2024-01-01', 'F'])
+        self.assertEqual((query, args), uncached(params, ['2024-01-01']))
+
+    def test_cache_is_bounded(self):
+        query_shape_cache.max_size, max_size = 2, query_shape_cache.max_size
+        try:
+            for col in ('gender', 'age', 'scheme'):
+                BaseServices._build_query(BASE_QUERY, Params().where(Encounter, col, '=', 1), MODEL_MAP)
+            self.assertEqual(query_shape_cache.stats()['size'], 2)
+        finally:
+            query_shape_cache.max_size = max_size
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+from datetime import date
+
+from app import app
+from app.columnar import _same
+from app.db import get_db, close_months
+from app.filter_parser import Params
+from app.models import Encounter
+from app.services import DashboardServices
+from app.test_support import SeededDatabaseTestCase
+
+RANGES = [(date(2023, 1, 1), date(2024, 12, 31)), (date(2023, 3, 15), date(2024, 6, 10))]
+
+
+class FrozenMonthsTestCase(SeededDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        app.config['DASHBOARD_ENGINE'] = 'sql'
+        db = get_db()
+        close_months(db, '2024-12')
+        db.commit()
+        self.frozen = DashboardServices.freeze_closed_months(db)
+
+    def frozen_rows(self):
+        return get_db().execute('SELECT COUNT(*) FROM frozen_month_queries').fetchone()[0]
+
+    def series(self, frozen: bool):
+        app.config['DASHBOARD_FROZEN_MONTHS'] = frozen
+        result = []
+        with app.app_context():
+            for start, end in RANGES:
+                for granularity in ('month', 'quarter', 'year'):
+                    result.append(DashboardServices.get_encounter_trend(Params(), start, end, granularity=granularity))
+                    result.append(DashboardServices.get_mortality_trend(Params(), start, end, granularity=granularity))
+                    for metric in ('encounters', 'mortality', 'utilization'):
+                        result.append(DashboardServices.grouped_series(Params(), metric, granularity, 'scheme', start, end))
+        return result
+
+    def assert_frozen_matches_live(self):
+        live, frozen = self.series(False), self.series(True)
+        for index, (expected, result) in enumerate(zip(live, frozen)):
+            self.assertTrue(_same(result, expected), (index, result, expected))
+
+    def test_close_months_freezes_the_trends(self):
+        self.assertGreater(self.frozen, 0)
+        self.assertEqual(self.frozen, self.frozen_rows())
+        self.assert_frozen_matches_live()
+
+    def test_frozen_counts_are_read(self):
+        trend = lambda: DashboardServices.get_encounter_trend(Params(), *RANGES[0], granularity='month')
+        with app.app_context():
+            before = trend()
+        get_db().execute("UPDATE frozen_month_counts SET count = count + 1000 WHERE month = '2023-05'")
+        get_db().commit()
+        with app.app_context():
+            after = trend()
+        self.assertNotEqual(before, after)
+
+    def test_dashboard_reads_do_not_freeze(self):
+        get_db().execute('DELETE FROM frozen_month_queries')
+        get_db().commit()
+        self.assert_frozen_matches_live()
+        self.assertEqual(self.frozen_rows(), 0)
+
+    def test_filtered_trends_are_counted_live(self):
+        params = Params().where(Encounter, 'gender', '=', 'F')
+        for frozen in (False, True):
+            app.config['DASHBOARD_FROZEN_MONTHS'] = frozen
+            with app.app_context():
+                trend = DashboardServices.get_encounter_trend(params, *RANGES[0], granularity='year')
+            self.assertEqual(sum(row['date_count'] for row in trend), get_db().execute(
+                "SELECT COUNT(*) FROM encounters WHERE gender = 'F'").fetchone()[0])
+
+    def test_back_dated_write_reopens_the_month(self):
+        db = get_db()
+        db.execute("UPDATE encounters SET date = '2023-05-20' WHERE id = (SELECT MIN(id) FROM encounters WHERE date LIKE '2024-08%')")
+        db.commit()
+        months = {row[0] for row in db.execute('SELECT DISTINCT month FROM frozen_month_queries')}
+        self.assertNotIn('2023-05', months)
+        self.assertNotIn('2024-08', months)
+        self.assertIn('2023-06', months)
+        self.assert_frozen_matches_live()
+
+        # a re-opened month stays live until flask close-months closes it again
+        DashboardServices.freeze_closed_months(db)
+        self.assertEqual(db.execute("SELECT COUNT(*) FROM frozen_month_queries WHERE month = '2023-05'").fetchone()[0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
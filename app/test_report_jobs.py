@@ -0,0 +1,85 @@
+import io
+import os
+import time
+import unittest
+from datetime import date
+
+from app import app
+from app.db import get_db
+from app.exceptions import ServiceError
+from app.report_jobs import artifact_path, get_job, jobs_enabled, submit_report
+from app.test_support import SeededDatabaseTestCase
+
+START, END = date(2024, 1, 1), date(2024, 6, 30)
+
+
+class ReportJobsTestCase(SeededDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        app.config['REPORT_JOBS_ENABLED'] = True
+        self.builds = []
+
+    def build(self, report_type, start_date, end_date, facility_id):
+        self.builds.append((report_type, start_date, end_date, facility_id))
+        return f'{report_type}.xlsx', io.BytesIO(f'{report_type} {start_date} {end_date}'.encode())
+
+    def failing_build(self, *args):
+        raise ServiceError('No report available for the selected period')
+
+    def submit(self, build=None):
+        with app.app_context():
+            return submit_report('encounter', START, END, None, build or self.build)
+
+    def wait(self, job_id: int):
+        for _ in range(200):
+            with app.app_context():
+                job = get_job(job_id)
+                if job['status'] in ('done', 'failed'):
+                    return job
+            time.sleep(0.05)
+        raise AssertionError(f'report job {job_id} did not finish')
+
+    def test_jobs_enabled(self):
+        self.assertTrue(jobs_enabled())
+        app.config['REPORT_JOBS_ENABLED'] = False
+        self.assertFalse(jobs_enabled())
+
+    def test_job_stores_the_report(self):
+        job = self.wait(self.submit()['id'])
+        self.assertEqual((job['status'], job['report_name']), ('done', 'encounter.xlsx'))
+        self.assertEqual(self.builds, [('encounter', START, END, None)])
+        with open(artifact_path(job), 'rb') as file:
+            self.assertEqual(file.read(), b'encounter 2024-01-01 2024-06-30')
+
+    def test_finished_job_is_reused(self):
+        job = self.wait(self.submit()['id'])
+        again = self.submit()
+        self.assertEqual((again['id'], again['status']), (job['id'], 'done'))
+        self.assertEqual(len(self.builds), 1)
+
+    def test_failed_job_is_queued_again(self):
+        failed = self.wait(self.submit(self.failing_build)['id'])
+        self.assertEqual((failed['status'], failed['error']), ('failed', 'No report available for the selected period'))
+        self.assertIsNone(artifact_path(failed))
+
+        retried = self.wait(self.submit()['id'])
+        self.assertEqual((retried['id'], retried['status']), (failed['id'], 'done'))
+
+    def test_data_change_replaces_the_job(self):
+        old = self.wait(self.submit()['id'])
+        path = artifact_path(old)
+        db = get_db()
+        db.execute("UPDATE encounters SET client_name = 'Ada Bello' WHERE id = 1")
+        db.commit()
+
+        new = self.wait(self.submit()['id'])
+        self.assertNotEqual(new['id'], old['id'])
+        self.assertGreater(new['data_version'], old['data_version'])
+        self.assertEqual(len(self.builds), 2)
+        with app.app_context():
+            self.assertIsNone(get_job(old['id']))
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+from datetime import date
+
+import pandas as pd
+
+from app.db import get_read_db
+from app.services import ReportServices
+from app.test_support import SeededDatabaseTestCase
+
+START, END = date(2024, 1, 1), date(2024, 12, 31)
+
+
+class ReportPivotTestCase(SeededDatabaseTestCase):
+    def test_grouped_by_pivot_dimensions(self):
+        keys = ('facility_name', 'age_group', 'gender')
+        items = [dict(row) for row in get_read_db().execute(ReportServices.ENCOUNTER_ROWS, (START, END))]
+        grouped = ReportServices._pivot_counts(ReportServices.ENCOUNTER_ROWS, (START, END), keys)
+
+        self.assertEqual(list(grouped.columns), [*keys, 'count'])
+        self.assertLess(len(grouped), len(items))
+        self.assertFalse(grouped.duplicated(list(keys)).any())
+        self.assertEqual(grouped['count'].sum(), len(items))
+
+    def test_encounter_report_matches_item_pivot(self):
+        _, report = ReportServices.generate_encounter_report(START, END)
+        items = pd.DataFrame([dict(row) for row in get_read_db().execute(ReportServices.ENCOUNTER_ROWS, (START, END))])
+        expected = items.pivot_table(index='facility_name', values='policy_number',
+                                     columns=['age_group', 'gender'], aggfunc='count', fill_value=0)
+
+        totals = report.set_index(report.columns[0]).drop('TOTAL')
+        for facility, row in expected.iterrows():
+            for column, count in row.items():
+                self.assertEqual(totals.loc[facility, column], count, (facility, column))
+        self.assertEqual(totals['GRAND TOTAL'].sum(), len(items))
+
+
+if __name__ == '__main__':
+    unittest.main()
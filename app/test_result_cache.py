@@ -0,0 +1,67 @@
+import unittest
+
+from app import app
+from app.db import get_db
+from app.filter_parser import Params
+from app.models import Encounter
+from app.result_cache import result_cache
+from app.services import DashboardServices
+from app.test_support import SeededDatabaseTestCase
+
+
+class ResultCacheTestCase(SeededDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        app.config['DASHBOARD_CACHE_ENABLED'] = True
+        result_cache.clear()
+
+    def tearDown(self):
+        result_cache.clear()
+        super().tearDown()
+
+    def top_facilities(self):
+        with app.app_context():
+            return DashboardServices.get_top_encounter_facilities(Params())
+
+    def counts(self):
+        return result_cache.stats()['DashboardServices.get_top_encounter_facilities']
+
+    def test_repeated_call_is_a_hit(self):
+        first = self.top_facilities()
+        self.assertEqual(self.top_facilities(), first)
+        self.assertEqual(self.counts(), {'hits': 1, 'misses': 1})
+
+    def test_params_are_part_of_the_key(self):
+        self.top_facilities()
+        with app.app_context():
+            DashboardServices.get_top_encounter_facilities(Params().where(Encounter, 'gender', '=', 'F'))
+        self.assertEqual(self.counts(), {'hits': 0, 'misses': 2})
+
+    def test_writes_invalidate(self):
+        first = self.top_facilities()
+        db = get_db()
+        db.execute('UPDATE encounters SET facility_id = 2 WHERE facility_id = 1 AND id % 12 = 1')
+        db.commit()
+        second = self.top_facilities()
+        self.assertEqual(self.counts(), {'hits': 0, 'misses': 2})
+        self.assertNotEqual(second, first)
+        self.assertEqual(second[0]['facility_name'], 'Omega Clinic')
+
+    def test_writes_invalidate_within_the_same_request(self):
+        with app.app_context():
+            first = DashboardServices.get_top_encounter_facilities(Params())
+            db = get_db()
+            db.execute('UPDATE encounters SET facility_id = 2 WHERE facility_id = 1 AND id % 12 = 1')
+            db.commit()
+            second = DashboardServices.get_top_encounter_facilities(Params())
+        self.assertEqual(self.counts(), {'hits': 0, 'misses': 2})
+        self.assertNotEqual(second, first)
+
+    def test_disabled_cache_is_bypassed(self):
+        app.config['DASHBOARD_CACHE_ENABLED'] = False
+        self.top_facilities()
+        self.assertEqual(result_cache.stats(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
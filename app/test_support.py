@@ -0,0 +1,91 @@
+''' Seeded file database shared by the dashboard, report and storage tests '''
+
+import os
+import random
+import tempfile
+import unittest
+from datetime import date, timedelta
+
+from app import app
+from app.constants import AgeGroup, OutcomeEnum
+from app.db import get_db, close_db, apply_derived_schema
+
+FACILITIES = [(1, 'Zeta Clinic', 'akure south'), (2, 'Omega Clinic', 'owo'), (3, 'Kappa Clinic', 'akure south'),
+              (4, 'Beta Clinic', 'ondo west'), (5, 'Alpha Clinic', 'owo'), (6, 'Delta Clinic', 'ifedore')]
+
+
+def seed_encounters(db, count: int = 720):
+    '''
+    Encounters over 2023 and 2024 from a fixed random seed. Facilities take turns, so they all
+    have the same number of encounters, and their ids run against their names, so only a
+    deterministic tie-break gives both engines the same order.
+    '''
+    rng = random.Random(20240101)
+    db.executemany('INSERT INTO insurance_scheme(id, scheme_name, color_scheme) VALUES (?, ?, ?)',
+                   [(1, 'BHCPFP', '#448264'), (2, 'ORANGHIS', '#fc9d03'), (3, 'AMCHIS', '#0066ff')])
+    db.executemany('INSERT INTO treatment_outcome(name, type) VALUES (?, ?)',
+                   [(OutcomeEnum.OUTPATIENT.value, 'General'), ('Referral', 'General'),
+                    (OutcomeEnum.INFANT_DEATH.value, 'Death'), (OutcomeEnum.MATERNAL_DEATH.value, 'Death')])
+    db.executemany("INSERT INTO facility(id, name, local_government, facility_type, ownership) VALUES (?, ?, ?, 'Primary', 'public')",
+                   FACILITIES)
+    db.executemany('INSERT INTO facility_scheme(facility_id, scheme_id) VALUES (?, ?)',
+                   [(facility[0], scheme) for facility in FACILITIES for scheme in (1, 2, 3)])
+    db.execute("INSERT INTO users(id, username, password_hash, role) VALUES (1, 'admin', 'x', 'admin')")
+    db.execute("INSERT INTO diseases_category(id, category_name) VALUES (1, 'Infectious')")
+    db.executemany('INSERT INTO diseases(id, name, category_id) VALUES (?, ?, 1)', [(1, 'Malaria'), (2, 'Typhoid')])
+    db.execute("INSERT INTO service_category(id, name) VALUES (1, 'Laboratory')")
+    db.executemany('INSERT INTO services(id, name, category_id) VALUES (?, ?, 1)',
+                   [(1, 'Packed Cell Volume'), (2, 'Antenatal Care'), (3, 'Normal Delivery')])
+    age_groups = [group.value for group in AgeGroup]
+    first = date(2023, 1, 1)
+    rows = []
+    for i in range(count):
+        rows.append((i + 1, FACILITIES[i % len(FACILITIES)][0],
+                     (first + timedelta(days=rng.randrange(731))).isoformat(),
+                     f'AKS/00{i}/24/C/0', f'Client {i}', rng.choice('MF'), rng.randint(0, 90),
+                     'general', 'Akure',
+                     rng.randint(1, 3), '12345678901', '08020007040', f'H{i}', None,
+                     rng.choice(age_groups), 'Walk-in', rng.randint(0, 5000), rng.randint(0, 5000),
+                     rng.randint(0, 5000), 'Dr. Musa', rng.choice([1, 1, 1, 2, 3, 4]), 1, '2024-01-01'))
+    db.executemany('''
+    INSERT INTO encounters(id, facility_id, date, policy_number, client_name, gender, age, enc_type, address,
+        scheme, nin, phone_number, hospital_number, referral_reason, age_group, mode_of_entry,
+        treatment_cost, medication_cost, investigation_cost, doctor_name, outcome, created_by, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    db.executemany('INSERT INTO encounters_diseases(encounter_id, disease_id) VALUES (?, ?)',
+                   [(i + 1, 1 + i % 2) for i in range(count) if i % 3])
+    db.executemany('INSERT INTO encounters_services(encounter_id, service_id) VALUES (?, 1)',
+                   [(i + 1,) for i in range(count) if i % 4 == 0])
+    db.commit()
+
+
+class SeededDatabaseTestCase(unittest.TestCase):
+    '''
+    Each test gets a new database file with the schema, the derived schema and, unless seed
+    is False, seed_encounters. A file rather than :memory:, since read connections, the
+    column store and report jobs open their own connections to it.
+    '''
+    seed = True
+
+    def setUp(self):
+        self.config = dict(app.config)
+        self.directory = tempfile.TemporaryDirectory()
+        app.config.update(TESTING=True, DATABASE=os.path.join(self.directory.name, 'odchc.db'),
+                          DB_POOL_ENABLED=False, DASHBOARD_CACHE_ENABLED=False, DASHBOARD_CACHE_FILE=None,
+                          REPORT_DIR=None, BITMAP_INDEX_FILE=None)
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db = get_db()
+        with app.open_resource('schema.sql') as f:
+            db.executescript(f.read().decode('utf8'))
+        apply_derived_schema(db)
+        if self.seed:
+            seed_encounters(db)
+
+    def tearDown(self):
+        close_db()
+        self.app_context.pop()
+        app.config.clear()
+        app.config.update(self.config)
+        self.directory.cleanup()